@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+複数モデルを同時に提供する A/B テスト用に、セッションをモデルへ
+重み付きで割り当てるモジュール。
+割り当ては重み付きランデブーハッシュで行うため、同じセッションは
+どのプロセスでも同じモデルに割り当てられ、モデルの追加・削除時に
+割り当てが変わるのは追加・削除したモデルに関係するセッションのみとなる。
+"""
+import hashlib
+import math
+
+def parse_model_specs(spec):
+    """
+    モデル指定文字列を解析する。
+    引数：
+        spec    "モデルID=パス[:重み],..." 形式の文字列（重み省略時は1）
+    戻り値：
+        [(モデルID, パス, 重み), ...]
+    """
+    models = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' not in item:
+            raise ValueError(f'model spec={item}: expected <id>=<path>[:<weight>]')
+        model_id, path = item.split('=', 1)
+        weight = 1.0
+        if ':' in path:
+            head, tail = path.rsplit(':', 1)
+            try:
+                weight = float(tail)
+                path = head
+            except ValueError:
+                pass
+        if weight <= 0:
+            raise ValueError(f'model spec={item}: weight must be positive')
+        if model_id in [m[0] for m in models]:
+            raise ValueError(f'model id={model_id}: duplicated')
+        models.append((model_id, path, weight))
+    if not models:
+        raise ValueError(f'model spec={spec}: no models')
+    return models
+
+def _unit_hash(model_id, session_id):
+    """
+    (モデルID, セッションID) から (0, 1) の一様な値を算出する。
+    """
+    digest = hashlib.blake2b(f'{model_id}\0{session_id}'.encode(), digest_size=8).digest()
+    return (int.from_bytes(digest, 'big') + 0.5) / 2.0 ** 64
+
+class ModelAssigner:
+    """
+    セッションIDをモデルIDへ重み付きで割り当てるクラス。
+    """
+    def __init__(self, weights):
+        """
+        引数：
+            weights     {モデルID: 重み}
+        戻り値：
+            なし
+        """
+        self.weights = dict(weights)
+
+    def assign(self, session_id):
+        """
+        セッションIDを割り当てるモデルIDを取得する。
+        各モデルのスコア -重み / log(ハッシュ値) が最大のモデルを選ぶ。
+        引数：
+            session_id  セッションID
+        戻り値：
+            モデルID
+        """
+        if len(self.weights) == 1:
+            return next(iter(self.weights))
+        return max(self.weights, key=lambda model_id:
+            -self.weights[model_id] / math.log(_unit_hash(model_id, session_id)))
+
+# テスト
+
+def test_parse_model_specs():
+    assert(parse_model_specs('prob=prob_ppo:2, pa=pa_ppo,policy=/tmp/a:b.npz') == [
+        ('prob', 'prob_ppo', 2.0), ('pa', 'pa_ppo', 1.0), ('policy', '/tmp/a:b.npz', 1.0)])
+    for spec in ['prob_ppo', 'a=x:0', 'a=x,a=y', '']:
+        try:
+            parse_model_specs(spec)
+            assert(False)
+        except ValueError:
+            pass
+
+def test_model_assigner():
+    from collections import Counter
+    sessions = [f'session{i}' for i in range(20000)]
+    assigner = ModelAssigner({'prob': 2.0, 'pa': 1.0, 'policy': 1.0})
+    assignments = [assigner.assign(s) for s in sessions]
+    counts = Counter(assignments)
+    assert(abs(counts['prob'] / len(sessions) - 0.5) < 0.02)
+    assert(abs(counts['pa'] / len(sessions) - 0.25) < 0.02)
+    assert(assignments == [assigner.assign(s) for s in sessions])
+    # モデルを削除しても、残るモデルに割り当て済みのセッションは移動しない
+    smaller = ModelAssigner({'prob': 2.0, 'pa': 1.0})
+    for session_id, model_id in zip(sessions, assignments):
+        if model_id != 'policy':
+            assert(smaller.assign(session_id) == model_id)
+
+if __name__ == '__main__':
+    test_parse_model_specs()
+    test_model_assigner()
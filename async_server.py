@@ -0,0 +1,601 @@
+# -*- coding: utf-8 -*-
+"""
+Webアプリケーション「AI対戦じゃんけん」の ASGI エントリポイントモジュール。
+server.py と同じ /、/pon/*、/reload（および /stats、/metrics）を提供する。
+推論・モデルのロード・セッションストアの読み書きのみをスレッドプールで実行し、
+観測の更新・勝敗判定はイベントループ上で行うため、
+待機中のプレイヤー毎にスレッドを消費しない。
+セッションクッキーは server.py と同じ形式で、観測の更新もセッションストアの
+begin()/commit() で行うため、両者（や複数ワーカー）でセッションストアを共有できる。
+
+Setup:
+    pip install docopt flask uvicorn stable-baselines3
+
+Usage:
+    async_server.py [--host=<host>] [--port=<port>] [--model_path=<target_model_path>] [--session_store=<store>] [--session_path=<path>] [--length=<n>] [--workers=<n>] [--max_pending=<n>] [--timeout_ms=<ms>] [--batch_size=<n>] [--batch_wait_ms=<ms>] [--cache_size=<n>] [--lookup_path=<path>] [--lookup_threshold=<rate>] [--trajectory_path=<path>] [--models=<spec>] [--warm_up]
+
+Options:
+    --host=<host>                       bind host [default: 127.0.0.1]
+    --port=<port>                       bind port [default: 5000]
+    --model_path=<target_model_path>    set target model path (*.npz: numpy policy)
+    --session_store=<store>             session store: memory or sqlite [default: memory]
+    --session_path=<path>               sqlite session store file path [default: sessions.sqlite3]
+    --length=<n>                        observation window (past rounds kept per session,
+                                        default: the models' training observation length)
+    --workers=<n>                       inference threads [default: 2]
+    --max_pending=<n>                   max queued inference requests before answering 503 [default: 1024]
+    --timeout_ms=<ms>                   inference timeout before answering 504 [default: 1000]
+    --batch_size=<n>                    max requests per batched inference [default: 32]
+    --batch_wait_ms=<ms>                max wait time to collect a batch [default: 2]
+    --cache_size=<n>                    cached observations for model inference (0: disabled) [default: 65536]
+    --lookup_path=<path>                lookup table distilled from the model (lookup_policy.py)
+    --lookup_threshold=<rate>           min agreement to answer from the lookup table [default: 0.95]
+    --trajectory_path=<path>            append every round to a binary trajectory file
+                                        (process id is added before the extension)
+    --models=<spec>                     serve several models, sessions split by weight
+                                        (e.g. prob=prob_ppo:2,pa=pa_ppo:1,policy=policy_ppo:1)
+    --warm_up                           load model and run first inference before serving
+"""
+import asyncio
+import atexit
+import json
+import mimetypes
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+
+import numpy as np
+
+import server
+from numpy_policy import action_probs
+from sessions import SessionConflict
+
+# URLと行動の対応
+MOVES = {'/pon/goo': 0, '/pon/paa': 1, '/pon/choki': 2}
+# 静的ファイルディレクトリ
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+class Overloaded(Exception):
+    """
+    推論待ちリクエスト数が上限に達した場合の例外。
+    """
+    pass
+
+class AsyncBatchPredictor:
+    """
+    イベントループ上でリクエストを集め、まとめて推論するスケジューラクラス。
+    推論は上限付きスレッドプールで実行し、同時に実行するバッチ数はスレッド数までとする。
+    推論待ちリクエスト数が max_pending に達した場合は Overloaded を送出し、
+    timeout 秒以内に推論が完了しない場合は asyncio.TimeoutError を送出する。
+    """
+    def __init__(self, workers=2, max_batch=32, max_wait=0.002,
+            max_pending=1024, timeout=1.0):
+        """
+        引数：
+            workers         推論スレッド数
+            max_batch       1回の推論でまとめる最大件数
+            max_wait        最初のリクエスト到着後に待つ最大時間（秒）
+            max_pending     推論待ちリクエスト数の上限
+            timeout         推論待ちのタイムアウト（秒）
+        戻り値：
+            なし
+        """
+        self.workers = workers
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.loop = None
+        self.queue = None
+        self.slots = None
+        self.task = None
+        self.pending = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _start(self):
+        """
+        実行中のイベントループ上でキュー・バッチ収集タスクを生成する。
+        """
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.loop is not loop:
+            self.loop = loop
+            self.pending = 0
+            self.queue = asyncio.Queue()
+            self.slots = asyncio.Semaphore(self.workers)
+            self.task = loop.create_task(self._run())
+
+    async def predict_probs(self, observation, model):
+        """
+        観測をキューへ追加し、各行動の選択確率を待って返却する。
+        引数：
+            observation     観測 (100, 2)
+            model           推論に使用するモデル
+        戻り値：
+            行動選択確率 (行動数,)
+        """
+        self._start()
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise Overloaded()
+        future = asyncio.get_running_loop().create_future()
+        self.pending += 1
+        self.queue.put_nowait((np.array(observation), model, future))
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    async def _next_batch(self):
+        """
+        最初のリクエストが届くまで待ち、その後max_wait経過またはmax_batch件
+        に達するまでリクエストを集める。タイムアウト済みのリクエストは除く。
+        """
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        alive = [request for request in batch if not request[2].done()]
+        self.pending -= len(batch) - len(alive)
+        return alive
+
+    async def _run(self):
+        """
+        バッチ収集タスク本体。空きスレッドを待ってから推論を依頼する。
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            groups = {}
+            for request in batch:
+                groups.setdefault(id(request[1]), []).append(request)
+            for group in groups.values():
+                await self.slots.acquire()
+                observations = np.stack([request[0] for request in group])
+                job = loop.run_in_executor(self.executor,
+                    action_probs, group[0][1], observations)
+                job.add_done_callback(
+                    lambda job, group=group: self._finish(job, group))
+
+    def _finish(self, job, group):
+        """
+        推論結果を各リクエストへ返却し、スレッドを解放する。
+        """
+        self.slots.release()
+        self.pending -= len(group)
+        error = job.exception()
+        for i, (_, _, future) in enumerate(group):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(job.result()[i])
+
+    def stats(self):
+        """
+        推論待ちリクエスト数・拒否数・タイムアウト数を取得する。
+        """
+        return {
+            'pending':      self.pending,
+            'rejected':     self.rejected,
+            'timeouts':     self.timeouts,
+        }
+
+# ASGI アプリケーションが使用する推論スケジューラ
+predictor = AsyncBatchPredictor()
+# 行動の抽選に使用する乱数（キャッシュを使用しない場合）
+rng = np.random.default_rng()
+# セッション毎の排他用ロック（イベントループ上で使用する）
+session_locks = [asyncio.Lock() for _ in range(server.store.LOCK_STRIPES)]
+
+def start_registries():
+    """
+    モデルをロードし、現在のプロセスでモデルレジストリのスレッドを開始する。
+    推論はAsyncBatchPredictorで行うため、server.py の BatchPredictor は生成しない。
+    引数：
+        なし
+    戻り値：
+        {モデルID: ModelRegistry インスタンス}
+    """
+    server.load_models()
+    if server.worker_pid != os.getpid():
+        with server.model_lock:
+            if server.worker_pid != os.getpid():
+                server.start_workers(batch=False)
+    return server.registries
+
+async def get_registries():
+    """
+    モデルID毎のモデルレジストリを取得する。
+    初回（fork した子プロセスでは最初のリクエスト時）はモデルのロード・
+    スレッドの開始をスレッドで行い、イベントループを止めない。
+    """
+    if server.registries is None or server.worker_pid != os.getpid():
+        await asyncio.get_running_loop().run_in_executor(None, start_registries)
+    return server.registries
+
+async def begin_session(session_id):
+    """
+    セッションストアの begin() をスレッドで実行し、更新する観測を取得する。
+    SQLite等のファイルI/Oでイベントループを止めない。
+    引数：
+        session_id  セッションID
+    戻り値：
+        (観測（ObservationBuffer）, commit_session() へ渡すバージョン)
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        None, server.store.begin, session_id)
+
+async def commit_session(session_id, obs, session_version):
+    """
+    セッションストアの commit() をスレッドで実行し、観測を格納する。
+    別のプロセスが先に同じセッションを更新していた場合は SessionConflict を送出する。
+    引数：
+        session_id      セッションID
+        obs             観測（ObservationBuffer）
+        session_version begin_session() が返却したバージョン
+    戻り値：
+        なし
+    """
+    await asyncio.get_running_loop().run_in_executor(
+        None, server.store.commit, session_id, obs, session_version)
+
+async def choose_action(obs, version, model_id):
+    """
+    モデル側の行動を選択する。参照テーブル・キャッシュはイベントループ上で参照し、
+    推論のみスレッドプールで実行する。
+    引数：
+        obs         観測（ObservationBuffer）
+        version     推論に使用するモデルバージョン
+        model_id    モデルID（キャッシュの選択に使用）
+    戻り値：
+        (モデルが選択した行動, 使用した参照テーブル（使用しない場合None）)
+    """
+    table = server.lookup
+    if table is not None and table.source_digest == version.digest:
+        return int(table.predict(obs.view())[0]), table
+    cache = server.caches.get(model_id)
+    if cache is not None:
+        enemy_action = cache.get(obs.hash_value, version.model)
+        if enemy_action is not None:
+            return enemy_action, None
+    probs = await predictor.predict_probs(obs.view(), version.model)
+    if cache is not None:
+        return cache.put(obs.hash_value, probs, version.model), None
+    return int((rng.random() > np.cumsum(probs)[:-1]).sum()), None
+
+def load_session_id(headers):
+    """
+    クッキー上のセッションIDを取得する（server.py と同じ署名形式）。
+    引数：
+        headers     リクエストヘッダ辞書
+    戻り値：
+        セッションID（存在しない・署名が不正な場合None）
+    """
+    cookie = SimpleCookie(headers.get('cookie', ''))
+    name = server.app.config['SESSION_COOKIE_NAME']
+    if name not in cookie:
+        return None
+    serializer = server.app.session_interface.get_signing_serializer(server.app)
+    try:
+        return serializer.loads(cookie[name].value).get('sid')
+    except Exception:
+        return None
+
+def session_cookie(session_id):
+    """
+    セッションIDを格納する Set-Cookie ヘッダ値を生成する。
+    """
+    serializer = server.app.session_interface.get_signing_serializer(server.app)
+    name = server.app.config['SESSION_COOKIE_NAME']
+    return f'{name}={serializer.dumps({"sid": session_id})}; HttpOnly; Path=/; SameSite=Lax'
+
+async def send_response(send, status, body, content_type='application/json', headers=()):
+    """
+    HTTPレスポンスを送信する。
+    """
+    if isinstance(body, str):
+        body = body.encode()
+    await send({
+        'type':     'http.response.start',
+        'status':   status,
+        'headers':  [(b'content-type', content_type.encode()),
+            (b'content-length', str(len(body)).encode())]
+            + [(key.encode(), value.encode()) for key, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def pon(my_action, headers, send):
+    """
+    セッションの観測を使ってじゃんけん結果をJSONで返却する。
+    推論待ちが上限を超えた場合は503、タイムアウトした場合は504を返却する。
+    """
+    started = time.perf_counter()
+    server.in_flight_gauge.inc()
+    try:
+        session_id = load_session_id(headers)
+        cookie_headers = []
+        if session_id is None:
+            session_id = server.store.new_session_id()
+            cookie_headers = [('set-cookie', session_cookie(session_id))]
+        registries = await get_registries()
+        model_id = server.assigner.assign(session_id)
+        server.request_counter.inc(server.MOVE_NAMES[my_action], model_id)
+        # プロセス内の同じセッションはロックで直列化し、別プロセスとの競合は
+        # セッションストアの commit() で検出して最新の観測でやり直す
+        async with session_locks[hash(session_id) % len(session_locks)]:
+            for attempt in range(server.store.MAX_RETRIES):
+                loaded = time.perf_counter()
+                obs, session_version = await begin_session(session_id)
+                server.stage_histogram.observe(time.perf_counter() - loaded, 'session_load')
+                version = registries[model_id].current()
+                inferring = time.perf_counter()
+                try:
+                    enemy_action, table = await choose_action(obs, version, model_id)
+                except Overloaded:
+                    return await send_response(send, 503,
+                        json.dumps({'error': 'overloaded'}), headers=cookie_headers)
+                except asyncio.TimeoutError:
+                    return await send_response(send, 504,
+                        json.dumps({'error': 'inference timeout'}), headers=cookie_headers)
+                server.stage_histogram.observe(time.perf_counter() - inferring, 'predict')
+                result = server.play_round(my_action, obs, version, enemy_action,
+                    table, model_id)
+                saving = time.perf_counter()
+                try:
+                    await commit_session(session_id, obs, session_version)
+                except SessionConflict:
+                    if attempt + 1 == server.store.MAX_RETRIES:
+                        raise
+                    await asyncio.sleep(server.store.retry_wait(attempt))
+                    continue
+                server.stage_histogram.observe(time.perf_counter() - saving, 'session_save')
+                break
+        server.record_round(session_id, result, obs.rounds)
+        encoding = time.perf_counter()
+        body = json.dumps(result)
+        finished = time.perf_counter()
+        server.stage_histogram.observe(finished - encoding, 'json_encode')
+        server.request_histogram.observe(finished - started, model_id)
+        await send_response(send, 200, body, headers=cookie_headers)
+    finally:
+        server.in_flight_gauge.dec()
+
+async def show_index(headers, send):
+    """
+    index.html を表示する。セッションが存在しない場合は観測を初期化する。
+    """
+    session_id = load_session_id(headers)
+    cookie_headers = []
+    if session_id is None:
+        session_id = server.store.new_session_id()
+        cookie_headers = [('set-cookie', session_cookie(session_id))]
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, server.store.load, session_id) is None:
+        await loop.run_in_executor(
+            None, server.store.save, session_id, server.store.new_observation())
+    html = server.app.jinja_env.get_template('index.html').render()
+    await send_response(send, 200, html, 'text/html; charset=utf-8', cookie_headers)
+
+async def show_static(path, send):
+    """
+    static ディレクトリ配下のファイルを返却する。
+    """
+    file_path = os.path.normpath(os.path.join(STATIC_DIR, path[len('/static/'):]))
+    if not file_path.startswith(STATIC_DIR + os.sep) or not os.path.isfile(file_path):
+        return await send_response(send, 404, json.dumps({'error': 'not found'}))
+    def read():
+        with open(file_path, 'rb') as f:
+            return f.read()
+    body = await asyncio.get_running_loop().run_in_executor(None, read)
+    content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    await send_response(send, 200, body, content_type)
+
+async def reload_model(query, send):
+    """
+    全モデルファイルの更新を確認し、変更されていればバックグラウンドで
+    ロードして差し替える。クエリ文字列に wait=1 を指定した場合はロード完了まで待つ
+    （待つ間もイベントループは止めない）。応答は server.py と同じ形式とする。
+    """
+    registries = await get_registries()
+    old_versions = {model_id: r.current() for model_id, r in registries.items()}
+    futures = {model_id: r.reload() for model_id, r in registries.items()}
+    wait = 'wait=1' in query.split('&')
+    models = {}
+    for model_id, future in futures.items():
+        models[model_id] = {
+            'old_model':    old_versions[model_id].info(),
+            'is_updated':   await asyncio.wrap_future(future) if wait else None,
+            'new_model':    registries[model_id].current().info(),
+        }
+    result = dict(next(iter(models.values())))
+    result['models'] = models
+    await send_response(send, 200, json.dumps(result))
+
+async def app(scope, receive, send):
+    """
+    ASGI アプリケーション本体。
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    path, method = scope['path'], scope['method']
+    headers = {key.decode('latin-1'): value.decode('latin-1')
+        for key, value in scope.get('headers', [])}
+    if path in MOVES and method == 'POST':
+        await pon(MOVES[path], headers, send)
+    elif path == '/' and method == 'GET':
+        await show_index(headers, send)
+    elif path.startswith('/static/') and method == 'GET':
+        await show_static(path, send)
+    elif path == '/reload' and method == 'GET':
+        await reload_model(scope.get('query_string', b'').decode(), send)
+    elif path == '/stats' and method == 'GET':
+        stats = {'inference': predictor.stats(), 'startup': server.startup_times}
+        if server.caches:
+            stats['cache'] = {model_id: cache.stats()
+                for model_id, cache in server.caches.items()}
+        await send_response(send, 200, json.dumps(stats))
+    elif path == '/metrics' and method == 'GET':
+        await send_response(send, 200, server.metrics.render(),
+            'text/plain; version=0.0.4; charset=utf-8')
+    else:
+        await send_response(send, 404, json.dumps({'error': 'not found'}))
+
+# テスト
+
+async def _request(method, path, cookie=None, query=b''):
+    headers = [] if cookie is None else [(b'cookie', cookie.encode())]
+    messages = []
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+    async def send(message):
+        messages.append(message)
+    await app({'type': 'http', 'method': method, 'path': path,
+        'headers': headers, 'query_string': query}, receive, send)
+    start = messages[0]
+    response_headers = {key.decode(): value.decode() for key, value in start['headers']}
+    return start['status'], response_headers, messages[1]['body']
+
+class _SlowModel:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+    def action_probs(self, observations):
+        self.calls += 1
+        time.sleep(self.delay)
+        return np.tile([0.0, 1.0, 0.0], (len(observations), 1))
+
+def test_async_predictor():
+    async def run():
+        model = _SlowModel()
+        predictor = AsyncBatchPredictor(workers=1, max_batch=64, max_wait=0.01)
+        observations = [np.zeros((100, 2), dtype=np.int8)] * 50
+        probs = await asyncio.gather(*[predictor.predict_probs(o, model)
+            for o in observations])
+        assert(all(p.tolist() == [0.0, 1.0, 0.0] for p in probs))
+        assert(model.calls < 50)
+        # 上限を超えた場合は拒否、時間内に推論できない場合はタイムアウト
+        slow = _SlowModel(delay=0.2)
+        predictor = AsyncBatchPredictor(workers=1, max_batch=1, max_wait=0.0,
+            max_pending=2, timeout=0.05)
+        results = await asyncio.gather(*[predictor.predict_probs(o, slow)
+            for o in observations[:3]], return_exceptions=True)
+        assert(isinstance(results[2], Overloaded))
+        assert(isinstance(results[0], asyncio.TimeoutError))
+        assert(predictor.stats()['rejected'] == 1)
+    asyncio.run(run())
+
+def test_async_app():
+    import tempfile
+    from numpy_policy import NumpyPolicy
+    from sessions import SqliteSessionStore
+
+    class ConflictingStore(SqliteSessionStore):
+        # 最初の commit() だけ別プロセスに先を越されたものとして扱う
+        conflicts = 1
+        def commit(self, session_id, observation, version):
+            if self.conflicts > 0:
+                self.conflicts -= 1
+                super().commit(session_id, observation, version)
+                raise SessionConflict(session_id)
+            super().commit(session_id, observation, version)
+    with tempfile.TemporaryDirectory() as dirname:
+        path = os.path.join(dirname, 'model.npz')
+        rng = np.random.default_rng(0)
+        np.savez(path, weight_0=rng.normal(size=(8, 200)), bias_0=np.zeros(8),
+            action_weight=rng.normal(size=(3, 8)), action_bias=np.zeros(3),
+            num_layers=np.array(1), activation=np.array('Tanh'),
+            observation_shape=np.array([100, 2]))
+        saved = (server.PATH, server.registries, server.predictor, server.worker_pid,
+            server.assigner, server.caches, server.store)
+        server.PATH = path
+        server.store = ConflictingStore(os.path.join(dirname, 'sessions.db'))
+        server.registries = server.predictor = server.worker_pid = None
+        try:
+            async def run():
+                status, headers, body = await _request('GET', '/')
+                assert(status == 200 and b'<html' in body)
+                cookie = headers['set-cookie'].split(';')[0]
+                observations = []
+                for move in ['goo', 'paa', 'choki']:
+                    status, headers, body = await _request('POST', f'/pon/{move}', cookie)
+                    assert(status == 200 and 'set-cookie' not in headers)
+                    result = json.loads(body)
+                    observations.append(result['observation'])
+                assert(result['my_action'] == 2 and result['model_id'] == 'model.npz')
+                assert(observations[2][-3:-1] == observations[1][-2:])
+                # 競合した1回目は先に格納された観測（1ラウンド分）から引き直している
+                assert(server.store.conflicts == 0)
+                session_id = load_session_id({'cookie': cookie})
+                assert(server.store.load(session_id).rounds == 4)
+                status, _, body = await _request('GET', '/reload', query=b'wait=1')
+                assert(status == 200 and json.loads(body)['is_updated'] == False)
+                status, _, body = await _request('GET', '/metrics')
+                assert(b'rps_requests_total{move="choki",model="model.npz"} 1' in body)
+                status, _, _ = await _request('GET', '/static/../server.py')
+                assert(status == 404)
+            asyncio.run(run())
+            # 推論は AsyncBatchPredictor で行い、server.py の BatchPredictor は生成しない
+            assert(server.predictor is None and server.worker_pid == os.getpid())
+            for registry in server.registries.values():
+                registry.close()
+        finally:
+            (server.PATH, server.registries, server.predictor, server.worker_pid,
+                server.assigner, server.caches, server.store) = saved
+
+if __name__ == '__main__':
+    from docopt import docopt
+    from sessions import MemorySessionStore, SqliteSessionStore
+    import uvicorn
+    args = docopt(__doc__)
+    if args['--model_path'] is not None:
+        server.PATH = args['--model_path']
+    if args['--models'] is not None:
+        server.MODELS = server.parse_model_specs(args['--models'])
+    # 観測長はモデルの学習時の観測長に揃え、指定が異なる場合は起動時にエラーとする
+    length = server.model_length()
+    if args['--length'] is not None and int(args['--length']) != length:
+        raise ValueError(f'length={args["--length"]}: models were trained with '
+            f'observation length {length}')
+    if args['--session_store'] == 'sqlite':
+        server.store = SqliteSessionStore(args['--session_path'], length=length)
+    elif args['--session_store'] == 'memory':
+        server.store = MemorySessionStore(length=length)
+    else:
+        raise ValueError(f'session_store={args["--session_store"]}: no match argument')
+    server.CACHE_SIZE = int(args['--cache_size'])
+    server.LOOKUP_PATH = args['--lookup_path']
+    server.LOOKUP_THRESHOLD = float(args['--lookup_threshold'])
+    if args['--trajectory_path'] is not None:
+        server.recorder = server.open_recorder(args['--trajectory_path'])
+        atexit.register(server.recorder.close)
+    predictor = AsyncBatchPredictor(workers=int(args['--workers']),
+        max_batch=int(args['--batch_size']),
+        max_wait=float(args['--batch_wait_ms']) / 1000.0,
+        max_pending=int(args['--max_pending']),
+        timeout=float(args['--timeout_ms']) / 1000.0)
+    if args['--warm_up']:
+        server.warm_up()
+    uvicorn.run(app, host=args['--host'], port=int(args['--port']))
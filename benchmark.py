@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+環境・プレイヤー・推論処理のスループット(ops/sec)を計測するベンチマークモジュール。
+ウォームアップ・繰り返し回数・乱数シードを固定し、結果をJSONで出力するため
+コミット間で比較できる。
+観測長のリストを指定すると、観測長毎の環境ステップ・方策推論の計測
+（window.<観測長>.*）を追加する。
+
+Usage:
+    benchmark.py [--model_path=<path>] [--number=<number>] [--repeat=<repeat>] [--warmup=<warmup>] [--seed=<seed>] [--windows=<lengths>] [--filter=<filter>] [--output=<output>]
+
+Options:
+    --model_path=<path>     trained model path for AIPlayer / server benchmarks (*.npz: numpy policy)
+    --number=<number>       calls per repeat [default: 1000]
+    --repeat=<repeat>       number of repeats [default: 5]
+    --warmup=<warmup>       warm-up calls before measuring [default: 100]
+    --seed=<seed>           random seed [default: 0]
+    --windows=<lengths>     observation lengths for window.* benchmarks (e.g. 10,100,1000,10000)
+    --filter=<filter>       run benchmarks whose name contains <filter>
+    --output=<output>       result json file path (default: stdout)
+"""
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from envs import (RockPaperScissorsEnv, EvalEnv, Player, ProbPlayer,
+    EnemyPlayer, JurinaPlayer, NGramPlayer, AIPlayer)
+
+# Player.predict 計測時に観測へ順に追加する手の数（キャッシュの最大件数より多くする）
+STREAM_SIZE = 1 << 17
+
+# 観測長毎の方策推論計測に使用する隠れ層のユニット数
+# （stable_baselines3 の MlpPolicy の既定値と同じ構成）
+POLICY_LAYERS = [64, 64]
+
+def measure(fn, number=1000, repeat=5, warmup=100):
+    """
+    関数の実行時間を計測する。
+    引数：
+        fn          計測対象関数（引数なし）
+        number      1回の計測で呼び出す回数
+        repeat      計測回数
+        warmup      計測前に呼び出す回数
+    戻り値：
+        計測結果辞書（best/median は1呼び出しあたりの秒数）
+    """
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - started) / number)
+    best = min(timings)
+    return {
+        'number':       number,
+        'repeat':       repeat,
+        'best_sec':     best,
+        'median_sec':   float(np.median(timings)),
+        'ops_per_sec':  1.0 / best if best > 0 else None,
+    }
+
+def bench_env_step(player, seed=None, length=100):
+    """
+    RockPaperScissorsEnv.step の計測対象関数を生成する。
+    """
+    env = RockPaperScissorsEnv(player, seed=seed, length=length)
+    env.reset()
+    return lambda: env.step(0)
+
+def bench_eval_env_step(seed=None):
+    """
+    EvalEnv.step の計測対象関数を生成する。
+    """
+    env = EvalEnv(ProbPlayer(), seed=seed)
+    env.reset()
+    return lambda: env.step(0)
+
+def bench_eval_env_render(mode, seed=None):
+    """
+    EvalEnv.render の計測対象関数を生成する。
+    """
+    env = EvalEnv(ProbPlayer(), seed=seed)
+    env.reset()
+    env.step(0)
+    return lambda: env.render(mode)
+
+def bench_update_observation(seed=None, length=100):
+    """
+    RockPaperScissorsEnv.update_observation の計測対象関数を生成する。
+    """
+    observation = RockPaperScissorsEnv.init_observation(
+        np.random.default_rng(seed), length)
+    return lambda: RockPaperScissorsEnv.update_observation(observation, 1, 2)
+
+def bench_player_predict(player, seed=None):
+    """
+    Player.predict の計測対象関数を生成する。
+    環境と同じく ObservationBuffer を渡し、呼び出し毎に乱数の手を1手ずつ追加するため、
+    キャッシュ使用時も同じ観測を繰り返し推論する場合のヒット率にはならない
+    （計測値には update_observation 1回分の時間を含む）。
+    """
+    rng = np.random.default_rng(seed)
+    observation = RockPaperScissorsEnv.init_observation(rng)
+    moves = rng.integers(0, 3, size=(STREAM_SIZE, 2)).tolist()
+    position = [0]
+    def fn():
+        policy_action, env_action = moves[position[0]]
+        position[0] = (position[0] + 1) % STREAM_SIZE
+        observation.push(policy_action, env_action)
+        return player.predict(observation)
+    return fn
+
+def bench_player_predict_batch(player, batch=256, seed=None):
+    """
+    Player.predict_batch の計測対象関数を生成する。
+    """
+    rng = np.random.default_rng(seed)
+    observations = rng.integers(0, 2, size=(batch, 100, 2), dtype=np.int8)
+    return lambda: player.predict_batch(observations)
+
+def bench_policy_predict(length, seed=None):
+    """
+    観測長lengthの観測を入力とする方策の推論（NumpyPolicy.predict）の
+    計測対象関数を生成する。重みは MlpPolicy と同じ形状の乱数。
+    """
+    rng = np.random.default_rng(seed)
+    sizes = [2 * length] + POLICY_LAYERS
+    weights = [rng.normal(scale=1.0 / np.sqrt(n_in), size=(n_out, n_in))
+        for n_in, n_out in zip(sizes[:-1], sizes[1:])]
+    biases = [np.zeros(n) for n in POLICY_LAYERS]
+    from numpy_policy import NumpyPolicy
+    policy = NumpyPolicy(weights, biases,
+        rng.normal(scale=0.01, size=(2, sizes[-1])), np.zeros(2),
+        observation_shape=(length, 2), seed=seed)
+    observation = RockPaperScissorsEnv.init_observation(rng, length).view()
+    return lambda: policy.predict(observation)
+
+def bench_ppo_predict(length, seed=None):
+    """
+    観測長lengthの環境で初期化した PPO の推論（PPO.predict）の
+    計測対象関数を生成する（stable_baselines3 が必要）。
+    """
+    from stable_baselines3 import PPO
+    env = RockPaperScissorsEnv(ProbPlayer(), seed=seed, length=length)
+    model = PPO('MlpPolicy', env, seed=seed, device='cpu')
+    observation = env.reset()
+    return lambda: model.predict(observation)
+
+def window_benchmarks(lengths, seed=None):
+    """
+    観測長毎の環境ステップ・方策推論のベンチマーク名と計測対象関数生成関数の
+    辞書を取得する。環境ステップは観測長によらず一定時間となることを、
+    方策推論（入力層が観測長に比例）は観測長に対する増え方を確認する。
+    stable_baselines3 がインストールされている場合は PPO の推論も計測する。
+    引数：
+        lengths     観測長のリスト
+        seed        乱数シード
+    戻り値：
+        {ベンチマーク名: 計測対象関数生成関数}
+    """
+    try:
+        import stable_baselines3
+        has_ppo = True
+    except ImportError:
+        has_ppo = False
+    suite = {}
+    for length in lengths:
+        prefix = f'window.{length}'
+        suite[f'{prefix}.env.step.ProbPlayer'] = lambda length=length: \
+            bench_env_step(ProbPlayer(), seed=seed, length=length)
+        suite[f'{prefix}.env.step.NGramPlayer'] = lambda length=length: \
+            bench_env_step(NGramPlayer(), seed=seed, length=length)
+        suite[f'{prefix}.update_observation'] = lambda length=length: \
+            bench_update_observation(seed=seed, length=length)
+        suite[f'{prefix}.policy.predict'] = lambda length=length: \
+            bench_policy_predict(length, seed=seed)
+        if has_ppo:
+            suite[f'{prefix}.ppo.predict'] = lambda length=length: \
+                bench_ppo_predict(length, seed=seed)
+    return suite
+
+def bench_server(path, action='goo'):
+    """
+    Flask テストクライアント経由の /pon/* リクエストの計測対象関数を生成する。
+    """
+    import server
+    server.PATH = path
+    server.BATCH_WAIT = 0.0
+    server.warm_up()
+    client = server.app.test_client()
+    client.get('/')
+    return lambda: client.post(f'/pon/{action}')
+
+def benchmarks(model_path=None, seed=None, windows=()):
+    """
+    ベンチマーク名と計測対象関数生成関数の辞書を取得する。
+    環境・プレイヤー・観測はすべて seed で初期化した乱数系列を使用する。
+    引数：
+        model_path  学習済みモデルパス（None の場合AIPlayer・サーバは計測しない）
+        seed        乱数シード
+        windows     観測長毎に計測する観測長のリスト（空の場合計測しない）
+    戻り値：
+        {ベンチマーク名: 計測対象関数生成関数}
+    """
+    players = {
+        'Player':       Player,
+        'ProbPlayer':   ProbPlayer,
+        'EnemyPlayer':  EnemyPlayer,
+        'JurinaPlayer': JurinaPlayer,
+    }
+    if model_path is not None:
+        from numpy_policy import load_model
+        model = load_model(model_path)
+        players['AIPlayer'] = lambda seed=None: AIPlayer(model, seed=seed)
+        players['AIPlayer.cached'] = \
+            lambda seed=None: AIPlayer(model, cache_size=65536, seed=seed)
+    suite = {
+        'env.step':             lambda: bench_env_step(ProbPlayer(), seed=seed),
+        'eval_env.step':        lambda: bench_eval_env_step(seed=seed),
+        'eval_env.render.ansi': lambda: bench_eval_env_render('ansi', seed=seed),
+        'eval_env.render.json': lambda: bench_eval_env_render('json', seed=seed),
+        'update_observation':   lambda: bench_update_observation(seed=seed),
+    }
+    for name, player_class in players.items():
+        suite[f'{name}.predict'] = lambda player_class=player_class: \
+            bench_player_predict(player_class(seed=seed), seed=seed)
+        suite[f'{name}.predict_batch.256'] = lambda player_class=player_class: \
+            bench_player_predict_batch(player_class(seed=seed), seed=seed)
+    if model_path is not None:
+        suite['server.pon'] = lambda: bench_server(model_path)
+    suite.update(window_benchmarks(windows, seed=seed))
+    return suite
+
+def git_commit():
+    """
+    現在のコミットIDを取得する（取得できない場合None）。
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(model_path=None, number=1000, repeat=5, warmup=100, seed=0, name_filter=None,
+        windows=()):
+    """
+    ベンチマークを実行する。各ベンチマークは同じ乱数シードで初期化した
+    環境・プレイヤーを使用する。
+    引数：
+        model_path  学習済みモデルパス
+        number      1回の計測で呼び出す回数
+        repeat      計測回数
+        warmup      計測前に呼び出す回数
+        seed        乱数シード
+        name_filter 名前にこの文字列を含むベンチマークのみ実行
+        windows     観測長毎に計測する観測長のリスト
+    戻り値：
+        結果辞書（meta, results）
+    """
+    results = {}
+    for name, setup in benchmarks(model_path, seed=seed, windows=windows).items():
+        if name_filter is not None and name_filter not in name:
+            continue
+        results[name] = measure(setup(), number=number, repeat=repeat, warmup=warmup)
+    return {
+        'meta': {
+            'commit':       git_commit(),
+            'python':       sys.version.split()[0],
+            'numpy':        np.__version__,
+            'platform':     platform.platform(),
+            'model_path':   model_path,
+            'seed':         seed,
+            'windows':      list(windows),
+        },
+        'results': results,
+    }
+
+# テスト
+
+def test_run():
+    result = run(number=10, repeat=2, warmup=1, name_filter='predict')
+    assert('ProbPlayer.predict' in result['results'])
+    assert('env.step' not in result['results'])
+    for value in result['results'].values():
+        assert(value['best_sec'] > 0.0)
+        assert(value['ops_per_sec'] > 0.0)
+
+def test_run_windows():
+    result = run(number=10, repeat=2, warmup=1, name_filter='window.',
+        windows=[10, 1000])
+    for length in [10, 1000]:
+        for name in ['env.step.ProbPlayer', 'env.step.NGramPlayer',
+                'update_observation', 'policy.predict']:
+            assert(result['results'][f'window.{length}.{name}']['best_sec'] > 0.0)
+    assert(result['meta']['windows'] == [10, 1000])
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    windows = [] if args['--windows'] is None else \
+        [int(length) for length in args['--windows'].split(',')]
+    result = run(model_path=args['--model_path'],
+        number=int(args['--number']), repeat=int(args['--repeat']),
+        warmup=int(args['--warmup']), seed=int(args['--seed']),
+        name_filter=args['--filter'], windows=windows)
+    text = json.dumps(result, indent=2)
+    if args['--output'] is None:
+        print(text)
+    else:
+        with open(args['--output'], 'w') as f:
+            f.write(text)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+学習途中のチェックポイントをバックグラウンドスレッドで書き出し、
+最新の指定件数のみ保持するモジュール。
+書き出すのは呼び出し時点の状態のコピーのため、書き込み中も学習を継続できる。
+ファイルは一時ファイルへ書き込んでから置き換えるため、書き込み途中で
+中断されても直前のチェックポイントは壊れない。
+"""
+import os
+import pickle
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+# チェックポイントファイル名の書式
+FILE_PATTERN = re.compile(r'^(?P<prefix>.+)_(?P<step>\d+)\.pkl$')
+
+def save_checkpoint(state, path):
+    """
+    チェックポイントをファイルへ書き出す。
+    一時ファイルへ書き込み、ディスクへ同期してから置き換える。
+    引数：
+        state   チェックポイント（pickle 可能なオブジェクト）
+        path    出力先パス
+    戻り値：
+        なし
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path):
+    """
+    チェックポイントをファイルから読み込む。
+    引数：
+        path    チェックポイントファイルパス
+    戻り値：
+        チェックポイント
+    """
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+class CheckpointWriter:
+    """
+    チェックポイントを1本のバックグラウンドスレッドで書き出すクラス。
+    前回の書き込みが終わっていない状態で次の書き込みを依頼した場合は
+    前回の完了を待つため、保持するコピーは最大1件となる。
+    """
+    def __init__(self, directory, prefix='checkpoint', keep=3):
+        """
+        引数：
+            directory   チェックポイントディレクトリ
+            prefix      ファイル名の接頭辞
+            keep        保持するチェックポイント数（0以下の場合すべて保持）
+        戻り値：
+            なし
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def path(self, step):
+        """
+        ステップ数に対応するチェックポイントファイルパスを取得する。
+        """
+        return os.path.join(self.directory, f'{self.prefix}_{step:012d}.pkl')
+
+    def checkpoints(self):
+        """
+        保存済みのチェックポイントを古い順に取得する。
+        引数：
+            なし
+        戻り値：
+            [(ステップ数, パス), ...]
+        """
+        found = []
+        for name in os.listdir(self.directory):
+            match = FILE_PATTERN.match(name)
+            if match is not None and match.group('prefix') == self.prefix:
+                found.append((int(match.group('step')), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    def latest(self):
+        """
+        最新のチェックポイントファイルパスを取得する（存在しない場合None）。
+        """
+        found = self.checkpoints()
+        return found[-1][1] if found else None
+
+    def submit(self, step, state):
+        """
+        チェックポイントの書き出しを依頼する。
+        state は書き出し完了まで変更しないこと（呼び出し側でコピーを渡す）。
+        引数：
+            step    ステップ数
+            state   チェックポイント
+        戻り値：
+            書き出したパスを返す Future
+        """
+        if self.pending is not None:
+            self.pending.result()
+        self.pending = self.executor.submit(self._write, step, state)
+        return self.pending
+
+    def _write(self, step, state):
+        """
+        チェックポイントを書き出し、保持数を超えた古いものを削除する。
+        """
+        path = self.path(step)
+        save_checkpoint(state, path)
+        if self.keep > 0:
+            for _, old in self.checkpoints()[:-self.keep]:
+                os.remove(old)
+        return path
+
+    def close(self):
+        """
+        書き込み中のチェックポイントの完了を待ち、スレッドを終了する。
+        """
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+        self.executor.shutdown()
+
+# テスト
+
+def test_checkpoint_writer():
+    import tempfile
+    import numpy as np
+    with tempfile.TemporaryDirectory() as dirname:
+        writer = CheckpointWriter(dirname, prefix='prob_ppo', keep=2)
+        assert(writer.latest() is None)
+        for step in [100, 200, 300]:
+            state = {'num_timesteps': step, 'weights': np.full(4, step)}
+            future = writer.submit(step, state)
+        assert(future.result() == writer.path(300))
+        writer.close()
+        assert([step for step, _ in writer.checkpoints()] == [200, 300])
+        state = load_checkpoint(writer.latest())
+        assert(state['num_timesteps'] == 300 and (state['weights'] == 300).all())
+        # 接頭辞の異なるファイル・書き込み途中の一時ファイルは対象外
+        open(os.path.join(dirname, 'prob_ppo_000000000400.pkl.tmp'), 'w').close()
+        open(os.path.join(dirname, 'pa_ppo_000000000500.pkl'), 'w').close()
+        assert(CheckpointWriter(dirname, prefix='prob_ppo').latest() == writer.path(300))
+
+if __name__ == '__main__':
+    test_checkpoint_writer()
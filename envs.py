@@ -2,17 +2,199 @@
 """
 じゃんけん対戦するOpenAI Gym 環境クラスを提供するモジュール
 """
-import random
 import numpy as np
 import gym
 from gym import spaces
 
+# 報酬表：REWARD_TABLE[方策側行動, 環境側行動]（0=グー、1=パー、2=チョキ）
+REWARD_TABLE = np.array([
+    [ -1, -10,  10],    # 方策側：グー
+    [ 10,  -1, -10],    # 方策側：パー
+    [-10,  10,  -1],    # 方策側：チョキ
+], dtype=np.float32)
+
+# 各手に勝つ手：COUNTER_ACTIONS[相手の行動]（0=グー、1=パー、2=チョキ）
+COUNTER_ACTIONS = np.array([1, 2, 0], dtype=np.int64)
+
+# 観測長（観測として保持する過去の対戦数）の既定値
+OBSERVATION_LENGTH = 100
+
+# 観測ハッシュ：[方策側行動×3 + 環境側行動] を古い順に並べた 2^64 を法とする多項式ハッシュ
+HASH_BASE = 0x100000001B3
+HASH_MASK = (1 << 64) - 1
+# 観測長毎の各位置の重み（古い順に HASH_BASE^(length-1), ..., 1）
+_hash_weights = {}
+
+def _get_hash_weights(length):
+    """
+    観測長に対応する各位置の重みを取得する。
+    """
+    weights = _hash_weights.get(length)
+    if weights is None:
+        weights = np.full(length, HASH_BASE, dtype=np.uint64)
+        weights[-1] = 1
+        # uint64 の積は 2^64 を法として循環する
+        weights = np.cumprod(weights[::-1])[::-1].copy()
+        _hash_weights[length] = weights
+    return weights
+
+def observation_hash(observation):
+    """
+    観測全体からハッシュ値を算出する。
+    ObservationBuffer.hash_value と同じ値となる。
+    引数：
+        observation     観測 (length, 2)
+    戻り値：
+        ハッシュ値（64ビット整数）
+    """
+    return int(observation_hashes(np.asarray(observation)[np.newaxis])[0])
+
+def observation_hashes(observations):
+    """
+    複数の観測それぞれのハッシュ値をまとめて算出する。
+    引数：
+        observations    観測の配列 (N, length, 2)
+    戻り値：
+        ハッシュ値の配列 (N,) uint64
+    """
+    values = np.asarray(observations)
+    weights = _get_hash_weights(values.shape[1])
+    codes = values[:, :, 0].astype(np.uint64) * np.uint64(3) \
+        + values[:, :, 1].astype(np.uint64)
+    return (codes * weights).sum(axis=1, dtype=np.uint64)
+
+# Player.predict() がまとめて抽選しておく行動数
+RANDOM_BLOCK_SIZE = 1024
+
+def spawn_seeds(seed, n):
+    """
+    シードから互いに独立した子シードを生成する。
+    並列ワーカーや環境・プレイヤー毎の乱数系列を分けるために使用する。
+    引数：
+        seed    整数シード、SeedSequence または None（None の場合OSの乱数から生成）
+        n       生成する子シード数
+    戻り値：
+        SeedSequence のリスト
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.spawn(n)
+
+class ObservationBuffer:
+    """
+    観測（過去N件分の[方策側行動, 環境側行動]）を保持する
+    リングバッファクラス。
+    長さ2Nのint8配列に同じ値を2か所書き込むことで、
+    ステップ毎の追加をO(1)・メモリ確保なしで行いつつ、
+    古い順に並んだ連続領域のビューを返却できる。
+    観測のハッシュ値（observation_hash()と同値）も追加毎にO(1)で更新する。
+    """
+    def __init__(self, length=OBSERVATION_LENGTH, observation=None, rounds=0):
+        """
+        バッファを確保し、観測が指定された場合はその値で初期化する。
+        引数：
+            length          観測長
+            observation     初期値となる観測（[[方策側行動, 環境側行動], ...]）
+            rounds          それまでに追加した手の数
+        戻り値：
+            なし
+        """
+        self.length = length
+        # 同じ内容を前半・後半に持つ 2N×2 の配列
+        self.buffer = np.zeros((2 * length, 2), dtype=np.int8)
+        # 最古の要素の位置
+        self.head = 0
+        # 観測のハッシュ値と、最古の手のハッシュ値への重み
+        self.hash_value = 0
+        self.oldest_weight = pow(HASH_BASE, length - 1, HASH_MASK + 1)
+        # push() した回数（サーバではセッション内の対戦の通し番号として記録する）
+        self.rounds = rounds
+        if observation is not None:
+            self.load(observation)
+
+    def load(self, observation):
+        """
+        観測全体を上書きする。
+        引数：
+            observation     観測（古い順、長さはlengthと一致すること）
+        戻り値：
+            なし
+        """
+        values = np.asarray(observation, dtype=np.int8)
+        if values.shape != (self.length, 2):
+            raise ValueError(
+                f'observation shape={values.shape}: expected ({self.length}, 2)')
+        self.buffer[:self.length] = values
+        self.buffer[self.length:] = values
+        self.head = 0
+        self.hash_value = observation_hash(values)
+
+    def push(self, policy_action, env_action):
+        """
+        最古の両者の手を最新の両者の手で上書きする。
+        引数：
+            policy_action       方策側の行動
+            env_action          環境側の行動
+        戻り値：
+            なし
+        """
+        head = self.head
+        oldest = int(self.buffer[head, 0]) * 3 + int(self.buffer[head, 1])
+        self.hash_value = ((self.hash_value - oldest * self.oldest_weight) * HASH_BASE
+            + int(policy_action) * 3 + int(env_action)) & HASH_MASK
+        self.buffer[head, 0] = policy_action
+        self.buffer[head, 1] = env_action
+        self.buffer[head + self.length, 0] = policy_action
+        self.buffer[head + self.length, 1] = env_action
+        self.head = head + 1 if head + 1 < self.length else 0
+        self.rounds += 1
+
+    def view(self):
+        """
+        古い順に並んだ観測を連続領域のビューとして取得する。
+        次のpush()で内容が変わるため、保持する場合はコピーすること。
+        引数：
+            なし
+        戻り値：
+            観測 (length, 2) int8 配列ビュー
+        """
+        return self.buffer[self.head:self.head + self.length]
+
+    def tolist(self):
+        """
+        観測をリスト形式で取得する（JSONシリアライズ用）。
+        引数：
+            なし
+        戻り値：
+            観測 [ 自分の行動, 敵の行動 ]×length
+        """
+        return self.view().tolist()
+
+    @property
+    def shape(self):
+        """
+        観測の形状。
+        """
+        return (self.length, 2)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.view()
+        if dtype is not None:
+            return array.astype(dtype)
+        return array.copy() if copy else array
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return self.view()[index]
+
 class RockPaperScissorsEnv(gym.Env):
     """
     OpenAI Gym 準拠のじゃんけん対戦環境クラス。
     必要最小限の実装のみ。
     """
-    def __init__(self, player):
+    def __init__(self, player, seed=None, length=OBSERVATION_LENGTH):
         """
         方策側の相手となる環境側プレイヤーを
         インスタンス変数へ格納し、
@@ -20,18 +202,40 @@ class RockPaperScissorsEnv(gym.Env):
         観測の初期化を行う。
         引数：
             player  環境側プレイヤーインスタンス
+            seed    乱数シード（指定した場合は環境側プレイヤーも子シードで初期化する）
+            length  観測長（保持する過去の対戦数）
         戻り値：
             なし
         """
         super().__init__()
         self.player = player
+        self.length = length
+        env_seed, player_seed = spawn_seeds(seed, 2)
+        self.rng = np.random.default_rng(env_seed)
+        if seed is not None and hasattr(player, 'seed'):
+            player.seed(player_seed)
         # 行動空間：0=グー、1=パー、2=チョキ
         self.action_space = spaces.Discrete(2)
-        # 観測空間：過去100件分の[方策側行動, 環境側行動]
+        # 観測空間：過去length件分の[方策側行動, 環境側行動]
         self.observation_space = spaces.Box(
-            low=0, high=2, shape=(100, 2), dtype=np.int8)
+            low=0, high=2, shape=(length, 2), dtype=np.int8)
         # 観測初期化
-        self.observation = self.init_observation()
+        self.observation = self.init_observation(self.rng, length)
+
+    def seed(self, seed=None):
+        """
+        環境と環境側プレイヤーの乱数系列を初期化し、観測を初期化し直す。
+        引数：
+            seed    乱数シード
+        戻り値：
+            [seed]
+        """
+        env_seed, player_seed = spawn_seeds(seed, 2)
+        self.rng = np.random.default_rng(env_seed)
+        if hasattr(self.player, 'seed'):
+            self.player.seed(player_seed)
+        self.observation = self.init_observation(self.rng, self.length)
+        return [seed]
 
     def reset(self):
         """
@@ -40,9 +244,9 @@ class RockPaperScissorsEnv(gym.Env):
         引数：
             なし
         戻り値：
-            観測 [ 自分の行動, 敵の行動 ]×100
+            観測 [ 自分の行動, 敵の行動 ]×length
         """
-        return self.observation
+        return self.observation.view()
 
     def step(self, action):
         """
@@ -57,45 +261,43 @@ class RockPaperScissorsEnv(gym.Env):
             info        その他情報（空の辞書）
         """
         policy_action = int(action)
+        # ObservationBuffer のまま渡し、保持するハッシュ値をキャッシュで使えるようにする
         env_action = int(self.player.predict(self.observation))
         self.observation = self.update_observation(
             self.observation, policy_action, env_action)
         reward = self.calc_reward(policy_action, env_action)
         done = self.is_done(policy_action, env_action)
-        return self.observation, reward, done, {}
+        return self.observation.view(), reward, done, {}
 
     @staticmethod
-    def init_observation():
+    def init_observation(rng=None, length=OBSERVATION_LENGTH):
         """
         エピソード開始時の観測を取得する。
         引数：
-            なし
+            rng     観測の初期化に使用する Generator（None の場合新規に生成）
+            length  観測長
         戻り値：
-            observation 観測（初期値）
+            observation 観測（初期値、ObservationBuffer）
         """
-        # 観測初期化
-        observation = []
-        for _ in range(100):
-            #　乱数で初期化
-            observation.append([
-                random.randrange(2), 
-                random.randrange(2)])
-        return observation
+        if rng is None:
+            rng = np.random.default_rng()
+        #　乱数で初期化
+        observation = rng.integers(0, 2, size=(length, 2), dtype=np.int8)
+        return ObservationBuffer(length=length, observation=observation)
 
     @staticmethod
     def update_observation(observation, policy_action, env_action):
         """
-        観測の先頭（最古の両者の手）を削除し、末尾に最新の両者の手を追加して
-        返却する。
+        観測の先頭（最古の両者の手）を最新の両者の手で上書きして
+        返却する（メモリ確保なしのインプレース更新）。
         引数：
-            observation         更新対象となる観測
+            observation         更新対象となる観測（ObservationBuffer）
             policy_action       方策側の行動
             env_action          環境側の行動
         戻り値：
             observation         更新後の観測
         """
-        observation.pop(0)
-        observation.append([policy_action, env_action])
+        observation.push(policy_action, env_action)
         return observation
 
     @staticmethod
@@ -149,15 +351,19 @@ class EvalEnv(RockPaperScissorsEnv):
     """
     # render モード
     metadata = {'render.modes': ['console', 'ansi', 'json']}
-    def __init__(self, player):
+    def __init__(self, player, recorder=None, seed=None, length=OBSERVATION_LENGTH):
         """
         インスタンス変数infoを初期化する。
         引数：
-            player  環境側プレイヤーインスタンス
+            player      環境側プレイヤーインスタンス
+            recorder    対戦履歴を書き込む TrajectoryWriter（None の場合記録しない）
+            seed        乱数シード
+            length      観測長
         戻り値：
             なし
         """
-        super().__init__(player)
+        super().__init__(player, seed=seed, length=length)
+        self.recorder = recorder
         self.info = {
             'env_id':       'RockPaperScissors-v0',         # env id
             'enemy_player': self.player.__class__.__name__, # 対戦オブジェクトクラス名
@@ -173,7 +379,7 @@ class EvalEnv(RockPaperScissorsEnv):
         引数：
             なし
         戻り値：
-            観測 [ 自分の行動, 敵の行動 ]×100
+            観測 [ 自分の行動, 敵の行動 ]×length
         """
         self.info['episode_no'] = self.info['episode_no'] + 1
         self.info['step_no'] = -1.0
@@ -196,6 +402,9 @@ class EvalEnv(RockPaperScissorsEnv):
         observation, reward, done, _ = super().step(action)
         self.info['step_no'] = self.info.get('step_no', -1) + 1
         self.info['total_reward'] = self.info['total_reward'] + reward 
+        if self.recorder is not None:
+            self.recorder.write(self.info['episode_no'], int(self.info['step_no']),
+                observation[-1, 0], observation[-1, 1], reward)
         return observation, reward, done, self.info
 
     def render(self, mode='console'):
@@ -219,13 +428,15 @@ class EvalEnv(RockPaperScissorsEnv):
         elif mode == 'ansi':
             return msg
         elif mode == 'json':
+            policy_action = int(self.observation[-1][0])
+            env_action = int(self.observation[-1][1])
             return {
                 'episode_no':       self.info['episode_no'],
                 'step_no':          self.info['step_no'],
-                'policy_action':    self.observation[-1][0],
-                'env_action':       self.observation[-1][1],
-                'done':             self.is_done(self.observation[-1][0], self.observation[-1][1]),
-                'reward':           self.calc_reward(self.observation[-1][0], self.observation[-1][1]),
+                'policy_action':    policy_action,
+                'env_action':       env_action,
+                'done':             self.is_done(policy_action, env_action),
+                'reward':           self.calc_reward(policy_action, env_action),
                 'total_reward':     self.info['total_reward'],
             }
         else:
@@ -234,80 +445,158 @@ class EvalEnv(RockPaperScissorsEnv):
 class Player:
     """
     プレイヤー基底クラス。
+    乱数はインスタンス毎の Generator(rng) から抽選する。
+    predict() は RANDOM_BLOCK_SIZE 件の行動を sample() でまとめて抽選しておき、
+    1件ずつ払い出す。
     """
+    def __init__(self, seed=None):
+        """
+        乱数系列を初期化する。
+        引数：
+            seed    乱数シード（None の場合OSの乱数から生成）
+        戻り値：
+            なし
+        """
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        """
+        乱数系列を初期化し直し、抽選済みの行動を破棄する。
+        引数：
+            seed    乱数シード（整数、SeedSequence または None）
+        戻り値：
+            なし
+        """
+        self.rng = np.random.default_rng(seed)
+        # 抽選済みの未使用の行動（末尾から払い出す）
+        self.actions = []
+
+    def get_state(self):
+        """
+        乱数系列の状態を取得する（学習再開用）。
+        引数：
+            なし
+        戻り値：
+            状態辞書
+        """
+        return {'rng': self.rng.bit_generator.state, 'actions': list(self.actions)}
+
+    def set_state(self, state):
+        """
+        get_state() で取得した乱数系列の状態を復元する。
+        引数：
+            state   状態辞書
+        戻り値：
+            なし
+        """
+        self.rng.bit_generator.state = state['rng']
+        self.actions = list(state['actions'])
+
+    def sample(self, size):
+        """
+        観測によらない行動をまとめて抽選する。
+        本実装ではグー・パーのいずれかをランダムに選択する。
+        引数：
+            size    抽選する行動数
+        戻り値：
+            行動の配列 (size,)
+        """
+        return self.rng.integers(2, size=size)
+
     def predict(self, observation):
         """
         引数observationをもとに次の行動を選択する。
-        本実装ではobservationを一切使用せずに、ランダムに行動を選択する。
+        本実装ではobservationを一切使用せずに、
+        まとめて抽選済みの行動を1件払い出す。
         引数：
             observation     観測（使用しない）
         戻り値：
             ランダムに選択された行動
         """
-        return random.randrange(2)
+        try:
+            return self.actions.pop()
+        except IndexError:
+            self.actions = self.sample(RANDOM_BLOCK_SIZE).tolist()
+            return self.actions.pop()
+
+    def predict_batch(self, observations):
+        """
+        複数の観測それぞれに対する次の行動を選択する。
+        観測ごとにpredict()を呼び出す。predict() が観測を使用しない
+        本実装のままの場合（ProbPlayer 等）は sample() でまとめて抽選する。
+        引数：
+            observations    観測の配列 (N, L, 2)
+        戻り値：
+            選択された行動の配列 (N,)
+        """
+        if type(self).predict is Player.predict:
+            return self.sample(len(observations))
+        return np.array([self.predict(observation) for observation in observations],
+            dtype=np.int64)
 
 class ProbPlayer(Player):
     """
     コンストラクタで渡された各手の確率に従ってランダムに手を出す
     プレイヤークラス。
     """
-    def __init__(self, prob_list=[0.333, 0.333, 0.334]):
+    def __init__(self, prob_list=[0.333, 0.333, 0.334], seed=None):
         """
         各手の確率リストをインスタンス変数へ格納する。
         引数：
             prob_list   各手の確率
+            seed        乱数シード
         戻り値：
             なし
         """
+        super().__init__(seed)
         self.prob_list = [
             float(prob_list[0])/float(sum(prob_list)),
             float(prob_list[1])/float(sum(prob_list)),
             float(prob_list[2])/float(sum(prob_list)),
         ]
-        
-    def predict(self, observation):
+        # 一括抽選用の累積確率
+        self.cum_probs = np.cumsum(self.prob_list)
+
+    def sample(self, size):
         """
-        引数observationをもとに次の行動を選択する。
-        本実装ではobservationを一切使用せずに、
-        各手の確率に従ってランダムに行動を選択する。
+        各手の確率に従って行動をまとめて抽選する。
+        累積確率に対する一括抽選を行う。
         引数：
-            observation     観測（使用しない）
+            size    抽選する行動数
         戻り値：
-            各手の確率に従ってランダムに選択された行動
+            各手の確率に従ってランダムに選択された行動の配列 (size,)
         """
-        value = random.uniform(0.0, 1.0)
-        if value <= self.prob_list[0]:
-            return 0    # グー
-        elif value <= (self.prob_list[0] + self.prob_list[1]):
-            return 1    # パー
-        else:
-            return 2    # チョキ
+        values = self.rng.random(size)
+        actions = np.searchsorted(self.cum_probs, values, side='left')
+        return np.minimum(actions, 2)
 
 class EnemyPlayer(ProbPlayer):
     """
     1/3の確率でグー・パー・チョキを選択するプレイヤー。
     """
-    def __init__(self):
+    def __init__(self, seed=None):
         """
         prob_list の要素がすべて1/3として親クラスの
         コンストラクタを呼び出す。
         引数：
-            なし
+            seed    乱数シード
         戻り値：
             なし
         """
-        super().__init__(prob_list=[1.0/3.0, 1.0/3.0, 1.0/3.0])
+        super().__init__(prob_list=[1.0/3.0, 1.0/3.0, 1.0/3.0], seed=seed)
 
 class JurinaPlayer(Player):
     """
     常に同じ手を出すプレイヤー。
     """
-    def __init__(self, action=1):
+    def __init__(self, action=1, seed=None):
         """
         常に出す手をインスタンス変数へ格納する。
         引数：
             action      常に出す手（デフォルト：パー）
+            seed        乱数シード（使用しない）
         """
+        super().__init__(seed)
         self.action = action
 
     def predict(self, observstion):
@@ -322,32 +611,213 @@ class JurinaPlayer(Player):
         """
         return self.action
 
+    def predict_batch(self, observations):
+        """
+        複数の観測それぞれに対する次の行動をまとめて選択する。
+        引数：
+            observations    観測の配列（使用しない）
+        戻り値：
+            コンストラクタで指定された行動で埋めた配列 (N,)
+        """
+        return np.full(len(observations), self.action, dtype=np.int64)
+
+class NGramPlayer(Player):
+    """
+    観測内の相手の手の並びをn-gramとして数え、直前order手に続く相手の手を
+    予測して、それに勝つ手を出すプレイヤー。
+    n-gramの出現数は観測が1手ずれる毎に、入ってきた手・出ていった手の分だけ
+    増減させるため、1ステップの出現数の更新量は観測長によらない。
+    前回の観測の相手の手を保持し、観測が前回の観測をちょうど1手ずらしたもので
+    ない場合（初回・別の対戦の観測・同じ観測の再入力など）は出現数を数え直す。
+    """
+    def __init__(self, order=2, seed=None):
+        """
+        n-gramの次数を格納する。
+        引数：
+            order   予測に使用する直前の相手の手数
+            seed    乱数シード（使用しない）
+        戻り値：
+            なし
+        """
+        super().__init__(seed)
+        self.order = order
+        self.num_contexts = 3 ** order
+        self.reset()
+
+    def seed(self, seed=None):
+        """
+        乱数系列を初期化し直し、n-gramの出現数を破棄する
+        （環境の seed() で観測が初期化し直されるため）。
+        引数：
+            seed    乱数シード
+        戻り値：
+            なし
+        """
+        super().seed(seed)
+        self.reset()
+
+    def reset(self):
+        """
+        n-gramの出現数を破棄する。次回の予測時に数え直す。
+        """
+        # 出現数 (N, 3^order, 3)：[対戦, 直前order手, 次の手]
+        self.counts = None
+        # 前回観測の相手の手 (N, L)
+        self.moves = None
+
+    def _context_codes(self, moves):
+        """
+        相手の手の並び (..., order) を3進数の文脈番号へ変換する。
+        """
+        codes = np.zeros(moves.shape[:-1], dtype=np.int64)
+        for j in range(self.order):
+            codes = codes * 3 + moves[..., j]
+        return codes
+
+    def _count(self, moves):
+        """
+        相手の手の並び (n, L) に含まれるn-gramを数える。
+        """
+        n, length = moves.shape
+        k = self.order
+        codes = np.zeros((n, length - k), dtype=np.int64)
+        for j in range(k):
+            codes = codes * 3 + moves[:, j:length - k + j]
+        index = (np.arange(n)[:, np.newaxis] * self.num_contexts + codes) * 3 \
+            + moves[:, k:]
+        return np.bincount(index.ravel(), minlength=n * self.num_contexts * 3) \
+            .reshape(n, self.num_contexts, 3).astype(np.int32)
+
+    def _update(self, observations):
+        """
+        観測 (N, L, 2) にあわせてn-gramの出現数を更新する。
+        1手ずれたことの確認は観測全体の比較で行うが、数え直す場合を除き
+        出現数の更新は先頭・末尾のorder+1手のみで行う。
+        引数：
+            observations    観測の配列 (N, L, 2)
+        戻り値：
+            観測末尾のorder+1手の相手の手 (N, order+1)
+        """
+        k = self.order
+        moves = observations[:, :, 0].astype(np.int8)
+        tail = moves[:, -k - 1:].astype(np.int64)
+        if self.counts is None or self.moves.shape != moves.shape:
+            self.counts = self._count(moves.astype(np.int64))
+        else:
+            # 前回の観測をちょうど1手ずらした観測かどうかを確認する
+            # （先頭・末尾のみの比較では、同じ手が続く観測を取り違える）
+            shifted = (moves[:, :-1] == self.moves[:, 1:]).all(axis=1)
+            rows = np.flatnonzero(shifted)
+            head = self.moves[rows, :k + 1].astype(np.int64)
+            # 出ていったn-gramを減らし、入ってきたn-gramを増やす
+            np.subtract.at(self.counts, (rows,
+                self._context_codes(head[:, :k]), head[:, k]), 1)
+            np.add.at(self.counts, (rows,
+                self._context_codes(tail[rows, :k]), tail[rows, k]), 1)
+            rows = np.flatnonzero(~shifted)
+            if len(rows) > 0:
+                self.counts[rows] = self._count(moves[rows].astype(np.int64))
+        self.moves = moves
+        return tail
+
+    def predict(self, observation):
+        """
+        引数observationをもとに次の行動を選択する。
+        引数：
+            observation     観測 [ 相手の行動, 自分の行動 ]×L
+        戻り値：
+            予測した相手の次の手に勝つ行動
+        """
+        return int(self.predict_batch(np.asarray(observation)[np.newaxis])[0])
+
+    def predict_batch(self, observations):
+        """
+        複数の観測それぞれに対する次の行動をまとめて選択する。
+        直前order手の文脈で最も多く出現した相手の次の手を予測し、
+        その文脈が未出現の場合は観測内で最も多い相手の手を予測とする。
+        引数：
+            observations    観測の配列 (N, L, 2)
+        戻り値：
+            予測した相手の次の手に勝つ行動の配列 (N,)
+        """
+        tail = self._update(np.asarray(observations))
+        contexts = self._context_codes(tail[:, 1:])
+        counts = self.counts[np.arange(len(tail)), contexts]
+        unseen = counts.sum(axis=1) == 0
+        if unseen.any():
+            counts[unseen] = self.counts[unseen].sum(axis=1)
+        return COUNTER_ACTIONS[counts.argmax(axis=1)]
+
 class AIPlayer(Player):
     """
     学習済みモデルを使って行動を決めるプレイヤー。
     学習済みモデルと対戦評価する際に使用する。
     """
-    def __init__(self, model):
+    def __init__(self, model, cache_size=0, seed=None):
         """
         学習済みモデルをコンストラクタに指定する。
         引数：
             model       学習済みモデルクラスのインスタンス
+            cache_size  観測毎の行動選択確率をキャッシュする件数（0:キャッシュしない）
+            seed        キャッシュした確率からの抽選に使用する乱数シード
         戻り値：
             なし
         """
         self.model = model
+        self.cache = None
+        if cache_size > 0:
+            from prediction_cache import PredictionCache
+            self.cache = PredictionCache(cache_size)
+        super().__init__(seed)
+
+    def seed(self, seed=None):
+        """
+        乱数系列を初期化し直す。キャッシュ使用時はキャッシュの抽選にも使用する。
+        引数：
+            seed    乱数シード
+        戻り値：
+            なし
+        """
+        super().seed(seed)
+        if self.cache is not None:
+            self.cache.rng = self.rng
     
     def predict(self, observation):
         """
         引数observationをもとに次の行動を選択する。
         本実装では学習済みモデルクラスのpredictメソッドを使って
-        行動を選択する。
+        行動を選択する。キャッシュ使用時は観測のハッシュ値をキーとして
+        キャッシュした行動選択確率に従って抽選する。
         引数：
-            observation     観測
+            observation     観測（ndarray または ObservationBuffer）
         戻り値：
             学習済みモデルが選択した行動
         """
-        return int(self.model.predict(observation)[0])
+        if self.cache is not None:
+            return self.cache.predict(observation, self.model)
+        return int(self.model.predict(np.asarray(observation))[0])
+
+    def predict_batch(self, observations):
+        """
+        複数の観測それぞれに対する次の行動をまとめて選択する。
+        本実装では学習済みモデルの順伝播を1回だけ実行する。
+        キャッシュ使用時はキャッシュに存在しない観測のみ順伝播する。
+        モデルが選択確率を算出できる場合(action_probs)は、プレイヤーの
+        乱数系列で抽選するため、seed() で結果を再現できる。
+        引数：
+            observations    観測の配列 (N, L, 2)
+        戻り値：
+            学習済みモデルが選択した行動の配列 (N,)
+        """
+        if self.cache is not None:
+            return self.cache.predict_batch(observations, self.model)
+        observations = np.asarray(observations)
+        if hasattr(self.model, 'action_probs'):
+            cum_probs = np.cumsum(self.model.action_probs(observations), axis=1)
+            values = self.rng.random((len(observations), 1))
+            return (values > cum_probs[:, :-1]).sum(axis=1)
+        actions, _ = self.model.predict(observations)
+        return np.asarray(actions, dtype=np.int64).reshape(-1)
 
 # テスト
 
@@ -391,6 +861,12 @@ def test_calc_reward():
     assert(env.calc_reward(2, 0)==-10)
     assert(env.calc_reward(2, 1)==10)
 
+def test_reward_table():
+    for policy_action in range(3):
+        for env_action in range(3):
+            assert(REWARD_TABLE[policy_action, env_action] == \
+                RockPaperScissorsEnv.calc_reward(policy_action, env_action))
+
 def test_player():
     player = Player()
     prob_player = ProbPlayer(prob_list=[1, 7, 2])
@@ -402,14 +878,129 @@ def test_player():
         assert(prob_player_pa.predict(None)==1)
         assert(jurina_player.predict(None)==1)
 
+def test_player_batch():
+    observations = np.zeros((1000, 100, 2), dtype=np.int8)
+    actions = Player().predict_batch(observations)
+    assert(actions.shape == (1000,))
+    assert(np.isin(actions, [0, 1, 2]).all())
+    actions = ProbPlayer(prob_list=[1, 7, 2]).predict_batch(observations)
+    assert(np.isin(actions, [0, 1, 2]).all())
+    assert((np.bincount(actions, minlength=3) > 0).all())
+    assert((ProbPlayer(prob_list=[0.0, 1.0, 0.0]).predict_batch(observations) == 1).all())
+    assert((ProbPlayer(prob_list=[0.0, 0.0, 1.0]).predict_batch(observations) == 2).all())
+    assert((JurinaPlayer(action=2).predict_batch(observations) == 2).all())
+    # predict() のみ実装したプレイヤーは観測ごとの predict() の結果を返す
+    class _CopyPlayer(Player):
+        def predict(self, observation):
+            return int(observation[-1][0])
+    observations[:, -1, 0] = np.arange(1000) % 3
+    assert((_CopyPlayer().predict_batch(observations) == np.arange(1000) % 3).all())
+
+def test_ngram_player():
+    player = NGramPlayer(order=2)
+    buffer = ObservationBuffer(length=10, observation=[[i % 3, 0] for i in range(10)])
+    # 相手は グー→パー→チョキ の繰り返し：直前 [パー(1), グー(0)] の次はパー(1)
+    for i in range(30):
+        assert(player.predict(buffer.view()) == COUNTER_ACTIONS[(i + 10) % 3])
+        buffer.push((i + 10) % 3, 0)
+    # 増分更新後の出現数は数え直した結果と一致する
+    player.predict(buffer.view())
+    moves = buffer.view()[np.newaxis, :, 0].astype(np.int64)
+    assert((player.counts == player._count(moves)).all())
+    # 1手ずれていない観測（同じ観測の再入力）では出現数を増減させない
+    player = NGramPlayer(order=2)
+    same = np.zeros((1, 10, 2), dtype=np.int8)
+    same[0, :, 0] = [0, 0, 0, 2, 1, 2, 0, 1, 1, 1]
+    for _ in range(7):
+        player.predict_batch(same)
+    assert((player.counts == player._count(same[:, :, 0].astype(np.int64))).all())
+    # 別の対戦の観測が渡された場合は数え直す
+    other = np.zeros((1, 10, 2), dtype=np.int8)
+    assert(player.predict_batch(other)[0] == COUNTER_ACTIONS[0])
+    observations = np.random.randint(0, 3, size=(50, 100, 2))
+    batch_player = NGramPlayer(order=3)
+    for _ in range(20):
+        batch_player.predict_batch(observations)
+        observations = np.concatenate(
+            [observations[:, 1:], np.random.randint(0, 3, size=(50, 1, 2))], axis=1)
+    batch_player.predict_batch(observations)
+    assert((batch_player.counts == batch_player._count(observations[:, :, 0])).all())
+
 def test_reset():
     env = RockPaperScissorsEnv(ProbPlayer())
     for _ in range(100):
-        assert(env.reset() == env.observation)
+        assert((env.reset() == env.observation.view()).all())
+
+def test_observation_buffer():
+    buffer = ObservationBuffer(length=3, observation=[[0, 1], [1, 0], [2, 2]])
+    assert(buffer.view().dtype == np.int8)
+    assert(buffer.view().flags['C_CONTIGUOUS'])
+    data = buffer.buffer
+    for i in range(5):
+        buffer.push(i % 3, (i + 1) % 3)
+        assert(buffer.buffer is data)
+    assert(buffer.tolist() == [[2, 0], [0, 1], [1, 2]])
+    assert(buffer.rounds == 5)
+    assert(np.asarray(buffer).shape == (3, 2))
+    assert(buffer.hash_value == observation_hash(buffer.view()))
+    buffer.load([[2, 2], [2, 2], [2, 2]])
+    for i in range(7):
+        buffer.push(2 - i % 3, i % 2)
+        assert(buffer.hash_value == observation_hash(buffer.view()))
+    assert(observation_hash([[2, 2]] * 3) != observation_hash([[2, 1]] * 3))
+
+def test_seed():
+    observations = np.zeros((10, 100, 2), dtype=np.int8)
+    first, second = ProbPlayer(seed=1), ProbPlayer(seed=1)
+    assert([first.predict(None) for _ in range(3000)] ==
+        [second.predict(None) for _ in range(3000)])
+    assert((first.predict_batch(observations) == second.predict_batch(observations)).all())
+    # 子シードは互いに異なる系列となる
+    players = [Player(seed=s) for s in spawn_seeds(1, 2)]
+    assert([players[0].predict(None) for _ in range(100)] !=
+        [players[1].predict(None) for _ in range(100)])
+    envs = [RockPaperScissorsEnv(ProbPlayer(), seed=7) for _ in range(2)]
+    assert((envs[0].reset() == envs[1].reset()).all())
+    assert([envs[0].step(0)[1] for _ in range(100)] == [envs[1].step(0)[1] for _ in range(100)])
+    assert(envs[0].seed(8) == [8])
+    envs[1].seed(8)
+    assert((envs[0].reset() == envs[1].reset()).all())
+    # 乱数系列の状態を復元すると同じ続きの系列となる
+    player = ProbPlayer()
+    player.predict(None)
+    state = player.get_state()
+    expected = [player.predict(None) for _ in range(2000)]
+    other = ProbPlayer()
+    other.set_state(state)
+    assert([other.predict(None) for _ in range(2000)] == expected)
+
+def test_observation_length():
+    for length in [10, 1000]:
+        env = EvalEnv(NGramPlayer(order=2), seed=3, length=length)
+        assert(env.observation_space.shape == (length, 2))
+        assert(env.reset().shape == (length, 2))
+        for i in range(50):
+            observation, _, _, _ = env.step(i % 3)
+        assert(observation.shape == (length, 2))
+        assert(observation[-1, 0] == 49 % 3)
+        env.seed(4)
+        assert(env.reset().shape == (length, 2))
+        # 観測長によらず増分更新後の出現数は数え直した結果と一致する
+        for i in range(5):
+            env.step(i % 3)
+        env.player.predict(env.observation.view())
+        moves = env.observation.view()[np.newaxis, :, 0].astype(np.int64)
+        assert((env.player.counts == env.player._count(moves)).all())
 
 if __name__ == '__main__':
     test_observation()
     test_is_done()
     test_calc_reward()
+    test_reward_table()
     test_player()
+    test_player_batch()
+    test_ngram_player()
     test_reset()
+    test_observation_buffer()
+    test_seed()
+    test_observation_length()
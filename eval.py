@@ -2,11 +2,28 @@
 """
 学習済みモデルを評価するためのモジュール。
 要学習済みモデルファイル。
-python eval.py を実行すると、標準出力に平均報酬値が出力される。
+python eval.py を実行すると、(ステップ数, モデル, 環境側プレイヤー)の
+全組み合わせをプロセスプールで並列評価し、平均報酬値・標準誤差・
+95%信頼区間を標準出力および結果ファイル(CSV/JSON)へ出力する。
+
+Usage:
+    eval.py [--steps=<steps>] [--paths=<paths>] [--players=<players>] [--workers=<workers>] [--output=<output>] [--seed=<seed>]
+
+Options:
+    --steps=<steps>         comma separated step counts [default: 10,100,1000,10000]
+    --paths=<paths>         comma separated model paths [default: prob_ppo,pa_ppo,policy_ppo]
+    --players=<players>     comma separated env players [default: Player,ProbPlayer,JurinaPlayer,AIPlayer]
+    --workers=<workers>     number of worker processes (0: cpu count) [default: 0]
+    --output=<output>       result file path (*.csv or *.json) [default: eval_result.csv]
+    --seed=<seed>           random seed (default: not reproducible)
 """
+import csv
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
 from time import time
-from stable_baselines3 import PPO
-from envs import EvalEnv, Player, ProbPlayer, JurinaPlayer, AIPlayer
+from envs import EvalEnv, Player, ProbPlayer, JurinaPlayer, AIPlayer, spawn_seeds
 
 # 学習済みモデルファイルパス
 PROP_PPO = 'prob_ppo'
@@ -14,7 +31,53 @@ PA_PPO = 'pa_ppo'
 POLICY_PPO = 'policy_ppo'
 PATHS = [PROP_PPO, PA_PPO, POLICY_PPO]
 
-def eval_ppo(env_player, path=PROP_PPO, steps=100, debug=True):
+# 評価環境側プレイヤー名
+PLAYERS = ['Player', 'ProbPlayer', 'JurinaPlayer', 'AIPlayer']
+
+# 結果ファイルの列
+COLUMNS = ['steps', 'path', 'player', 'episodes', 'mean', 'stderr',
+    'ci_low', 'ci_high', 'elapsed']
+
+# プロセス毎の学習済みモデルキャッシュ
+_model_cache = {}
+
+def get_model(path):
+    """
+    学習済みモデルをロードする。
+    同じプロセス内で同じパスのモデルは1回だけロードする。
+    引数：
+        path    学習済みモデルファイルパス
+    戻り値：
+        学習済みモデル
+    """
+    model = _model_cache.get(path)
+    if model is None:
+        from stable_baselines3 import PPO
+        model = PPO.load(path)
+        _model_cache[path] = model
+    return model
+
+def make_player(name):
+    """
+    プレイヤー名から評価環境側プレイヤーを生成する。
+    AIPlayer は prob_ppo を使用する。
+    引数：
+        name    プレイヤー名
+    戻り値：
+        プレイヤーインスタンス
+    """
+    if name == 'Player':
+        return Player()
+    elif name == 'ProbPlayer':
+        return ProbPlayer()
+    elif name == 'JurinaPlayer':
+        return JurinaPlayer()
+    elif name == 'AIPlayer':
+        return AIPlayer(get_model(PROP_PPO))
+    else:
+        raise ValueError(f'player={name}: no match argument')
+
+def eval_ppo(env_player, path=PROP_PPO, steps=100, debug=True, model=None, seed=None):
     """
     学習済み方策PPOを100ステップ実行し、
     平均収益を表示する。
@@ -23,14 +86,17 @@ def eval_ppo(env_player, path=PROP_PPO, steps=100, debug=True):
         path            ロードする方策側学習済みモデルファイルパス
         steps           ステップ実行回数
         debug           Trueの場合毎ステップ表示する
+        model           方策側学習済みモデル（None の場合pathからロード）
+        seed            評価環境・環境側プレイヤーの乱数シード
     戻り値：
-        なし
+        収益リスト（エピソード毎の最終報酬）
     """
     # 評価用環境の生成
-    env = EvalEnv(env_player)
+    env = EvalEnv(env_player, seed=seed)
     # 評価対象学習済み方策モデルの復元
-    model = PPO.load(path)
-    
+    if model is None:
+        model = get_model(path)
+
     # エピソード開始時の観測を取得
     observation = env.reset()
     # 収益リスト初期化
@@ -40,7 +106,7 @@ def eval_ppo(env_player, path=PROP_PPO, steps=100, debug=True):
     # 処理時間計測
     elapsed = time()
     for _ in range(steps):
-        
+
         policy_action = model.predict(observation)
         if isinstance(policy_action, tuple):
             policy_action = policy_action[0]
@@ -52,32 +118,155 @@ def eval_ppo(env_player, path=PROP_PPO, steps=100, debug=True):
             revenue.append(reward)
             episodes = info['episode_no']
             observation = env.reset()
-    print(f'** path:{path} test')
     if debug:
+        print(f'** path:{path} test')
         print(f'   env player {env_player.__class__.__name__}')
-    print(f'   ran {steps} steps, {time() - elapsed} sec')
-    if debug:
+        print(f'   ran {steps} steps, {time() - elapsed} sec')
         print(f'   {episodes} episodes done')
-    if len(revenue) <= 0:
-        print(f'   no revenues')
+        if len(revenue) <= 0:
+            print(f'   no revenues')
+        else:
+            print(f'   revenue average: {sum(revenue)/len(revenue)} per episodes')
+    return revenue
+
+def summarize(revenue, z=1.96):
+    """
+    収益リストの平均・標準誤差・信頼区間を算出する。
+    引数：
+        revenue     収益リスト
+        z           信頼区間の係数（デフォルト：95%）
+    戻り値：
+        集計結果辞書（収益がない場合値はNone）
+    """
+    n = len(revenue)
+    if n <= 0:
+        return {'episodes': 0, 'mean': None, 'stderr': None,
+            'ci_low': None, 'ci_high': None}
+    mean = sum(revenue) / n
+    if n > 1:
+        variance = sum((r - mean) ** 2 for r in revenue) / (n - 1)
+        stderr = math.sqrt(variance / n)
+    else:
+        stderr = 0.0
+    return {'episodes': n, 'mean': mean, 'stderr': stderr,
+        'ci_low': mean - z * stderr, 'ci_high': mean + z * stderr}
+
+def eval_cell(steps, path, player, seed=None):
+    """
+    1つの(ステップ数, モデル, 環境側プレイヤー)の組み合わせを評価する。
+    プロセスプールのワーカー上で実行される。
+    引数：
+        steps       ステップ実行回数
+        path        方策側学習済みモデルファイルパス
+        player      環境側プレイヤー名
+        seed        評価環境の乱数シード
+    戻り値：
+        評価結果辞書
+    """
+    elapsed = time()
+    revenue = eval_ppo(make_player(player), path=path, steps=steps,
+        debug=False, model=get_model(path), seed=seed)
+    result = {'steps': steps, 'path': path, 'player': player}
+    result.update(summarize(revenue))
+    result['elapsed'] = time() - elapsed
+    return result
+
+def _init_worker():
+    """
+    ワーカープロセス同士でCPUコアを奪い合わないよう torch のスレッド数を1にする。
+    """
+    import torch
+    torch.set_num_threads(1)
+
+def eval_matrix(step_list, paths=PATHS, players=PLAYERS, workers=None, seed=None):
+    """
+    全組み合わせをプロセスプールで並列評価する。
+    各ワーカーは担当したモデルをプロセス内キャッシュへ1回だけロードする。
+    シード指定時は組み合わせ毎の子シードで評価環境を初期化する。
+    引数：
+        step_list   ステップ実行回数リスト
+        paths       方策側学習済みモデルファイルパスリスト
+        players     環境側プレイヤー名リスト
+        workers     ワーカープロセス数（None の場合CPU数）
+        seed        乱数シード（None の場合再現性なし）
+    戻り値：
+        評価結果辞書のリスト（ステップ数・モデル・プレイヤー順）
+    """
+    cells = [(steps, path, player)
+        for steps in step_list for path in paths for player in players]
+    seeds = [None] * len(cells) if seed is None else spawn_seeds(seed, len(cells))
+    cells = [cell + (cell_seed,) for cell, cell_seed in zip(cells, seeds)]
+    # ステップ数の大きい組み合わせから投入して負荷を平準化する
+    order = sorted(range(len(cells)), key=lambda i: -cells[i][0])
+    results = [None] * len(cells)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = {i: executor.submit(eval_cell, *cells[i]) for i in order}
+        for i, future in futures.items():
+            results[i] = future.result()
+    return results
+
+def write_results(results, output):
+    """
+    評価結果を拡張子に応じてCSVまたはJSONで書き出す。
+    引数：
+        results     評価結果辞書のリスト
+        output      結果ファイルパス
+    戻り値：
+        なし
+    """
+    if output.endswith('.json'):
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
     else:
-        print(f'   revenue average: {sum(revenue)/len(revenue)} per episodes')
+        with open(output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(results)
 
+def print_results(results):
+    """
+    評価結果を表形式で標準出力へ表示する。
+    引数：
+        results     評価結果辞書のリスト
+    戻り値：
+        なし
+    """
+    print(f'{"steps":>6} {"path":<12} {"player":<13} {"episodes":>8} ' + \
+        f'{"mean":>8} {"stderr":>7} {"95% CI":>17}')
+    for r in results:
+        if r['mean'] is None:
+            stats = f'{"-":>8} {"-":>7} {"-":>17}'
+        else:
+            stats = f'{r["mean"]:8.3f} {r["stderr"]:7.3f} ' + \
+                f'[{r["ci_low"]:7.3f},{r["ci_high"]:7.3f}]'
+        print(f'{r["steps"]:>6} {r["path"]:<12} {r["player"]:<13} ' + \
+            f'{r["episodes"]:>8} {stats}')
+
+# テスト
+
+def test_summarize():
+    result = summarize([10, -10, 10, -10])
+    assert(result['episodes'] == 4)
+    assert(result['mean'] == 0.0)
+    assert(abs(result['stderr'] - math.sqrt(400.0 / 3.0 / 4.0)) < 1e-9)
+    assert(abs(result['ci_high'] - 1.96 * result['stderr']) < 1e-9)
+    assert(summarize([])['mean'] is None)
+    assert(summarize([1])['stderr'] == 0.0)
 
 if __name__ == '__main__':
     """
     学習済みモデルの平均報酬値を出力する。
     """
-    # ステップ数リスト
-    step_list = [10, 100, 1000, 10000]
-
-    # 評価環境側プレイヤーリスト
-    players = [Player(), ProbPlayer(), JurinaPlayer(), AIPlayer(PPO.load(PROP_PPO))]
-    debug = False
-    print('*****************************')
-    for steps in step_list:
-        for path in PATHS:
-            for player in players:
-                print(f'*** steps={steps}, path={path}, player={player.__class__.__name__}')
-                eval_ppo(env_player=player, path=path, steps=steps, debug=debug)
-                print('*****************************')
+    from docopt import docopt
+    args = docopt(__doc__)
+    step_list = [int(steps) for steps in args['--steps'].split(',')]
+    workers = int(args['--workers']) or os.cpu_count()
+    elapsed = time()
+    results = eval_matrix(step_list,
+        paths=args['--paths'].split(','),
+        players=args['--players'].split(','),
+        workers=workers,
+        seed=None if args['--seed'] is None else int(args['--seed']))
+    print_results(results)
+    write_results(results, args['--output'])
+    print(f'{len(results)} cells, {workers} workers, {time() - elapsed} sec')
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+学習済みモデルの推論をまとめて実行するマイクロバッチ推論スケジューラを
+提供するモジュール。
+同時に届いた複数リクエストの観測を一定時間・一定件数まで集め、
+1回の順伝播で推論して各呼び出し元へ結果を返却する。
+"""
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+from numpy_policy import action_probs
+
+class BatchPredictor:
+    """
+    マイクロバッチ推論スケジューラクラス。
+    predict() は呼び出しスレッドをブロックし、
+    バックグラウンドスレッドがまとめて推論した結果を返却する。
+    """
+    def __init__(self, model=None, max_batch=32, max_wait=0.002, history=10000):
+        """
+        モデル・バッチ条件を格納し、推論スレッドを開始する。
+        引数：
+            model       既定の学習済みモデル（predict(observations)を持つこと）
+            max_batch   1回の推論でまとめる最大件数
+            max_wait    最初のリクエスト到着後に待つ最大時間（秒）
+            history     レイテンシ統計に使用する直近件数
+        戻り値：
+            なし
+        """
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = Counter()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def predict(self, observation, model=None):
+        """
+        観測をキューへ追加し、推論結果を待って返却する。
+        引数：
+            observation     観測 (100, 2)
+            model           推論に使用するモデル（None の場合既定のモデル）
+        戻り値：
+            モデルが選択した行動
+        """
+        return self._submit(observation, model, False)
+
+    def predict_probs(self, observation, model=None):
+        """
+        観測をキューへ追加し、各行動の選択確率を待って返却する。
+        引数：
+            observation     観測 (100, 2)
+            model           推論に使用するモデル（None の場合既定のモデル）
+        戻り値：
+            行動選択確率 (行動数,)
+        """
+        return self._submit(observation, model, True)
+
+    def _submit(self, observation, model, probs):
+        """
+        リクエストをキューへ追加し、結果を待って返却する。
+        """
+        future = Future()
+        model = self.model if model is None else model
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('predictor is closed')
+            self.queue.append(
+                (np.array(observation), future, time.perf_counter(), model, probs))
+            self.condition.notify()
+        return future.result()
+
+    def _next_batch(self):
+        """
+        最初のリクエストが届くまで待ち、その後max_wait経過またはmax_batch件
+        に達するまでリクエストを集める。
+        引数：
+            なし
+        戻り値：
+            リクエストのリスト（終了時はNone）
+        """
+        with self.condition:
+            while not self.queue and not self.closed:
+                self.condition.wait()
+            if self.closed and not self.queue:
+                return None
+            deadline = time.perf_counter() + self.max_wait
+            while len(self.queue) < self.max_batch and not self.closed:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            size = min(len(self.queue), self.max_batch)
+            return [self.queue.popleft() for _ in range(size)]
+
+    def _run(self):
+        """
+        推論スレッド本体。
+        モデル切り替え中は、リクエスト毎に指定されたモデル単位で推論する。
+        行動・選択確率のリクエストもそれぞれまとめて推論する。
+        """
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            groups = {}
+            for request in batch:
+                groups.setdefault((id(request[3]), request[4]), []).append(request)
+            for group in groups.values():
+                self._predict_group(group)
+
+    def _predict_group(self, group):
+        """
+        同一モデルのリクエストをまとめて推論し、結果を返却する。
+        """
+        observations = np.stack([request[0] for request in group])
+        model = group[0][3]
+        try:
+            if group[0][4]:
+                results = list(action_probs(model, observations))
+            else:
+                actions, _ = model.predict(observations)
+                results = [int(action) for action in np.asarray(actions).reshape(-1)]
+        except Exception as e:
+            for request in group:
+                request[1].set_exception(e)
+            return
+        now = time.perf_counter()
+        self.batch_sizes[len(group)] += 1
+        for request, result in zip(group, results):
+            self.latencies.append(now - request[2])
+            request[1].set_result(result)
+
+    def stats(self):
+        """
+        推論レイテンシのパーセンタイルとバッチサイズ分布を取得する。
+        引数：
+            なし
+        戻り値：
+            統計情報辞書
+        """
+        latencies = np.array(self.latencies)
+        if len(latencies) > 0:
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000.0
+        else:
+            p50 = p90 = p99 = 0.0
+        return {
+            'requests':         len(latencies),
+            'latency_ms':       {
+                'p50': float(p50), 'p90': float(p90), 'p99': float(p99)},
+            'batch_sizes':      {str(size): count
+                for size, count in sorted(self.batch_sizes.items())},
+        }
+
+    def close(self):
+        """
+        推論スレッドを終了する。キュー内のリクエストは推論してから終了する。
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+# テスト
+
+class _CountingModel:
+    def __init__(self):
+        self.calls = 0
+    def predict(self, observations):
+        self.calls += 1
+        return observations[:, -1, 0].astype(np.int64), None
+    def action_probs(self, observations):
+        self.calls += 1
+        return np.eye(3)[observations[:, -1, 0]]
+
+def test_batch_predictor():
+    from concurrent.futures import ThreadPoolExecutor
+    model = _CountingModel()
+    predictor = BatchPredictor(model, max_batch=8, max_wait=0.05)
+    observations = [np.full((100, 2), i % 3, dtype=np.int8) for i in range(16)]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        actions = list(executor.map(predictor.predict, observations))
+    predictor.close()
+    assert(actions == [i % 3 for i in range(16)])
+    assert(model.calls < 16)
+    stats = predictor.stats()
+    assert(stats['requests'] == 16)
+    assert(sum(int(size) * count for size, count in stats['batch_sizes'].items()) == 16)
+
+def test_batch_predictor_models():
+    from concurrent.futures import ThreadPoolExecutor
+    old_model, new_model = _CountingModel(), _CountingModel()
+    predictor = BatchPredictor(old_model, max_batch=8, max_wait=0.05)
+    observation = np.zeros((100, 2), dtype=np.int8)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: predictor.predict(observation,
+            model=new_model if i % 2 else None), range(8)))
+    predictor.close()
+    assert(old_model.calls >= 1 and new_model.calls >= 1)
+
+def test_batch_predictor_probs():
+    model = _CountingModel()
+    predictor = BatchPredictor(model, max_batch=8, max_wait=0.01)
+    observation = np.full((100, 2), 2, dtype=np.int8)
+    probs = predictor.predict_probs(observation)
+    assert(predictor.predict(observation) == 2)
+    predictor.close()
+    assert(probs.tolist() == [0.0, 0.0, 1.0])
+
+if __name__ == '__main__':
+    test_batch_predictor()
+    test_batch_predictor_models()
+    test_batch_predictor_probs()
@@ -0,0 +1,567 @@
+# -*- coding: utf-8 -*-
+"""
+過去のチェックポイントを対戦相手プールとして保持し、勝率に応じて
+対戦相手を選ぶ（優先度付き架空自己対戦、PFSP）リーグ学習を行うモジュール。
+世代毎に複数の学習者をプロセスプールで並列に学習させ、各学習者の
+スナップショットをプールへ追加し、学習者とプール全員の対戦を
+バッチ対戦で評価して次の世代の対戦相手の選択確率を更新する。
+プールのスナップショットは pool_size 件まで保持し、古いものはファイルごと削除する。
+リーグの状態は世代毎に league.json へ書き出し、再実行時は続きから学習する。
+学習者毎の学習済み世代も学習の完了毎に書き出すため、世代の途中で中断しても
+再実行時に学習を終えた学習者を重ねて学習させない。
+
+Usage:
+    league.py [--learners=<n>] [--generations=<n>] [--timesteps=<steps>] [--num_envs=<n>] [--pool_size=<n>] [--opponents=<specs>] [--games=<games>] [--batch=<batch>] [--resample=<steps>] [--workers=<workers>] [--dir=<dir>] [--seed=<seed>] [--length=<n>]
+
+Options:
+    --learners=<n>          number of learners trained concurrently [default: 2]
+    --generations=<n>       number of generations to train [default: 10]
+    --timesteps=<steps>     timesteps per learner per generation [default: 100000]
+    --num_envs=<n>          games stepped at once per learner [default: 64]
+    --pool_size=<n>         max snapshots kept in the opponent pool (>= learners) [default: 8]
+    --opponents=<specs>     comma separated fixed opponents (Player class names or model paths) [default: ProbPlayer,JurinaPlayer,NGramPlayer]
+    --games=<games>         evaluation rounds per (learner, opponent) [default: 2000]
+    --batch=<batch>         concurrent games stepped at once in evaluation [default: 100]
+    --resample=<steps>      steps between opponent reassignment per env (0: never) [default: 256]
+    --workers=<workers>     number of evaluation worker processes (0: cpu count) [default: 0]
+    --dir=<dir>             league directory [default: league]
+    --seed=<seed>           random seed (default: not reproducible)
+    --length=<n>            observation window of the learners [default: 100]
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import envs
+from tournament import ENV_SIDE, POLICY_SIDE, Entrant, play, save_cache, load_cache
+
+# リーグ状態ファイル名
+STATE_FILE = 'league.json'
+
+def pfsp_weights(scores, power=2.0, min_weight=0.05):
+    """
+    対戦相手毎の学習者のスコアから対戦相手の選択確率を算出する。
+    学習者が勝てない相手ほど選ばれやすい (1 - スコア)^power を重みとし、
+    未評価の相手は重み1とする。勝ち越した相手も min_weight の割合で選ぶ。
+    引数：
+        scores      対戦相手毎のスコア（勝ち=1、あいこ=0.5、未評価はNone）のリスト
+        power       重みの指数
+        min_weight  重みの下限
+    戻り値：
+        選択確率の配列
+    """
+    weights = np.array([1.0 if score is None else (1.0 - score) ** power
+        for score in scores], dtype=np.float64)
+    weights = np.maximum(weights, min_weight)
+    return weights / weights.sum()
+
+class PoolPlayer(envs.Player):
+    """
+    対戦相手プールのプレイヤーを環境毎に割り当てて行動を選択するプレイヤー。
+    割り当ては resample_interval ステップ毎に選択確率に従って抽選し直す
+    （0 の場合、環境数が変わらない限り抽選し直さない）。
+    行動は割り当てた相手毎に predict_batch() をまとめて1回ずつ呼び出すため、
+    1ステップの推論回数は環境数ではなく対戦相手数で決まる。
+    観測は環境側の並び [学習者の行動, 自分の行動] で受け取り、
+    方策側として学習したスナップショット（POLICY_SIDE）には
+    学習時と同じ [自分の行動, 学習者の行動] の並びへ入れ替えて渡す。
+    """
+    def __init__(self, opponents, probs, resample_interval=256, seed=None, sides=None):
+        """
+        引数：
+            opponents           対戦相手プレイヤーインスタンスのリスト
+            probs               各対戦相手の選択確率
+            resample_interval   割り当てを抽選し直す間隔（ステップ数、0 の場合抽選し直さない）
+            seed                割り当ての抽選に使用する乱数シード
+            sides               各対戦相手の観測の列の並び（None の場合すべて ENV_SIDE）
+        戻り値：
+            なし
+        """
+        self.opponents = list(opponents)
+        self.sides = [ENV_SIDE] * len(self.opponents) if sides is None else list(sides)
+        probs = np.asarray(probs, dtype=np.float64)
+        self.probs = probs / probs.sum()
+        if resample_interval < 0:
+            raise ValueError(f'resample_interval={resample_interval}: must be 0 or positive')
+        self.resample_interval = resample_interval
+        self.steps = 0
+        # 環境毎の対戦相手番号と、対戦相手毎の環境番号 [(対戦相手番号, 環境番号配列), ...]
+        self.assignment = None
+        self.groups = []
+        super().__init__(seed)
+
+    def assign(self, num_envs):
+        """
+        環境毎の対戦相手を抽選する。
+        引数：
+            num_envs    環境数
+        戻り値：
+            なし
+        """
+        self.assignment = self.rng.choice(len(self.opponents), size=num_envs, p=self.probs)
+        order = np.argsort(self.assignment, kind='stable')
+        counts = np.bincount(self.assignment, minlength=len(self.opponents))
+        self.groups = [(index, rows) for index, rows in
+            enumerate(np.split(order, np.cumsum(counts)[:-1])) if len(rows) > 0]
+
+    def predict(self, observation):
+        """
+        引数observationをもとに次の行動を選択する。
+        """
+        return int(self.predict_batch(np.asarray(observation)[np.newaxis])[0])
+
+    def predict_batch(self, observations):
+        """
+        複数の観測それぞれに対する次の行動を、割り当てた対戦相手毎にまとめて選択する。
+        引数：
+            observations    観測の配列 (N, L, 2)
+        戻り値：
+            選択された行動の配列 (N,)
+        """
+        observations = np.asarray(observations)
+        if self.assignment is None or len(self.assignment) != len(observations) \
+                or (self.resample_interval > 0 and self.steps % self.resample_interval == 0):
+            self.assign(len(observations))
+        self.steps += 1
+        actions = np.empty(len(observations), dtype=np.int64)
+        for index, rows in self.groups:
+            group = observations[rows]
+            if self.sides[index] == POLICY_SIDE:
+                group = group[:, :, ::-1]
+            actions[rows] = self.opponents[index].predict_batch(group)
+        return actions
+
+def make_pool_player(specs, probs, resample_interval=256, seed=None):
+    """
+    対戦相手の指定文字列リストから PoolPlayer を生成する。
+    引数：
+        specs               envs.py のプレイヤークラス名または学習済みモデルファイルパスのリスト
+        probs               各対戦相手の選択確率
+        resample_interval   割り当てを抽選し直す間隔（ステップ数）
+        seed                割り当ての抽選に使用する乱数シード
+    戻り値：
+        PoolPlayer インスタンス
+    """
+    entrants = [Entrant.from_spec(spec) for spec in specs]
+    return PoolPlayer([entrant.create() for entrant in entrants], probs,
+        resample_interval=resample_interval, seed=seed,
+        sides=[entrant.side for entrant in entrants])
+
+def train_learner(checkpoint_path, snapshot_path, opponent_specs, probs,
+        timesteps, num_envs=64, resample_interval=256, seed=None,
+        length=envs.OBSERVATION_LENGTH):
+    """
+    ワーカープロセス上で学習者を1世代分学習させる。
+    学習者のチェックポイントが存在すれば続きから学習し、
+    学習後にチェックポイントと対戦相手プール用の .npz スナップショットを書き出す。
+    引数：
+        checkpoint_path     学習者のチェックポイントパス（.zip 省略）
+        snapshot_path       スナップショットの出力先 .npz パス
+        opponent_specs      対戦相手の指定文字列リスト
+        probs               各対戦相手の選択確率
+        timesteps           学習ステップ数
+        num_envs            同時に進める環境数
+        resample_interval   対戦相手の割り当てを抽選し直す間隔（ステップ数）
+        seed                乱数シード（SeedSequence）
+        length              観測長
+    戻り値：
+        学習者の累計ステップ数
+    """
+    import torch
+    from stable_baselines3 import PPO
+    from numpy_policy import policy_arrays
+    from vec_envs import BatchRockPaperScissorsEnv
+    torch.set_num_threads(1)
+    player_seed, env_seed, model_seed = envs.spawn_seeds(seed, 3)
+    player = make_pool_player(opponent_specs, probs,
+        resample_interval=resample_interval, seed=player_seed)
+    env = BatchRockPaperScissorsEnv(player, num_envs=num_envs, length=length, seed=env_seed)
+    model_seed = int(model_seed.generate_state(1)[0] & 0x7fffffff)
+    if os.path.exists(checkpoint_path + '.zip'):
+        model = PPO.load(checkpoint_path, env=env)
+        model.set_random_seed(model_seed)
+    else:
+        model = PPO('MlpPolicy', env, seed=model_seed)
+    model.learn(total_timesteps=timesteps, reset_num_timesteps=False)
+    # 書き込み途中で中断されても直前のチェックポイントが残るよう置き換える
+    model.save(checkpoint_path + '.tmp.zip')
+    os.replace(checkpoint_path + '.tmp.zip', checkpoint_path + '.zip')
+    np.savez(snapshot_path, **policy_arrays(model))
+    env.close()
+    return model.num_timesteps
+
+def evaluate_pairing(learner_spec, opponent_spec, games, batch, seed=None,
+        length=envs.OBSERVATION_LENGTH):
+    """
+    ワーカープロセス上で学習者と対戦相手をバッチ対戦させ、学習者のスコアを算出する。
+    学習者・対戦相手にはそれぞれ学習時と同じ列の並びの観測を渡す。
+    引数：
+        learner_spec    学習者のスナップショットパス
+        opponent_spec   対戦相手の指定文字列
+        games           対戦回数
+        batch           同時に進める対戦数
+        seed            乱数シード（SeedSequence）
+        length          観測長（学習者の学習時の観測長）
+    戻り値：
+        学習者のスコア（勝ち=1、あいこ=0.5）
+    """
+    play_seed, learner_seed, opponent_seed = envs.spawn_seeds(seed, 3)
+    entrants = (Entrant.from_spec(learner_spec), Entrant.from_spec(opponent_spec))
+    learner, opponent = entrants[0].create(), entrants[1].create()
+    learner.seed(learner_seed)
+    opponent.seed(opponent_seed)
+    win, draw, _ = play(learner, opponent, games=games, batch=batch, length=length,
+        seed=play_seed, sides=tuple(entrant.side for entrant in entrants))
+    return (win + 0.5 * draw) / games
+
+def _init_worker():
+    """
+    ワーカープロセス同士でCPUコアを奪い合わないよう torch のスレッド数を1にする。
+    """
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+
+class League:
+    """
+    リーグの状態（学習者・固定の対戦相手・スナップショット・スコア）を
+    保持し、league.json へ読み書きするクラス。
+    """
+    def __init__(self, directory, learners=2, fixed=(), pool_size=8,
+            length=envs.OBSERVATION_LENGTH):
+        """
+        状態ファイルが存在すれば読み込み、存在しなければ初期化する。
+        引数：
+            directory   リーグディレクトリ
+            learners    学習者数
+            fixed       固定の対戦相手の指定文字列リスト
+            pool_size   保持するスナップショットの最大数（学習者数未満の場合は ValueError）
+            length      学習者の観測長（既存のリーグと異なる場合は ValueError）
+        戻り値：
+            なし
+        """
+        self.directory = directory
+        self.pool_size = pool_size
+        os.makedirs(os.path.join(directory, 'snapshots'), exist_ok=True)
+        self.state = load_cache(os.path.join(directory, STATE_FILE)) or {
+            'generation':   0,
+            'learners':     [f'learner{i}' for i in range(learners)],
+            'fixed':        list(fixed),
+            'length':       length,
+            # [{'name': 名前, 'path': .npz パス, 'generation': 世代}]
+            'snapshots':    [],
+            # {学習者名: {対戦相手の指定文字列: スコア}}
+            'scores':       {},
+            # {学習者名: {'generation': 学習済みの世代, 'steps': 累計ステップ数}}
+            'trained':      {},
+        }
+        self.state.setdefault('trained', {})
+        # 1世代分のスナップショットを保持できないと、評価前に同じ世代のものを削除してしまう
+        if pool_size < len(self.learners):
+            raise ValueError(f'pool_size={pool_size}: must be at least the number of '
+                f'learners ({len(self.learners)})')
+        # 観測長を変えると既存のチェックポイント・スナップショットを使用できない
+        if self.length != length:
+            raise ValueError(f'length={length}: league was trained with length {self.length}')
+
+    @property
+    def generation(self):
+        return self.state['generation']
+
+    @property
+    def length(self):
+        return self.state.get('length', envs.OBSERVATION_LENGTH)
+
+    @property
+    def learners(self):
+        return self.state['learners']
+
+    def checkpoint_path(self, learner):
+        """
+        学習者のチェックポイントパス（.zip 省略）を取得する。
+        """
+        return os.path.join(self.directory, learner)
+
+    def snapshot_path(self, learner, generation):
+        """
+        学習者の世代毎のスナップショットパスを取得する。
+        """
+        return os.path.join(self.directory, 'snapshots', f'{learner}-g{generation}.npz')
+
+    def pool(self):
+        """
+        対戦相手プール（固定の対戦相手とスナップショット）の指定文字列リストを取得する。
+        """
+        return self.state['fixed'] + [s['path'] for s in self.state['snapshots']]
+
+    def probs(self, learner):
+        """
+        学習者の対戦相手プールの選択確率を取得する。
+        """
+        scores = self.state['scores'].get(learner, {})
+        return pfsp_weights([scores.get(spec) for spec in self.pool()])
+
+    def pending(self, generation):
+        """
+        指定した世代の学習を終えていない学習者名のリストを取得する。
+        """
+        return [learner for learner in self.learners
+            if self.state['trained'].get(learner, {}).get('generation', 0) < generation]
+
+    def finish_training(self, learner, generation, steps):
+        """
+        学習者の学習済み世代を記録し、状態を書き出す。
+        チェックポイントの置き換え直後に呼び出し、中断後の再実行で重ねて学習させない。
+        引数：
+            learner     学習者名
+            generation  学習を終えた世代
+            steps       学習者の累計ステップ数
+        戻り値：
+            なし
+        """
+        self.state['trained'][learner] = {'generation': generation, 'steps': steps}
+        self.save()
+
+    def steps(self):
+        """
+        学習者毎の累計ステップ数の辞書を取得する。
+        """
+        return {learner: self.state['trained'].get(learner, {}).get('steps')
+            for learner in self.learners}
+
+    def add_snapshot(self, learner, generation):
+        """
+        スナップショットをプールへ追加し、pool_size を超えた古いものを削除する。
+        引数：
+            learner     学習者名
+            generation  世代
+        戻り値：
+            削除したスナップショットパスのリスト
+        """
+        self.state['snapshots'].append({'name': f'{learner}-g{generation}',
+            'path': self.snapshot_path(learner, generation), 'generation': generation})
+        removed = []
+        while len(self.state['snapshots']) > self.pool_size:
+            path = self.state['snapshots'].pop(0)['path']
+            removed.append(path)
+            for scores in self.state['scores'].values():
+                scores.pop(path, None)
+            if os.path.exists(path):
+                os.remove(path)
+        return removed
+
+    def save(self):
+        """
+        状態を league.json へ書き出す（一時ファイル経由で置き換える）。
+        """
+        save_cache(os.path.join(self.directory, STATE_FILE), self.state)
+
+def run_league(directory='league', learners=2, generations=10, timesteps=100000,
+        num_envs=64, pool_size=8, fixed=('ProbPlayer', 'JurinaPlayer', 'NGramPlayer'),
+        games=2000, batch=100, resample_interval=256, workers=None, seed=None,
+        length=envs.OBSERVATION_LENGTH):
+    """
+    リーグ学習を実行する。
+    世代毎に、全学習者を並列に学習させ、スナップショットをプールへ追加し、
+    学習者とプール全員の対戦を並列に評価して状態を書き出す。
+    引数：
+        directory           リーグディレクトリ
+        learners            学習者数
+        generations         今回の実行で学習する世代数
+        timesteps           1世代あたりの学習ステップ数
+        num_envs            学習者毎に同時に進める環境数
+        pool_size           保持するスナップショットの最大数（学習者数以上）
+        fixed               固定の対戦相手の指定文字列リスト
+        games               評価時の1組あたりの対戦回数
+        batch               評価時に同時に進める対戦数
+        resample_interval   対戦相手の割り当てを抽選し直す間隔（ステップ数、0 の場合抽選し直さない）
+        workers             評価ワーカープロセス数（None の場合CPU数）
+        seed                乱数シード（None の場合再現性なし）
+        length              学習者の観測長
+    戻り値：
+        League インスタンス
+    """
+    league = League(directory, learners=learners, fixed=fixed, pool_size=pool_size,
+        length=length)
+    for _ in range(generations):
+        generation = league.generation + 1
+        # 世代毎に同じシードから子シードを生成するため、中断後の再実行でも再現できる
+        generation_seed = None if seed is None else np.random.SeedSequence([seed, generation])
+        train_seeds, eval_seed = envs.spawn_seeds(generation_seed, 2)
+        train_seeds = envs.spawn_seeds(train_seeds, len(league.learners))
+        train_seeds = dict(zip(league.learners, train_seeds))
+        pending = league.pending(generation)
+        pool = league.pool()
+        if pending:
+            with ProcessPoolExecutor(max_workers=len(pending)) as executor:
+                futures = {executor.submit(train_learner,
+                    league.checkpoint_path(learner), league.snapshot_path(learner, generation),
+                    pool, league.probs(learner), timesteps, num_envs, resample_interval,
+                    train_seeds[learner], length): learner for learner in pending}
+                # 学習を終えた順に記録し、残りの学習中に中断しても終えた分は学習し直さない
+                for future in as_completed(futures):
+                    league.finish_training(futures[future], generation, future.result())
+        for learner in league.learners:
+            league.add_snapshot(learner, generation)
+
+        pool = league.pool()
+        pairings = [(learner, spec) for learner in league.learners for spec in pool]
+        eval_seeds = envs.spawn_seeds(eval_seed, len(pairings))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            futures = [executor.submit(evaluate_pairing,
+                league.snapshot_path(learner, generation), spec, games, batch, pairing_seed,
+                length)
+                for (learner, spec), pairing_seed in zip(pairings, eval_seeds)]
+            for (learner, spec), future in zip(pairings, futures):
+                league.state['scores'].setdefault(learner, {})[spec] = future.result()
+        league.state['generation'] = generation
+        league.save()
+        print_generation(league, league.steps())
+    return league
+
+def print_generation(league, steps):
+    """
+    世代毎の学習ステップ数と対戦相手毎のスコアを標準出力へ表示する。
+    """
+    print(f'generation {league.generation}')
+    for learner in league.learners:
+        scores = league.state['scores'].get(learner, {})
+        print(f'  {learner}: {steps.get(learner)} steps')
+        for spec, prob in zip(league.pool(), league.probs(learner)):
+            print(f'    {os.path.basename(spec):<24} score {scores.get(spec, 0.0):.3f}'
+                f'  next prob {prob:.3f}')
+
+# テスト
+
+def _save_random_policy(path, seed):
+    rng = np.random.default_rng(seed)
+    np.savez(path, weight_0=rng.normal(size=(16, 200)), bias_0=rng.normal(size=16),
+        action_weight=rng.normal(size=(3, 16)), action_bias=rng.normal(size=3),
+        num_layers=np.array(1), activation=np.array('Tanh'),
+        observation_shape=np.array([100, 2]))
+
+def _save_counter_policy(path, length=100):
+    """
+    観測の列1（方策側の並びでは相手の行動）の最新の手に勝つ手を選ぶ方策を書き出す。
+    """
+    weight = np.zeros((2, 2 * length))
+    weight[:, 2 * (length - 1) + 1] = [10.0, -10.0]
+    # 隠れ層：h0 ≒ [相手の手 == チョキ]、h1 ≒ [相手の手 == グー]（±1）
+    np.savez(path, weight_0=weight, bias_0=np.array([-15.0, 5.0]),
+        action_weight=np.array([[10.0, 0.0], [0.0, 10.0], [-10.0, -10.0]]),
+        action_bias=np.array([0.0, 0.0, -10.0]),
+        num_layers=np.array(1), activation=np.array('Tanh'),
+        observation_shape=np.array([length, 2]))
+
+def test_pfsp_weights():
+    probs = pfsp_weights([0.0, 0.5, 1.0, None])
+    assert(abs(probs.sum() - 1.0) < 1e-9)
+    assert(probs[0] == probs[3] and probs[0] > probs[1] > probs[2] > 0.0)
+
+def test_pool_player():
+    observations = np.zeros((1000, 100, 2), dtype=np.int8)
+    player = PoolPlayer([envs.JurinaPlayer(action=0), envs.JurinaPlayer(action=2)],
+        [1.0, 0.0], seed=0)
+    assert((player.predict_batch(observations) == 0).all())
+    player = PoolPlayer([envs.JurinaPlayer(action=0), envs.JurinaPlayer(action=2)],
+        [3.0, 1.0], resample_interval=2, seed=0)
+    actions = player.predict_batch(observations)
+    assert((actions == 2 * player.assignment).all())
+    assert(abs((actions == 0).mean() - 0.75) < 0.05)
+    first = player.assignment
+    player.predict_batch(observations)
+    assert(player.assignment is first)
+    player.predict_batch(observations)
+    assert(player.assignment is not first)
+    # resample_interval=0 の場合は最初の割り当てを使い続ける
+    player = PoolPlayer([envs.JurinaPlayer(action=0), envs.JurinaPlayer(action=2)],
+        [1.0, 1.0], resample_interval=0, seed=0)
+    player.predict_batch(observations)
+    first = player.assignment
+    for _ in range(3):
+        player.predict_batch(observations)
+    assert(player.assignment is first)
+
+def test_snapshot_side():
+    import tempfile
+    with tempfile.TemporaryDirectory() as dirname:
+        spec = os.path.join(dirname, 'counter.npz')
+        _save_counter_policy(spec)
+        # 相手の直前の手に勝つよう学習したスナップショットは、固定の手の相手に勝ち越す
+        assert(evaluate_pairing(spec, 'JurinaPlayer', games=1000, batch=50, seed=1) > 0.9)
+        # プール内のスナップショットには学習者の手を相手の手として渡す
+        observations = np.zeros((100, 100, 2), dtype=np.int8)
+        observations[:, :, 0] = 2
+        player = make_pool_player([spec], [1.0], seed=0)
+        assert((player.predict_batch(observations) == envs.COUNTER_ACTIONS[2]).all())
+        # 観測長を変えて学習したスナップショットは同じ観測長で評価する
+        spec = os.path.join(dirname, 'counter10.npz')
+        _save_counter_policy(spec, length=10)
+        assert(evaluate_pairing(spec, 'JurinaPlayer', games=1000, batch=50, seed=1,
+            length=10) > 0.9)
+
+def test_league_pool():
+    import tempfile
+    with tempfile.TemporaryDirectory() as dirname:
+        league = League(dirname, learners=1, fixed=['JurinaPlayer'], pool_size=2)
+        for generation in range(1, 4):
+            _save_random_policy(league.snapshot_path('learner0', generation), generation)
+            league.add_snapshot('learner0', generation)
+        assert(league.pool() == ['JurinaPlayer',
+            league.snapshot_path('learner0', 2), league.snapshot_path('learner0', 3)])
+        assert(not os.path.exists(league.snapshot_path('learner0', 1)))
+        # スナップショットとの対戦はバッチ推論で評価する
+        spec = league.snapshot_path('learner0', 3)
+        score = evaluate_pairing(spec, 'JurinaPlayer', games=200, batch=50, seed=1)
+        assert(0.0 <= score <= 1.0)
+        assert(score == evaluate_pairing(spec, 'JurinaPlayer', games=200, batch=50, seed=1))
+        league.state['scores']['learner0'] = {'JurinaPlayer': 1.0, spec: 0.0}
+        probs = league.probs('learner0')
+        assert(probs[0] < probs[2])
+        league.save()
+        assert(League(dirname).pool() == league.pool())
+        try:
+            League(dirname, length=10)
+            assert(False)
+        except ValueError:
+            pass
+
+def test_league_progress():
+    import tempfile
+    with tempfile.TemporaryDirectory() as dirname:
+        try:
+            League(dirname, learners=3, pool_size=2)
+            assert(False)
+        except ValueError:
+            pass
+        league = League(dirname, learners=2, pool_size=2)
+        assert(league.pending(1) == ['learner0', 'learner1'])
+        # learner1 の学習を終えた時点で中断しても、再実行時は learner0 だけを学習する
+        league.finish_training('learner1', 1, 1000)
+        league = League(dirname, learners=2, pool_size=2)
+        assert(league.pending(1) == ['learner0'])
+        league.finish_training('learner0', 1, 1000)
+        assert(league.pending(1) == [] and league.pending(2) == ['learner0', 'learner1'])
+        assert(league.steps() == {'learner0': 1000, 'learner1': 1000})
+        # 同じ世代の全学習者のスナップショットは pool_size で削除されない
+        for generation in range(1, 3):
+            for learner in league.learners:
+                league.add_snapshot(learner, generation)
+        assert([s['generation'] for s in league.state['snapshots']] == [2, 2])
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    run_league(directory=args['--dir'], learners=int(args['--learners']),
+        generations=int(args['--generations']), timesteps=int(args['--timesteps']),
+        num_envs=int(args['--num_envs']), pool_size=int(args['--pool_size']),
+        fixed=[spec for spec in args['--opponents'].split(',') if spec],
+        games=int(args['--games']), batch=int(args['--batch']),
+        resample_interval=int(args['--resample']),
+        workers=int(args['--workers']) or None,
+        seed=None if args['--seed'] is None else int(args['--seed']),
+        length=int(args['--length']))
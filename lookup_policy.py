@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+学習済みモデルを直近 k 手の (方策側行動, 環境側行動) の組だけで引ける
+参照テーブル（9^k 行）へ蒸留し、配列の添字参照のみで推論するモジュール。
+蒸留時に評価用観測でテーブルとモデルの一致率を算出し、テーブルへ格納する。
+
+Usage:
+    lookup_policy.py <model_path> <npz_path> [--order=<k>] [--samples=<n>] [--holdout=<n>] [--dataset=<path>] [--seed=<seed>] [--length=<n>]
+
+Arguments:
+    <model_path>    trained model path (PPO model or *.npz numpy policy)
+    <npz_path>      output lookup table npz file path
+
+Options:
+    --order=<k>         number of latest action pairs used as table index [default: 3]
+    --samples=<n>       random histories averaged per table entry [default: 64]
+    --holdout=<n>       held-out observations used to measure agreement [default: 10000]
+    --dataset=<path>    replay dataset (replay.py) used as held-out observations
+    --seed=<seed>       random seed [default: 0]
+    --length=<n>        observation window (default: the model's training length)
+"""
+import os
+
+import numpy as np
+
+from envs import OBSERVATION_LENGTH
+from numpy_policy import action_probs, model_observation_shape
+
+# 1手あたりの (方策側行動, 環境側行動) の組の数
+PAIRS = 9
+
+def context_index(observations, order):
+    """
+    観測の直近 order 手から参照テーブルの添字を算出する。
+    最新の手が最下位の桁となる 9 進数とする。
+    引数：
+        observations    観測 (length, 2) または観測の配列 (N, length, 2)
+        order           添字に使用する手数 k
+    戻り値：
+        添字（観測の配列の場合は添字の配列 (N,)）
+    """
+    latest = np.asarray(observations)[..., -order:, :].astype(np.int64)
+    pairs = latest[..., 0] * 3 + latest[..., 1]
+    return pairs @ (PAIRS ** np.arange(order - 1, -1, -1, dtype=np.int64))
+
+class LookupPolicy:
+    """
+    参照テーブルで行動を選択する方策クラス。
+    predict() は stable_baselines3 の predict() と同じ形式で返却するため、
+    AIPlayer やサーバの推論処理へそのまま渡すことができる。
+    """
+    def __init__(self, probs, order, agreement=None, source_digest=None,
+            observation_shape=(OBSERVATION_LENGTH, 2), seed=None):
+        """
+        参照テーブルを格納する。
+        引数：
+            probs               各添字の行動選択確率 (9^k, 行動数)
+            order               添字に使用する手数 k
+            agreement           評価用観測での最大確率行動の一致率
+            source_digest       蒸留元モデルファイルのSHA-256ハッシュ値
+            observation_shape   観測の形状
+            seed                確率的行動選択に使用する乱数シード
+        戻り値：
+            なし
+        """
+        self.probs = np.asarray(probs, dtype=np.float32)
+        self.order = int(order)
+        if len(self.probs) != PAIRS ** self.order:
+            raise ValueError(f'order={order}: table size {len(self.probs)} does not match')
+        self.actions = self.probs.argmax(axis=1)
+        self.cum_probs = np.cumsum(self.probs, axis=1)
+        self.agreement = agreement
+        self.source_digest = source_digest
+        self.observation_shape = tuple(observation_shape)
+        self.rng = np.random.default_rng(seed)
+
+    @classmethod
+    def load(cls, npz_path, seed=None):
+        """
+        save() で書き出した .npz から方策を生成する。
+        引数：
+            npz_path    .npz ファイルパス
+            seed        確率的行動選択に使用する乱数シード
+        戻り値：
+            LookupPolicy インスタンス
+        """
+        with np.load(npz_path) as data:
+            agreement = float(data['agreement'])
+            digest = str(data['source_digest'])
+            return cls(data['lookup_probs'], int(data['order']),
+                agreement=None if np.isnan(agreement) else agreement,
+                source_digest=digest or None,
+                observation_shape=data['observation_shape'].tolist(),
+                seed=seed)
+
+    def save(self, npz_path):
+        """
+        参照テーブルを .npz へ書き出す。
+        引数：
+            npz_path    出力先 .npz ファイルパス
+        戻り値：
+            なし
+        """
+        np.savez(npz_path,
+            lookup_probs=self.probs,
+            order=np.array(self.order),
+            agreement=np.array(np.nan if self.agreement is None else self.agreement),
+            source_digest=np.array(self.source_digest or ''),
+            observation_shape=np.array(self.observation_shape))
+
+    def action_probs(self, observations):
+        """
+        観測の配列から各行動の選択確率を取得する。
+        引数：
+            observations    観測の配列 (N, length, 2)
+        戻り値：
+            選択確率 (N, 行動数)
+        """
+        return self.probs[context_index(observations, self.order)]
+
+    def predict(self, observation, state=None, episode_start=None,
+            deterministic=False):
+        """
+        観測から行動を選択する。stable_baselines3 の predict() と同じ形式。
+        引数：
+            observation     観測 (length, 2) または観測の配列 (N, length, 2)
+            state           使用しない
+            episode_start   使用しない
+            deterministic   真：最大確率の行動、偽：確率に従って抽選
+        戻り値：
+            actions         行動（単一観測の場合は0次元配列）
+            state           None
+        """
+        index = context_index(observation, self.order)
+        if deterministic:
+            return self.actions[index], None
+        cum_probs = self.cum_probs[index]
+        values = self.rng.random(np.shape(index) + (1,))
+        return (values > cum_probs[..., :-1]).sum(axis=-1), None
+
+def distill(model, order=3, samples=64, observation_shape=None, seed=0,
+        chunk_size=4096):
+    """
+    学習済みモデルを参照テーブルへ蒸留する。
+    各添字について直近 order 手を固定し、それより前の履歴を乱数とした
+    観測 samples 件の行動選択確率の平均をテーブルの値とする。
+    引数：
+        model               学習済みモデル（PPO または NumpyPolicy）
+        order               添字に使用する手数 k
+        samples             1添字あたりの観測数
+        observation_shape   観測の形状（None の場合はモデルの学習時の観測の形状）
+        seed                乱数シード
+        chunk_size          1回の順伝播で処理する観測数
+    戻り値：
+        LookupPolicy インスタンス
+    """
+    if observation_shape is None:
+        observation_shape = model_observation_shape(model)
+    rng = np.random.default_rng(seed)
+    length = observation_shape[0]
+    contexts = np.arange(PAIRS ** order)
+    # 添字を直近 order 手の (方策側行動, 環境側行動) へ展開（古い順）
+    digits = contexts[:, np.newaxis] // (PAIRS ** np.arange(order - 1, -1, -1)) % PAIRS
+    latest = np.stack([digits // 3, digits % 3], axis=-1).astype(np.int8)
+    per_chunk = max(1, chunk_size // samples)
+    probs = []
+    for start in range(0, len(contexts), per_chunk):
+        block = latest[start:start + per_chunk]
+        observations = rng.integers(0, 3,
+            size=(len(block), samples, length, 2), dtype=np.int8)
+        observations[:, :, -order:] = block[:, np.newaxis]
+        block_probs = action_probs(model,
+            observations.reshape(-1, length, 2), chunk_size=chunk_size)
+        probs.append(block_probs.reshape(len(block), samples, -1).mean(axis=1))
+    return LookupPolicy(np.concatenate(probs), order,
+        observation_shape=observation_shape, seed=seed)
+
+def agreement_report(model, policy, observations, chunk_size=4096):
+    """
+    評価用観測で参照テーブルと学習済みモデルの一致度を算出する。
+    引数：
+        model           学習済みモデル
+        policy          LookupPolicy インスタンス
+        observations    評価用観測の配列 (N, length, 2)
+        chunk_size      1回の順伝播で処理する観測数
+    戻り値：
+        一致度辞書（最大確率行動の一致率、選択確率の平均全変動距離）
+    """
+    expected = action_probs(model, observations, chunk_size=chunk_size)
+    probs = policy.action_probs(observations)
+    return {
+        'observations':         len(observations),
+        'agreement':            float((probs.argmax(axis=1)
+            == expected.argmax(axis=1)).mean()),
+        'total_variation':      float(0.5 * np.abs(probs - expected).sum(axis=1).mean()),
+    }
+
+def holdout_observations(count, observation_shape=(OBSERVATION_LENGTH, 2), seed=1,
+        dataset_path=None):
+    """
+    評価用観測を取得する。
+    リプレイデータセットが指定された場合は対戦履歴から切り出し、
+    指定がない場合は乱数で生成する。
+    引数：
+        count               観測数
+        observation_shape   観測の形状
+        seed                乱数シード
+        dataset_path        リプレイデータセットディレクトリ
+    戻り値：
+        観測の配列 (N, length, 2)
+    """
+    if dataset_path is None:
+        rng = np.random.default_rng(seed)
+        return rng.integers(0, 3, size=(count,) + tuple(observation_shape), dtype=np.int8)
+    from replay import ReplayDataset
+    dataset = ReplayDataset(dataset_path, length=observation_shape[0])
+    batches, total = [], 0
+    for observations, _ in dataset.iter_batches(batch_size=min(count, 4096), seed=seed):
+        batches.append(np.array(observations[:count - total]))
+        total += len(batches[-1])
+        if total >= count:
+            break
+    return np.concatenate(batches)
+
+# テスト
+
+class _LastMoveModel:
+    """
+    相手の直前の手に勝つ手を高い確率で選ぶテスト用モデル。
+    """
+    def __init__(self, length=OBSERVATION_LENGTH):
+        self.observation_shape = (length, 2)
+
+    def action_probs(self, observations):
+        probs = np.full((len(observations), 3), 0.1)
+        counters = np.array([1, 2, 0])[np.asarray(observations)[:, -1, 0]]
+        probs[np.arange(len(observations)), counters] = 0.8
+        return probs
+
+def test_context_index():
+    observation = np.zeros((OBSERVATION_LENGTH, 2), dtype=np.int8)
+    observation[-2:] = [[2, 1], [0, 2]]
+    assert(context_index(observation, 1) == 2)
+    assert(context_index(observation, 2) == 7 * 9 + 2)
+    assert(context_index(np.stack([observation] * 3), 2).tolist() == [65] * 3)
+
+def test_lookup_policy():
+    import tempfile
+    # 観測長はモデルの学習時の観測の形状に揃える
+    model = _LastMoveModel(length=10)
+    policy = distill(model, order=2, samples=4)
+    assert(policy.probs.shape == (81, 3))
+    assert(policy.observation_shape == (10, 2))
+    observations = holdout_observations(1000, policy.observation_shape)
+    report = agreement_report(model, policy, observations)
+    assert(report['agreement'] == 1.0)
+    assert(report['total_variation'] < 1e-6)
+    policy.agreement = report['agreement']
+    policy.source_digest = 'abc'
+    with tempfile.TemporaryDirectory() as dirname:
+        path = os.path.join(dirname, 'lookup.npz')
+        policy.save(path)
+        loaded = LookupPolicy.load(path)
+    assert(loaded.order == 2 and loaded.agreement == 1.0 and loaded.source_digest == 'abc')
+    assert(loaded.observation_shape == (10, 2))
+    actions, _ = loaded.predict(observations, deterministic=True)
+    assert((actions == np.array([1, 2, 0])[observations[:, -1, 0]]).all())
+    action, _ = loaded.predict(observations[0])
+    assert(action.shape == () and action in [0, 1, 2])
+
+if __name__ == '__main__':
+    from docopt import docopt
+    from model_registry import file_digest
+    from numpy_policy import load_model
+    args = docopt(__doc__)
+    model_path = args['<model_path>']
+    model = load_model(model_path)
+    seed = int(args['--seed'])
+    shape = model_observation_shape(model)
+    if args['--length'] is not None and int(args['--length']) != shape[0]:
+        raise ValueError(f'--length={args["--length"]}: model was trained with length {shape[0]}')
+    policy = distill(model, order=int(args['--order']),
+        samples=int(args['--samples']), observation_shape=shape, seed=seed)
+    observations = holdout_observations(int(args['--holdout']),
+        observation_shape=shape, seed=seed + 1, dataset_path=args['--dataset'])
+    report = agreement_report(model, policy, observations)
+    policy.agreement = report['agreement']
+    if not os.path.exists(model_path) and os.path.exists(model_path + '.zip'):
+        model_path = model_path + '.zip'
+    policy.source_digest = file_digest(model_path)
+    policy.save(args['<npz_path>'])
+    print(f'order={policy.order} entries={len(policy.probs)} ' + \
+        f'held-out={report["observations"]} agreement={report["agreement"]:.4f} ' + \
+        f'total_variation={report["total_variation"]:.4f}')
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus テキスト形式で出力するカウンタ・ゲージ・ヒストグラムを提供するモジュール。
+記録はスレッド毎の領域へ行い、ロックを取得するのはスレッドの初回記録時と
+出力時のみのため、リクエスト処理中のロック競合は発生しない。
+"""
+import threading
+from bisect import bisect_left
+
+# レイテンシヒストグラムの既定バケット（秒）
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+def _escape(value):
+    """
+    ラベル値をエスケープする。
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    """
+    ラベルを {name="value",...} 形式の文字列にする。
+    """
+    pairs = [f'{name}="{_escape(value)}"'
+        for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    """
+    値を文字列にする。
+    """
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Metric:
+    """
+    メトリクス基底クラス。
+    値はスレッド毎の辞書 {ラベル値のタプル: 値} へ記録し、出力時に合算する。
+    終了したスレッドの値は退避用辞書へ合算して保持する。
+    """
+    # 出力時の型名
+    TYPE = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        """
+        引数：
+            name        メトリクス名
+            help_text   説明
+            labelnames  ラベル名のタプル
+        戻り値：
+            なし
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (スレッド, スレッド毎の辞書) のリスト
+        self.shards = []
+        # 終了したスレッドの値
+        self.retired = {}
+        self.sweep_at = 64
+
+    def _shard(self):
+        """
+        呼び出しスレッドの記録先辞書を取得する。
+        """
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = {}
+            with self.lock:
+                if len(self.shards) >= self.sweep_at:
+                    self._sweep()
+                    self.sweep_at = max(64, 2 * len(self.shards))
+                self.shards.append((threading.current_thread(), shard))
+            self.local.shard = shard
+            return shard
+
+    def _sweep(self):
+        """
+        終了したスレッドの値を退避用辞書へ合算する（lock を取得した状態で呼び出すこと）。
+        """
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                for key, value in shard.items():
+                    self.retired[key] = self._merge(self.retired.get(key), value)
+        self.shards = alive
+
+    def _merge(self, total, value):
+        """
+        値を合算する。
+        """
+        return value if total is None else total + value
+
+    def collect(self):
+        """
+        全スレッドの値を合算する。
+        引数：
+            なし
+        戻り値：
+            {ラベル値のタプル: 値}
+        """
+        with self.lock:
+            self._sweep()
+            totals = dict(self.retired)
+            for _, shard in self.shards:
+                for key, value in list(shard.items()):
+                    totals[key] = self._merge(totals.get(key), value)
+        return totals
+
+    def samples(self):
+        """
+        出力する (サンプル名, ラベル文字列, 値) を生成する。
+        """
+        for key, value in sorted(self.collect().items()):
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def render(self):
+        """
+        Prometheus テキスト形式の文字列を取得する。
+        """
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.TYPE}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """
+    単調増加するカウンタ。
+    """
+    TYPE = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        """
+        カウンタを加算する。
+        引数：
+            labelvalues ラベル値
+            amount      加算値
+        戻り値：
+            なし
+        """
+        shard = self._shard()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+class Gauge(Metric):
+    """
+    増減する値。スレッド毎の増減を合算するか、出力時に callback の値を使用する。
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        """
+        引数：
+            name        メトリクス名
+            help_text   説明
+            labelnames  ラベル名のタプル
+            callback    出力時に {ラベル値のタプル: 値} を返す関数
+        戻り値：
+            なし
+        """
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+
+    def inc(self, *labelvalues, amount=1):
+        """
+        値を加算する。
+        """
+        shard = self._shard()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        """
+        値を減算する。
+        """
+        self.inc(*labelvalues, amount=-amount)
+
+    def collect(self):
+        if self.callback is not None:
+            return self.callback()
+        return super().collect()
+
+class Histogram(Metric):
+    """
+    値の分布を固定バケットで集計するヒストグラム。
+    スレッド毎に [各バケットの件数..., 合計, 件数] のリストを保持する。
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        引数：
+            name        メトリクス名
+            help_text   説明
+            labelnames  ラベル名のタプル
+            buckets     バケット上限値（昇順、+Inf は自動で追加）
+        戻り値：
+            なし
+        """
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, *labelvalues):
+        """
+        値を記録する。
+        引数：
+            value       記録する値
+            labelvalues ラベル値
+        戻り値：
+            なし
+        """
+        shard = self._shard()
+        counts = shard.get(labelvalues)
+        if counts is None:
+            counts = [0] * len(self.buckets) + [0.0, 0]
+            shard[labelvalues] = counts
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def _merge(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self):
+        for key, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + '_bucket', _format_labels(
+                    self.labelnames, key, [('le', _format_value(bound))]), cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield self.name + '_sum', labels, counts[-2]
+            yield self.name + '_count', labels, counts[-1]
+
+class MetricsRegistry:
+    """
+    メトリクスをまとめて出力するクラス。
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """
+        メトリクスを登録する。
+        引数：
+            metric  Metric インスタンス
+        戻り値：
+            登録した Metric インスタンス
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        """
+        全メトリクスを Prometheus テキスト形式で出力する。
+        """
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+# テスト
+
+def test_metrics():
+    from concurrent.futures import ThreadPoolExecutor
+    registry = MetricsRegistry()
+    requests = registry.counter('requests_total', 'requests', ('move',))
+    latency = registry.histogram('latency_seconds', 'latency', ('stage',),
+        buckets=(0.1, 1.0))
+    in_flight = registry.gauge('in_flight', 'in flight')
+    version = registry.gauge('model_version', 'version', callback=lambda: {(): 3})
+    def work(i):
+        in_flight.inc()
+        requests.inc(['goo', 'paa'][i % 2])
+        latency.observe(0.05 if i % 2 else 0.5, 'predict')
+        in_flight.dec()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(work, range(100)))
+    assert(requests.collect() == {('goo',): 50, ('paa',): 50})
+    assert(in_flight.collect() == {(): 0})
+    text = registry.render()
+    assert('requests_total{move="goo"} 50' in text)
+    assert('latency_seconds_bucket{stage="predict",le="0.1"} 50' in text)
+    assert('latency_seconds_bucket{stage="predict",le="+Inf"} 100' in text)
+    assert('latency_seconds_count{stage="predict"} 100' in text)
+    assert('# TYPE latency_seconds histogram' in text)
+    assert('model_version 3' in text)
+
+def test_metrics_retired_threads():
+    counter = Counter('c', 'c')
+    for _ in range(200):
+        thread = threading.Thread(target=counter.inc)
+        thread.start()
+        thread.join()
+    assert(len(counter.shards) < 200)
+    assert(counter.collect() == {(): 200})
+
+if __name__ == '__main__':
+    test_metrics()
+    test_metrics_retired_threads()
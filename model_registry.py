@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+学習済みモデルファイルの更新を検知し、バックグラウンドでロードした
+新しいバージョンへ差し替えるモデルレジストリを提供するモジュール。
+"""
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class ModelVersion:
+    """
+    ロード済みモデルとそのバージョン情報を保持するクラス。
+    インスタンスは差し替えのみ行い、変更しない。
+    """
+    def __init__(self, model, version, digest, mtime):
+        """
+        引数：
+            model       ロード済みモデル
+            version     バージョン番号（ロード毎に1ずつ増加）
+            digest      モデルファイルのSHA-256ハッシュ値
+            mtime       モデルファイルの更新時刻（ナノ秒）
+        戻り値：
+            なし
+        """
+        self.model = model
+        self.version = version
+        self.digest = digest
+        self.mtime = mtime
+
+    def info(self):
+        """
+        バージョン情報を辞書で取得する。
+        引数：
+            なし
+        戻り値：
+            バージョン情報辞書
+        """
+        return {
+            'model':    self.model.__class__.__name__,
+            'version':  self.version,
+            'hash':     self.digest,
+        }
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    ファイルのSHA-256ハッシュ値を算出する。
+    引数：
+        path        ファイルパス
+        chunk_size  読み込み単位（バイト）
+    戻り値：
+        16進ハッシュ文字列
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ModelRegistry:
+    """
+    モデルファイルの更新時刻・ハッシュ値を監視し、
+    変更があればバックグラウンドスレッドでロードして差し替えるクラス。
+    差し替えは参照の代入のみで行うため、current() で取得済みの
+    バージョンを使用中のリクエストは旧バージョンのまま完了する。
+    ロード用・監視スレッドはプロセス毎に start() で開始するため、
+    モデルをロードしてから fork した子プロセスでもそのまま使用できる。
+    """
+    def __init__(self, path, loader, poll_interval=None):
+        """
+        引数：
+            path            モデルファイルパス（PPO.load同様 .zip 省略可）
+            loader          モデルをロードする関数 loader(path)
+            poll_interval   更新監視間隔（秒）、None の場合監視しない
+        戻り値：
+            なし
+        """
+        self.path = path
+        self.loader = loader
+        self.poll_interval = poll_interval
+        self.version = None
+        self.lock = threading.Lock()
+        # スレッドを開始したプロセスID（未開始の場合None）
+        self.pid = None
+        self.executor = None
+        self.stopped = threading.Event()
+        self.watcher = None
+
+    def start(self):
+        """
+        現在のプロセスでロード用スレッドと監視スレッドを開始する。
+        開始済みの場合は何もしない。fork した子プロセスでは親のスレッドは
+        引き継がれないため、子プロセスで呼び出すと新たに開始する。
+        引数：
+            なし
+        戻り値：
+            なし
+        """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stopped = threading.Event()
+        self.watcher = None
+        if self.poll_interval is not None:
+            self.start_watching(self.poll_interval)
+
+    def resolve_file(self):
+        """
+        実際に読み込まれるモデルファイルのパスを取得する。
+        """
+        if not os.path.exists(self.path) and os.path.exists(self.path + '.zip'):
+            return self.path + '.zip'
+        return self.path
+
+    def current(self):
+        """
+        現在のモデルバージョンを取得する。
+        未ロードの場合はロードが完了するまで待つ。
+        引数：
+            なし
+        戻り値：
+            ModelVersion インスタンス
+        """
+        version = self.version
+        if version is None:
+            self.check()
+            version = self.version
+        return version
+
+    def check(self):
+        """
+        モデルファイルの更新時刻を確認し、変更されていればハッシュ値を比較し、
+        内容が変わっていればロードして差し替える。
+        引数：
+            なし
+        戻り値：
+            真：新しいバージョンへ差し替えた、偽：変更なし
+        """
+        with self.lock:
+            current = self.version
+            path = self.resolve_file()
+            mtime = os.stat(path).st_mtime_ns
+            if current is not None and mtime == current.mtime:
+                return False
+            digest = file_digest(path)
+            if current is not None and digest == current.digest:
+                # 内容は同一のため更新時刻のみ記録する
+                self.version = ModelVersion(
+                    current.model, current.version, digest, mtime)
+                return False
+            model = self.loader(self.path)
+            self.version = ModelVersion(model,
+                1 if current is None else current.version + 1, digest, mtime)
+            return True
+
+    def reload(self):
+        """
+        バックグラウンドスレッドで check() を実行する。
+        引数：
+            なし
+        戻り値：
+            check() の結果を返す Future
+        """
+        self.start()
+        return self.executor.submit(self.check)
+
+    def start_watching(self, poll_interval):
+        """
+        一定間隔で check() を実行する監視スレッドを開始する。
+        引数：
+            poll_interval   監視間隔（秒）
+        戻り値：
+            なし
+        """
+        def watch():
+            while not self.stopped.wait(poll_interval):
+                try:
+                    self.check()
+                except Exception as e:
+                    print(f'model reload failed: {e}')
+        self.watcher = threading.Thread(target=watch, daemon=True)
+        self.watcher.start()
+
+    def close(self):
+        """
+        監視スレッド・ロード用スレッドを終了する。
+        """
+        self.stopped.set()
+        if self.pid != os.getpid():
+            return
+        if self.watcher is not None:
+            self.watcher.join()
+        self.executor.shutdown()
+
+# テスト
+
+def test_model_registry():
+    import tempfile
+    import time
+    def loader(path):
+        with open(path) as f:
+            return f.read()
+    with tempfile.TemporaryDirectory() as dirname:
+        path = os.path.join(dirname, 'model')
+        with open(path, 'w') as f:
+            f.write('v1')
+        registry = ModelRegistry(path, loader)
+        first = registry.current()
+        assert(first.model == 'v1' and first.version == 1)
+        assert(registry.reload().result() == False)
+        # 内容が同一の場合は更新しない
+        os.utime(path, ns=(time.time_ns(), first.mtime + 10**9))
+        assert(registry.reload().result() == False)
+        assert(registry.current().version == 1)
+        with open(path, 'w') as f:
+            f.write('v2')
+        os.utime(path, ns=(time.time_ns(), first.mtime + 2 * 10**9))
+        assert(registry.reload().result() == True)
+        second = registry.current()
+        assert(second.model == 'v2' and second.version == 2)
+        assert(second.digest != first.digest)
+        assert(first.model == 'v1')
+        registry.close()
+
+def test_model_registry_fork():
+    import multiprocessing as mp
+    import tempfile
+    def loader(path):
+        with open(path) as f:
+            return f.read()
+    def child(registry, queue):
+        queue.put((registry.current().model, registry.reload().result(timeout=3)))
+        registry.close()
+    with tempfile.TemporaryDirectory() as dirname:
+        path = os.path.join(dirname, 'model')
+        with open(path, 'w') as f:
+            f.write('v1')
+        registry = ModelRegistry(path, loader)
+        # 親プロセスでスレッドを開始してから fork しても子プロセスで再開始する
+        registry.current()
+        assert(registry.reload().result() == False)
+        context = mp.get_context('fork')
+        queue = context.Queue()
+        process = context.Process(target=child, args=(registry, queue))
+        process.start()
+        assert(queue.get(timeout=5) == ('v1', False))
+        process.join()
+        registry.close()
+
+if __name__ == '__main__':
+    test_model_registry()
+    test_model_registry_fork()
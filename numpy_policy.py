@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+学習済みPPOモデル(MlpPolicy)の行動選択部分を .npz ファイルへ書き出し、
+NumPyのみで推論するためのモジュール。
+推論時は torch / stable_baselines3 をインポートしない。
+
+Usage:
+    numpy_policy.py <model_path> <npz_path>
+
+Arguments:
+    <model_path>    trained PPO model path (prob_ppo, pa_ppo, policy_ppo)
+    <npz_path>      output npz file path
+"""
+import numpy as np
+
+# 対応する活性化関数
+ACTIVATIONS = {
+    'Tanh':     np.tanh,
+    'ReLU':     lambda x: np.maximum(x, 0.0),
+    'Identity': lambda x: x,
+}
+
+def export_policy(model_path, npz_path):
+    """
+    学習済みPPOモデルをロードし、行動選択に必要な重みを .npz へ書き出す。
+    引数：
+        model_path  学習済みモデルファイルパス
+        npz_path    出力先 .npz ファイルパス
+    戻り値：
+        なし
+    """
+    from stable_baselines3 import PPO
+    model = PPO.load(model_path, device='cpu')
+    np.savez(npz_path, **policy_arrays(model))
+
+def policy_arrays(model):
+    """
+    ロード済みPPOモデルから行動選択に必要な重みを取り出す。
+    共有層(shared_net)・方策層(policy_net)・出力層(action_net)の順に格納する。
+    引数：
+        model       PPO インスタンス
+    戻り値：
+        {配列名: 配列}（.npz と同じ形式）
+    """
+    policy = model.policy
+    state = {key: value.detach().cpu().numpy()
+        for key, value in policy.state_dict().items()}
+    arrays = {}
+    layer_no = 0
+    for prefix in ['mlp_extractor.shared_net.', 'mlp_extractor.policy_net.']:
+        indices = sorted(int(key[len(prefix):].split('.')[0])
+            for key in state if key.startswith(prefix) and key.endswith('.weight'))
+        for index in indices:
+            arrays[f'weight_{layer_no}'] = state[f'{prefix}{index}.weight']
+            arrays[f'bias_{layer_no}'] = state[f'{prefix}{index}.bias']
+            layer_no += 1
+    arrays['action_weight'] = state['action_net.weight']
+    arrays['action_bias'] = state['action_net.bias']
+    arrays['num_layers'] = np.array(layer_no)
+    arrays['activation'] = np.array(policy.activation_fn.__name__)
+    arrays['observation_shape'] = np.array(policy.observation_space.shape)
+    return arrays
+
+class NumpyPolicy:
+    """
+    .npz に書き出された方策をNumPyのみで推論するクラス。
+    predict() は stable_baselines3 の predict() と同じ形式で返却するため、
+    AIPlayer やサーバの推論処理へそのまま渡すことができる。
+    """
+    def __init__(self, weights, biases, action_weight, action_bias,
+            activation='Tanh', observation_shape=(100, 2), seed=None):
+        """
+        重みを格納する。
+        引数：
+            weights             隠れ層の重みリスト (出力, 入力)
+            biases              隠れ層のバイアスリスト
+            action_weight       出力層の重み
+            action_bias         出力層のバイアス
+            activation          活性化関数名
+            observation_shape   観測の形状
+            seed                確率的行動選択に使用する乱数シード
+        戻り値：
+            なし
+        """
+        # 行列積を (N, 入力) @ (入力, 出力) で行うため転置して保持
+        self.weights = [np.ascontiguousarray(w.T, dtype=np.float32) for w in weights]
+        self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+        self.action_weight = np.ascontiguousarray(action_weight.T, dtype=np.float32)
+        self.action_bias = np.asarray(action_bias, dtype=np.float32)
+        self.activation_name = activation
+        self.activation = ACTIVATIONS[activation]
+        self.observation_shape = tuple(observation_shape)
+        self.rng = np.random.default_rng(seed)
+
+    @classmethod
+    def load(cls, npz_path, seed=None):
+        """
+        export_policy() で書き出した .npz から方策を生成する。
+        引数：
+            npz_path    .npz ファイルパス
+            seed        確率的行動選択に使用する乱数シード
+        戻り値：
+            NumpyPolicy インスタンス
+        """
+        with np.load(npz_path) as data:
+            return cls.from_arrays(data, seed=seed)
+
+    @classmethod
+    def from_arrays(cls, arrays, seed=None):
+        """
+        policy_arrays() 形式の配列辞書から方策を生成する。
+        引数：
+            arrays      {配列名: 配列}
+            seed        確率的行動選択に使用する乱数シード
+        戻り値：
+            NumpyPolicy インスタンス
+        """
+        num_layers = int(arrays['num_layers'])
+        return cls(
+            [arrays[f'weight_{i}'] for i in range(num_layers)],
+            [arrays[f'bias_{i}'] for i in range(num_layers)],
+            arrays['action_weight'], arrays['action_bias'],
+            activation=str(arrays['activation']),
+            observation_shape=np.asarray(arrays['observation_shape']).tolist(),
+            seed=seed)
+
+    @classmethod
+    def from_model(cls, model, seed=None):
+        """
+        ロード済みPPOモデルから方策を生成する。
+        引数：
+            model       PPO インスタンス
+            seed        確率的行動選択に使用する乱数シード
+        戻り値：
+            NumpyPolicy インスタンス
+        """
+        return cls.from_arrays(policy_arrays(model), seed=seed)
+
+    def action_logits(self, observations):
+        """
+        観測の配列から各行動のロジットを算出する。
+        引数：
+            observations    観測の配列 (N, 100, 2)
+        戻り値：
+            ロジット (N, 行動数)
+        """
+        x = np.asarray(observations, dtype=np.float32).reshape(len(observations), -1)
+        for weight, bias in zip(self.weights, self.biases):
+            x = self.activation(x @ weight + bias)
+        return x @ self.action_weight + self.action_bias
+
+    def action_probs(self, observations):
+        """
+        観測の配列から各行動の選択確率を算出する。
+        引数：
+            observations    観測の配列 (N, 100, 2)
+        戻り値：
+            選択確率 (N, 行動数)
+        """
+        logits = self.action_logits(observations)
+        logits = logits - logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        return probs / probs.sum(axis=1, keepdims=True)
+
+    def predict(self, observation, state=None, episode_start=None,
+            deterministic=False):
+        """
+        観測から行動を選択する。stable_baselines3 の predict() と同じ形式。
+        引数：
+            observation     観測 (100, 2) または観測の配列 (N, 100, 2)
+            state           使用しない
+            episode_start   使用しない
+            deterministic   真：最大確率の行動、偽：確率に従って抽選
+        戻り値：
+            actions         行動（単一観測の場合は0次元配列）
+            state           None
+        """
+        observations = np.asarray(observation)
+        vectorized = observations.shape != self.observation_shape
+        if not vectorized:
+            observations = observations[np.newaxis]
+        if deterministic:
+            actions = self.action_logits(observations).argmax(axis=1)
+        else:
+            cum_probs = np.cumsum(self.action_probs(observations), axis=1)
+            values = self.rng.random((len(observations), 1))
+            actions = (values > cum_probs[:, :-1]).sum(axis=1)
+        if not vectorized:
+            actions = actions[0]
+        return actions, None
+
+def action_probs(model, observations, chunk_size=4096):
+    """
+    学習済みモデルの各行動の選択確率を算出する。
+    引数：
+        model           学習済みモデル（PPO または NumpyPolicy）
+        observations    観測の配列 (N, length, 2)
+        chunk_size      1回の順伝播で処理する観測数
+    戻り値：
+        選択確率 (N, 行動数)
+    """
+    if hasattr(model, 'action_probs'):
+        return np.concatenate([model.action_probs(observations[i:i + chunk_size])
+            for i in range(0, len(observations), chunk_size)])
+    import torch
+    results = []
+    with torch.no_grad():
+        for i in range(0, len(observations), chunk_size):
+            obs_tensor, _ = model.policy.obs_to_tensor(observations[i:i + chunk_size])
+            results.append(model.policy.get_distribution(
+                obs_tensor).distribution.probs.cpu().numpy())
+    return np.concatenate(results)
+
+def load_model(path):
+    """
+    拡張子に応じて学習済みモデルをロードする。
+    .npz の場合は NumpyPolicy（参照テーブルの場合は LookupPolicy）、
+    それ以外は PPO としてロードする。
+    引数：
+        path    学習済みモデルファイルパス
+    戻り値：
+        モデルインスタンス
+    """
+    if str(path).endswith('.npz'):
+        with np.load(path) as data:
+            is_lookup = 'lookup_probs' in data.files
+        if is_lookup:
+            from lookup_policy import LookupPolicy
+            return LookupPolicy.load(path)
+        return NumpyPolicy.load(path)
+    from stable_baselines3 import PPO
+    return PPO.load(path)
+
+def model_observation_shape(model):
+    """
+    学習済みモデルの学習時の観測の形状を取得する。
+    引数：
+        model   NumpyPolicy / LookupPolicy（observation_shape）または PPO（observation_space）
+    戻り値：
+        観測の形状 (length, 2)
+    """
+    shape = getattr(model, 'observation_shape', None)
+    if shape is None:
+        shape = model.observation_space.shape
+    return tuple(int(size) for size in shape)
+
+# テスト
+
+def test_numpy_policy():
+    rng = np.random.default_rng(0)
+    policy = NumpyPolicy(
+        [rng.normal(size=(64, 200)), rng.normal(size=(64, 64))],
+        [rng.normal(size=64), rng.normal(size=64)],
+        rng.normal(size=(3, 64)), rng.normal(size=3), seed=0)
+    observations = rng.integers(0, 3, size=(500, 100, 2)).astype(np.int8)
+    probs = policy.action_probs(observations)
+    assert(np.allclose(probs.sum(axis=1), 1.0, atol=1e-5))
+    actions, _ = policy.predict(observations, deterministic=True)
+    assert((actions == probs.argmax(axis=1)).all())
+    action, _ = policy.predict(observations[0], deterministic=True)
+    assert(action.shape == () and action == actions[0])
+    actions, _ = policy.predict(observations)
+    assert(actions.shape == (500,) and np.isin(actions, [0, 1, 2]).all())
+
+def test_export_parity():
+    import os
+    import tempfile
+    import torch
+    from stable_baselines3 import PPO
+    from envs import ProbPlayer
+    from vec_envs import BatchRockPaperScissorsEnv
+    env = BatchRockPaperScissorsEnv(ProbPlayer(), num_envs=4)
+    model = PPO('MlpPolicy', env, n_steps=64, batch_size=64, device='cpu')
+    model.learn(total_timesteps=256)
+    observations = np.random.randint(0, 3, size=(256, 100, 2)).astype(np.int8)
+    with tempfile.TemporaryDirectory() as dirname:
+        model.save(os.path.join(dirname, 'model'))
+        export_policy(os.path.join(dirname, 'model'), os.path.join(dirname, 'model.npz'))
+        policy = NumpyPolicy.load(os.path.join(dirname, 'model.npz'))
+    expected, _ = model.predict(observations, deterministic=True)
+    actions, _ = policy.predict(observations, deterministic=True)
+    assert((actions == expected).all())
+    with torch.no_grad():
+        obs_tensor, _ = model.policy.obs_to_tensor(observations)
+        expected_probs = model.policy.get_distribution(
+            obs_tensor).distribution.probs.numpy()
+    assert(np.allclose(policy.action_probs(observations), expected_probs, atol=1e-5))
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    export_policy(args['<model_path>'], args['<npz_path>'])
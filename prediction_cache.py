@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+観測のハッシュ値をキーとして学習済みモデルの行動選択確率を保持する
+LRUキャッシュを提供するモジュール。
+確率をキャッシュして毎回抽選するため、キャッシュ使用時も行動の分布は変わらない。
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from envs import ObservationBuffer, observation_hash, observation_hashes
+from numpy_policy import action_probs
+
+class PredictionCache:
+    """
+    行動選択確率のLRUキャッシュクラス。
+    キャッシュはモデル単位で保持し、異なるモデル（リロード後の新バージョン）
+    で参照された時点で全件破棄する。
+    """
+    def __init__(self, max_size=65536, seed=None):
+        """
+        引数：
+            max_size    最大保持件数
+            seed        行動の抽選に使用する乱数シード
+        戻り値：
+            なし
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.model = None
+        self.lock = threading.Lock()
+        self.rng = np.random.default_rng(seed)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _sample(self, cum_probs):
+        """
+        累積確率に従って行動を抽選する（lock を取得した状態で呼び出すこと）。
+        """
+        return int((self.rng.random() > cum_probs[:-1]).sum())
+
+    def _check_model(self, model):
+        """
+        モデルが変わっていればキャッシュを破棄する（lock を取得した状態で呼び出すこと）。
+        """
+        if model is not self.model:
+            if self.entries:
+                self.entries.clear()
+                self.invalidations += 1
+            self.model = model
+
+    def get(self, key, model):
+        """
+        キャッシュした確率に従って行動を抽選する。
+        引数：
+            key         観測のハッシュ値
+            model       推論に使用するモデル
+        戻り値：
+            行動（キャッシュに存在しない場合None）
+        """
+        with self.lock:
+            self._check_model(model)
+            cum_probs = self.entries.get(key)
+            if cum_probs is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self._sample(cum_probs)
+
+    def put(self, key, probs, model):
+        """
+        行動選択確率を格納し、その確率に従って行動を抽選する。
+        引数：
+            key         観測のハッシュ値
+            probs       行動選択確率
+            model       確率を算出したモデル
+        戻り値：
+            行動
+        """
+        cum_probs = np.cumsum(probs)
+        with self.lock:
+            self._check_model(model)
+            self.entries[key] = cum_probs
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            return self._sample(cum_probs)
+
+    def predict(self, observation, model):
+        """
+        キャッシュを参照し、存在しない場合はモデルで確率を算出して行動を選択する。
+        引数：
+            observation     観測（ObservationBuffer の場合は保持するハッシュ値を使用）
+            model           推論に使用するモデル
+        戻り値：
+            行動
+        """
+        if isinstance(observation, ObservationBuffer):
+            key = observation.hash_value
+            observation = observation.view()
+        else:
+            observation = np.asarray(observation)
+            key = observation_hash(observation)
+        action = self.get(key, model)
+        if action is None:
+            action = self.put(key,
+                action_probs(model, observation[np.newaxis])[0], model)
+        return action
+
+    def predict_batch(self, observations, model):
+        """
+        複数の観測それぞれに対する行動をキャッシュを参照して選択する。
+        キャッシュに存在しない観測のみまとめて1回の順伝播で確率を算出する。
+        引数：
+            observations    観測の配列 (N, length, 2)
+            model           推論に使用するモデル
+        戻り値：
+            行動の配列 (N,)
+        """
+        observations = np.asarray(observations)
+        keys = observation_hashes(observations).tolist()
+        if not keys:
+            return np.empty(0, dtype=np.int64)
+        missing = []
+        with self.lock:
+            self._check_model(model)
+            found = []
+            for i, key in enumerate(keys):
+                entry = self.entries.get(key)
+                if entry is None:
+                    missing.append(i)
+                else:
+                    self.entries.move_to_end(key)
+                    found.append(entry)
+            self.hits += len(found)
+            self.misses += len(missing)
+        if missing:
+            probs = action_probs(model, observations[missing])
+        with self.lock:
+            self._check_model(model)
+            for i, row in zip(missing, np.cumsum(probs, axis=1) if missing else []):
+                self.entries[keys[i]] = row
+                self.entries.move_to_end(keys[i])
+                found.insert(i, row)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            cum_probs = np.array(found)
+            values = self.rng.random((len(keys), 1))
+        return (values > cum_probs[:, :-1]).sum(axis=1)
+
+    def clear(self):
+        """
+        キャッシュを全件破棄する。
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        キャッシュの統計情報を取得する。
+        引数：
+            なし
+        戻り値：
+            統計情報辞書
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'size':             len(self.entries),
+                'max_size':         self.max_size,
+                'hits':             self.hits,
+                'misses':           self.misses,
+                'hit_rate':         self.hits / requests if requests > 0 else 0.0,
+                'evictions':        self.evictions,
+                'invalidations':    self.invalidations,
+            }
+
+# テスト
+
+class _CountingModel:
+    def __init__(self, action=0):
+        self.calls = 0
+        self.action = action
+    def action_probs(self, observations):
+        self.calls += 1
+        probs = np.zeros((len(observations), 3))
+        probs[:, self.action] = 1.0
+        return probs
+
+def test_prediction_cache():
+    model = _CountingModel(action=2)
+    cache = PredictionCache(max_size=2)
+    buffer = ObservationBuffer(length=3, observation=[[0, 1], [1, 0], [2, 2]])
+    assert(cache.predict(buffer, model) == 2)
+    assert(cache.predict(buffer.view(), model) == 2)
+    assert(model.calls == 1)
+    for i in range(2):
+        buffer.push(i, i)
+        cache.predict(buffer, model)
+    stats = cache.stats()
+    assert((stats['hits'], stats['misses'], stats['evictions']) == (1, 3, 1))
+    assert(stats['size'] == 2)
+    # モデルが変わるとキャッシュを破棄する
+    new_model = _CountingModel(action=1)
+    assert(cache.predict(buffer, new_model) == 1)
+    assert(new_model.calls == 1)
+    assert(cache.stats()['invalidations'] == 1)
+    assert(cache.stats()['size'] == 1)
+
+def test_ai_player_cache():
+    from envs import AIPlayer
+    model = _CountingModel(action=1)
+    player = AIPlayer(model, cache_size=16)
+    observation = np.zeros((100, 2), dtype=np.int8)
+    assert([player.predict(observation) for _ in range(5)] == [1] * 5)
+    assert(model.calls == 1)
+    # バッチ推論もキャッシュを参照し、存在しない観測のみ順伝播する
+    observations = np.zeros((4, 100, 2), dtype=np.int8)
+    observations[1:, -1] = [[0, 1], [1, 0], [0, 1]]
+    assert((player.predict_batch(observations) == 1).all())
+    assert(model.calls == 2)
+    assert(player.cache.stats()['size'] == 3)
+    player.predict_batch(observations)
+    assert(model.calls == 2)
+
+def test_env_step_cache():
+    from envs import AIPlayer, RockPaperScissorsEnv
+    model = _CountingModel(action=2)
+    player = AIPlayer(model, cache_size=16)
+    env = RockPaperScissorsEnv(player, seed=0)
+    # 環境は ObservationBuffer を渡すため、保持するハッシュ値がキーとなる
+    keys = []
+    for _ in range(3):
+        keys.append(env.observation.hash_value)
+        env.step(0)
+    assert(list(player.cache.entries) == keys)
+    assert(model.calls == 3)
+
+if __name__ == '__main__':
+    test_prediction_cache()
+    test_ai_player_cache()
+    test_env_step_cache()
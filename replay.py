@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Webアプリケーションで記録した人間との対戦履歴（trajectory.py 形式）から
+リプレイデータセットを構築し、学習済みモデルをオフライン学習するモジュール。
+
+データセットはディレクトリに以下を格納する：
+    actions.npy     [人間の行動, モデルの行動] (行数, 2) int8
+                    セッション毎に先頭へ観測初期値（乱数）を観測長分挿入し、
+                    セッション単位で連続させたもの
+    offsets.npy     各セッションの開始行 (セッション数 + 1,) int64
+観測（直近 length 手）は stride tricks によるビューとして切り出すため、
+ウィンドウ毎のコピーは発生せず、メモリマップでRAMを超えるデータセットも扱える。
+
+Usage:
+    replay.py ingest <dataset> <trajectory>... [--length=<n>]
+    replay.py train <dataset> [--model_path=<path>] [--output=<path>] [--mode=<mode>] [--epochs=<epochs>] [--batch_size=<batch_size>] [--learning_rate=<lr>] [--length=<n>]
+    replay.py retrain <dataset> <trajectory>... [--model_path=<path>] [--output=<path>] [--mode=<mode>] [--epochs=<epochs>] [--batch_size=<batch_size>] [--learning_rate=<lr>] [--length=<n>]
+
+Options:
+    --model_path=<path>         initial model path (default: new PPO model)
+    --output=<path>             output model path [default: replay_ppo]
+    --mode=<mode>               counter: learn the move beating the human's next move,
+                                clone: imitate the human's next move [default: counter]
+    --epochs=<epochs>           number of passes over the dataset [default: 1]
+    --batch_size=<batch_size>   minibatch size [default: 256]
+    --learning_rate=<lr>        Adam learning rate [default: 0.0003]
+    --length=<n>                observation window (default: the initial model's training length, 100 for a new model)
+"""
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from envs import COUNTER_ACTIONS, OBSERVATION_LENGTH
+from trajectory import read_trajectory
+
+def ingest(trajectory_paths, dataset_path, length=OBSERVATION_LENGTH, seed=0, chunk_size=1 << 20):
+    """
+    対戦履歴ファイルを(エピソード, ステップ, ファイル順)順に並べ替え、
+    セッション毎に観測初期値を挿入したデータセットを書き出す。
+    ステップ番号はセッション内の対戦の通し番号のため、複数のサーバプロセスが
+    書き出したファイルを混ぜて渡しても各セッションの対戦順に並ぶ。
+    引数：
+        trajectory_paths    対戦履歴ファイルパスのリスト
+        dataset_path        出力先データセットディレクトリ
+        length              観測長
+        seed                観測初期値の乱数シード
+        chunk_size          1回に書き込むレコード数
+    戻り値：
+        (セッション数, レコード数)
+    """
+    records = [read_trajectory(path) for path in trajectory_paths]
+    episodes = np.concatenate([r['episode'] for r in records])
+    steps = np.concatenate([r['step'] for r in records])
+    files = np.concatenate([np.full(len(r), i, dtype=np.int32)
+        for i, r in enumerate(records)])
+    order = np.lexsort((files, steps, episodes))
+    del steps, files
+    sorted_episodes = episodes[order]
+    del episodes
+    new_session = np.ones(len(order), dtype=bool)
+    new_session[1:] = sorted_episodes[1:] != sorted_episodes[:-1]
+    del sorted_episodes
+    session_index = np.cumsum(new_session) - 1
+    sessions = int(session_index[-1]) + 1 if len(order) > 0 else 0
+    # 各レコードの書き込み先行：先行するセッション分の観測初期値を加算
+    destinations = np.arange(len(order)) + (session_index + 1) * length
+    session_starts = np.flatnonzero(new_session)
+    offsets = np.append(session_starts + np.arange(sessions) * length,
+        len(order) + sessions * length).astype(np.int64)
+    del new_session, session_index
+
+    os.makedirs(dataset_path, exist_ok=True)
+    total = len(order) + sessions * length
+    actions = np.lib.format.open_memmap(os.path.join(dataset_path, 'actions.npy'),
+        mode='w+', dtype=np.int8, shape=(total, 2))
+    rng = np.random.default_rng(seed)
+    for start in range(0, total, chunk_size):
+        end = min(start + chunk_size, total)
+        actions[start:end] = rng.integers(0, 2, size=(end - start, 2), dtype=np.int8)
+    # ファイル毎の先頭位置
+    file_starts = np.cumsum([0] + [len(r) for r in records])
+    for start in range(0, len(order), chunk_size):
+        chunk = order[start:start + chunk_size]
+        file_index = np.searchsorted(file_starts, chunk, side='right') - 1
+        values = np.empty((len(chunk), 2), dtype=np.int8)
+        for i, r in enumerate(records):
+            mask = file_index == i
+            if mask.any():
+                rows = chunk[mask] - file_starts[i]
+                values[mask, 0] = r['policy_action'][rows]
+                values[mask, 1] = r['env_action'][rows]
+        actions[destinations[start:start + chunk_size]] = values
+    actions.flush()
+    del actions
+    np.save(os.path.join(dataset_path, 'offsets.npy'), offsets)
+    return sessions, len(order)
+
+class ReplayDataset:
+    """
+    リプレイデータセットクラス。
+    (観測, 人間の次の行動) の組をミニバッチ単位で逐次生成する。
+    """
+    def __init__(self, dataset_path, length=OBSERVATION_LENGTH):
+        """
+        データセットをメモリマップで開く。
+        引数：
+            dataset_path    データセットディレクトリ
+            length          観測長
+        戻り値：
+            なし
+        """
+        self.length = length
+        self.actions = np.load(os.path.join(dataset_path, 'actions.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(dataset_path, 'offsets.npy'))
+        # 観測長+1 行（観測と次の行動）のウィンドウビュー（コピーなし）
+        self.windows = sliding_window_view(self.actions, (length + 1, 2))[:, 0]
+
+    def __len__(self):
+        """
+        サンプル数（各セッションの行数 - 観測長 の合計）。
+        """
+        return int(np.maximum(np.diff(self.offsets) - self.length, 0).sum())
+
+    def window_starts(self, sessions):
+        """
+        指定セッションの有効なウィンドウ開始行を取得する。
+        ウィンドウはセッションをまたがない。
+        引数：
+            sessions    セッション番号の配列
+        戻り値：
+            ウィンドウ開始行の配列
+        """
+        starts = self.offsets[sessions]
+        counts = np.maximum(self.offsets[sessions + 1] - starts - self.length, 0)
+        base = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return base + np.arange(counts.sum())
+
+    def iter_batches(self, batch_size=256, shuffle=True, seed=0, sessions_per_chunk=4096):
+        """
+        (観測, 人間の次の行動) のミニバッチを逐次生成する。
+        セッションをチャンク単位で読み込み、チャンク内でシャッフルするため、
+        メモリ使用量はデータセットの大きさによらない。
+        引数：
+            batch_size          ミニバッチサイズ
+            shuffle             真：セッション順・チャンク内の順序をシャッフルする
+            seed                シャッフルの乱数シード
+            sessions_per_chunk  1チャンクのセッション数
+        戻り値：
+            (観測 (B, length, 2) int8, 人間の次の行動 (B,) int64) を返すジェネレータ
+        """
+        rng = np.random.default_rng(seed)
+        sessions = np.arange(len(self.offsets) - 1)
+        if shuffle:
+            rng.shuffle(sessions)
+        for chunk_start in range(0, len(sessions), sessions_per_chunk):
+            starts = self.window_starts(sessions[chunk_start:chunk_start + sessions_per_chunk])
+            if shuffle:
+                rng.shuffle(starts)
+            for start in range(0, len(starts), batch_size):
+                windows = self.windows[np.sort(starts[start:start + batch_size])]
+                yield windows[:, :self.length], windows[:, self.length, 0].astype(np.int64)
+
+def train_offline(dataset, model, mode='counter', epochs=1, batch_size=256,
+        learning_rate=3e-4):
+    """
+    リプレイデータセットで方策を教師あり学習する。
+    counter の場合は人間の次の手に勝つ手、clone の場合は人間の次の手を正解とし、
+    正解行動の対数尤度を最大化する。正解が行動空間外のサンプルは使用しない。
+    引数：
+        dataset         ReplayDataset インスタンス
+        model           学習対象 PPO モデル
+        mode            counter または clone
+        epochs          データセットを走査する回数
+        batch_size      ミニバッチサイズ
+        learning_rate   Adam の学習率
+    戻り値：
+        最終エポックの平均損失
+    """
+    import torch
+    if mode not in ['counter', 'clone']:
+        raise ValueError(f'mode={mode}: no match argument')
+    policy = model.policy
+    policy.set_training_mode(True)
+    optimizer = torch.optim.Adam(policy.parameters(), lr=learning_rate)
+    n_actions = model.action_space.n
+    mean_loss = None
+    for epoch in range(epochs):
+        total_loss, batches = 0.0, 0
+        for observations, human_actions in dataset.iter_batches(batch_size, seed=epoch):
+            targets = COUNTER_ACTIONS[human_actions] if mode == 'counter' else human_actions
+            mask = targets < n_actions
+            if not mask.any():
+                continue
+            obs_tensor, _ = policy.obs_to_tensor(np.ascontiguousarray(observations[mask]))
+            actions = torch.as_tensor(targets[mask], device=policy.device)
+            _, log_prob, _ = policy.evaluate_actions(obs_tensor, actions)
+            loss = -log_prob.mean()
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item()
+            batches += 1
+        mean_loss = total_loss / max(batches, 1)
+        print(f'epoch {epoch}: {batches} batches, loss {mean_loss:.4f}')
+    policy.set_training_mode(False)
+    return mean_loss
+
+def load_or_create_model(model_path=None, length=None):
+    """
+    学習済みモデルをロードする。指定がない場合は新規PPOモデルを生成する。
+    引数：
+        model_path  学習済みモデルファイルパス（None の場合は新規生成）
+        length      観測長（None の場合はロードしたモデルの学習時の観測長、
+                    新規生成時は OBSERVATION_LENGTH）
+    戻り値：
+        PPO モデル
+    """
+    from stable_baselines3 import PPO
+    if model_path is not None:
+        model = PPO.load(model_path)
+        trained = model.observation_space.shape[0]
+        if length is not None and length != trained:
+            raise ValueError(f'length={length}: model was trained with length {trained}')
+        return model
+    from envs import Player
+    from vec_envs import BatchRockPaperScissorsEnv
+    return PPO('MlpPolicy', BatchRockPaperScissorsEnv(Player(), num_envs=1,
+        length=OBSERVATION_LENGTH if length is None else length))
+
+# テスト
+
+def test_replay_dataset():
+    import tempfile
+    from trajectory import TrajectoryWriter
+    with tempfile.TemporaryDirectory() as dirname:
+        paths = [os.path.join(dirname, f'day{i}.bin') for i in range(2)]
+        # 2プロセスで記録：セッション7は交互に計5手、セッション3は1手（順不同で記録）
+        with TrajectoryWriter(paths[0]) as writer:
+            writer.write(7, 1, 0, 1, -10)
+            writer.write(3, 1, 2, 2, -1)
+            writer.write(7, 3, 2, 1, 10)
+            writer.write(7, 2, 1, 1, -1)
+        with TrajectoryWriter(paths[1]) as writer:
+            writer.write(7, 5, 1, 0, 10)
+            writer.write(7, 4, 0, 0, -1)
+        dataset_path = os.path.join(dirname, 'dataset')
+        assert(ingest(paths, dataset_path, length=4) == (2, 6))
+        dataset = ReplayDataset(dataset_path, length=4)
+        assert(dataset.offsets.tolist() == [0, 5, 14])
+        assert(dataset.actions[4].tolist() == [2, 2])
+        assert(dataset.actions[9:].tolist() == [[0, 1], [1, 1], [2, 1], [0, 0], [1, 0]])
+        assert(np.shares_memory(dataset.windows, dataset.actions))
+        assert(len(dataset) == 1 + 5)
+        batches = list(dataset.iter_batches(batch_size=4, shuffle=False))
+        observations = np.concatenate([b[0] for b in batches])
+        targets = np.concatenate([b[1] for b in batches])
+        assert(observations.shape == (6, 4, 2))
+        assert(targets.tolist() == [2, 0, 1, 2, 0, 1])
+        assert(observations[-1].tolist() == [[0, 1], [1, 1], [2, 1], [0, 0]])
+        del dataset
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    length = None if args['--length'] is None else int(args['--length'])
+    model = None
+    if args['train'] or args['retrain']:
+        # 観測長は学習対象モデルの学習時の観測長に揃える
+        model = load_or_create_model(args['--model_path'], length=length)
+        length = model.observation_space.shape[0]
+    if length is None:
+        length = OBSERVATION_LENGTH
+    if args['ingest'] or args['retrain']:
+        sessions, records = ingest(args['<trajectory>'], args['<dataset>'], length=length)
+        print(f'ingested {records} records in {sessions} sessions')
+    if model is not None:
+        train_offline(ReplayDataset(args['<dataset>'], length=length), model,
+            mode=args['--mode'], epochs=int(args['--epochs']),
+            batch_size=int(args['--batch_size']),
+            learning_rate=float(args['--learning_rate']))
+        model.save(args['--output'])
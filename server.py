@@ -7,49 +7,469 @@ Setup:
     pip install docopt flask stable-baselines3
 
 Usage:
-    server.py [--debug] [--model_path=<target_model_path>]
+    server.py [--debug] [--model_path=<target_model_path>] [--session_store=<store>] [--session_path=<path>] [--length=<n>] [--batch_size=<n>] [--batch_wait_ms=<ms>] [--warm_up] [--watch_interval=<sec>] [--trajectory_path=<path>] [--lookup_path=<path>] [--lookup_threshold=<rate>] [--cache_size=<n>] [--models=<spec>]
 
 Options:
     --debug                             set debug on flask
-    --model_path=<target_model_path>    set target model path
+    --model_path=<target_model_path>    set target model path (*.npz: numpy policy)
+    --session_store=<store>             session store: memory or sqlite [default: memory]
+    --session_path=<path>               sqlite session store file path [default: sessions.sqlite3]
+    --length=<n>                        observation window (past rounds kept per session,
+                                        default: the models' training observation length)
+    --batch_size=<n>                    max requests per batched inference [default: 32]
+    --batch_wait_ms=<ms>                max wait time to collect a batch [default: 2]
+    --warm_up                           load model and run first inference before serving
+    --watch_interval=<sec>              poll model file for updates every <sec> seconds
+    --trajectory_path=<path>            append every round to a binary trajectory file
+                                        (process id is added before the extension)
+    --lookup_path=<path>                lookup table distilled from the model (lookup_policy.py)
+    --lookup_threshold=<rate>           min agreement to answer from the lookup table [default: 0.95]
+    --cache_size=<n>                    cached observations for model inference (0: disabled) [default: 65536]
+    --models=<spec>                     serve several models, sessions split by weight
+                                        (e.g. prob=prob_ppo:2,pa=pa_ppo:1,policy=policy_ppo:1)
 """
+import atexit
+import hashlib
+import os
+import threading
+import time
+# 起動時間計測開始
+STARTED = time.perf_counter()
 from docopt import docopt
-from flask import Flask, jsonify, render_template, session
-from stable_baselines3 import PPO
+from flask import Flask, Response, jsonify, render_template, request, session
 from envs import RockPaperScissorsEnv as env
+from ab_testing import ModelAssigner, parse_model_specs
+from inference import BatchPredictor
+from lookup_policy import LookupPolicy
+from metrics import MetricsRegistry
+from model_registry import ModelRegistry
+from numpy_policy import load_model as load_model_file, model_observation_shape
+from prediction_cache import PredictionCache
+from sessions import MemorySessionStore, SqliteSessionStore
+from trajectory import TrajectoryWriter
 
-# 方策のロード
+# 方策のパス（ロードは初回リクエスト時またはwarm_up()呼び出し時）
 PATH = 'prob_ppo' # 1/3の確率で手を出す環境相手に学習
 #PATH = 'pa_ppo' # つねにパーを出す環境相手に学習
 #PATH = 'policy_ppo' # prob_ppoを相手に学習
-model = PPO.load(PATH)
+# 同時に提供するモデル [(モデルID, パス, 重み), ...]（None の場合 PATH のみ）
+# セッション毎に重みに応じていずれかのモデルへ割り当てる
+MODELS = None
+# マイクロバッチ推論設定
+BATCH_SIZE = 32
+BATCH_WAIT = 0.002
+# モデルファイル更新監視間隔（秒）、None の場合は /reload 時のみ確認
+WATCH_INTERVAL = None
+# 参照テーブルのパスと使用する一致率の下限（None の場合参照テーブルを使用しない）
+LOOKUP_PATH = None
+LOOKUP_THRESHOLD = 0.95
+# 行動選択確率キャッシュの最大件数（0 の場合キャッシュしない）
+CACHE_SIZE = 65536
+# モデルID毎のバージョン管理（最初のモデルを既定のモデルとする）
+registries = None
+# セッションのモデルへの割り当て
+assigner = None
+# モデルから蒸留した参照テーブル
+lookup = None
+# 同時リクエストをまとめて推論するスケジューラ
+predictor = None
+# 推論スケジューラ・モデルレジストリのスレッドを開始したプロセスID
+# （fork した子プロセスでは最初のリクエスト時に開始し直す）
+worker_pid = None
+# モデルID毎の、観測のハッシュ値をキーとする行動選択確率キャッシュ
+# （モデル差し替え時は自動で破棄）
+caches = {}
+model_lock = threading.Lock()
+# 起動時間内訳（秒）
+startup_times = {'imports': time.perf_counter() - STARTED}
 
 
 # アプリケーションオブジェクト生成
 app = Flask(__name__)
 # session 用シークレットキー
 app.secret_key='rock-paper-scissors'
+# 観測を保持するセッションストア（クッキーにはセッションIDのみ格納）
+store = MemorySessionStore()
+# 対戦履歴の書き込み先（None の場合記録しない）
+# エピソード番号はセッションIDの64ビットハッシュ値、ステップ番号はセッション内の対戦の通し番号
+# （セッションストアに保持するため、複数ワーカープロセスで記録しても対戦順に並べられる）
+recorder = None
 
-def predict(my_action, obs):
+# /metrics で出力するメトリクス（スレッド毎に記録するためロック競合なし）
+metrics = MetricsRegistry()
+# 行動毎のリクエスト数（添字は行動）
+MOVE_NAMES = ['goo', 'paa', 'choki']
+request_counter = metrics.counter('rps_requests_total',
+    'Number of /pon requests by the player\'s move and served model.', ('move', 'model'))
+in_flight_gauge = metrics.gauge('rps_requests_in_flight',
+    'Number of /pon requests being processed.')
+stage_histogram = metrics.histogram('rps_request_stage_seconds',
+    'Latency of each /pon request processing stage in seconds.', ('stage',))
+request_histogram = metrics.histogram('rps_request_seconds',
+    'Total latency of /pon requests in seconds by served model.', ('model',))
+outcome_counter = metrics.counter('rps_game_outcomes_total',
+    'Number of rounds by outcome from the player\'s side and served model.',
+    ('outcome', 'model'))
+metrics.gauge('rps_model_version',
+    'Version number and hash of each served model.', ('model', 'hash'),
+    callback=lambda: {} if registries is None else {
+        (model_id, r.version.digest): r.version.version
+        for model_id, r in registries.items() if r.version is not None})
+
+def model_specs():
+    """
+    提供するモデルの一覧を取得する。
+    引数：
+        なし
+    戻り値：
+        [(モデルID, パス, 重み), ...]
+    """
+    if MODELS is not None:
+        return MODELS
+    return [(os.path.basename(PATH.rstrip('/')), PATH, 1.0)]
+
+def init_model():
+    """
+    モデルレジストリ経由で全モデルをロードして初回推論を行う。
+    モデルはプロセス内で1回だけロードし、全セッション・スレッドで共有する。
+    スレッドは開始しないため、呼び出し後に fork した子プロセスでも
+    ロード済みのモデルをそのまま使用できる。
+    フレームワークのインポート・ロード・初回推論の時間を記録して表示する。
+    model_lock を取得した状態で呼び出すこと。
+    引数：
+        なし
+    戻り値：
+        なし
+    """
+    global registries, assigner, lookup, caches
+    specs = model_specs()
+    started = time.perf_counter()
+    if not all(path.endswith('.npz') for _, path, _ in specs):
+        import stable_baselines3
+    imported = time.perf_counter()
+    new_registries = {model_id: ModelRegistry(path, load_model_file,
+        poll_interval=WATCH_INTERVAL) for model_id, path, _ in specs}
+    versions = [r.current() for r in new_registries.values()]
+    loaded = time.perf_counter()
+    for model_id, version in zip(new_registries, versions):
+        check_length(model_id, version.model, store.length)
+    for version in versions:
+        version.model.predict(store.new_observation().view())
+    inferred = time.perf_counter()
+    startup_times.update({
+        'framework_imports':    imported - started,
+        'model_load':           loaded - imported,
+        'first_inference':      inferred - loaded,
+    })
+    if LOOKUP_PATH is not None:
+        lookup = load_lookup(LOOKUP_PATH, LOOKUP_THRESHOLD)
+    if CACHE_SIZE > 0:
+        caches = {model_id: PredictionCache(CACHE_SIZE) for model_id in new_registries}
+    assigner = ModelAssigner({model_id: weight for model_id, _, weight in specs})
+    registries = new_registries
+    print('startup time: ' + ', '.join(
+        f'{key}={value:.3f}sec' for key, value in startup_times.items()))
+
+def check_length(model_id, model, length):
+    """
+    モデルの学習時の観測長がセッションの観測長と一致することを確認する。
+    一致しない場合は推論時に形状エラーとなるため ValueError を送出する。
+    引数：
+        model_id    モデルID
+        model       ロード済みモデル
+        length      セッションの観測長
+    戻り値：
+        なし
+    """
+    model_length = model_observation_shape(model)[0]
+    if model_length != length:
+        raise ValueError(f'length={length}: model {model_id} was trained with '
+            f'observation length {model_length}')
+
+def model_length():
+    """
+    提供する全モデルの学習時の観測長を取得する（モデルファイルを読み込む）。
+    モデル毎に観測長が異なる場合は1つのセッションストアで提供できないため ValueError を送出する。
+    引数：
+        なし
+    戻り値：
+        観測長
+    """
+    lengths = {model_id: model_observation_shape(load_model_file(path))[0]
+        for model_id, path, _ in model_specs()}
+    if len(set(lengths.values())) > 1:
+        raise ValueError(f'models were trained with different observation lengths: {lengths}')
+    return next(iter(lengths.values()))
+
+def load_lookup(path, threshold):
+    """
+    参照テーブルをロードする。
+    一致率が下限に満たない場合は使用しない。
+    引数：
+        path        参照テーブルファイルパス
+        threshold   一致率の下限
+    戻り値：
+        LookupPolicy インスタンス（使用しない場合None）
+    """
+    table = LookupPolicy.load(path)
+    if table.agreement is None or table.agreement < threshold:
+        print(f'lookup table {path} not used: agreement={table.agreement} ' + \
+            f'< threshold={threshold}')
+        return None
+    return table
+
+def start_workers(batch=True):
+    """
+    現在のプロセスでモデルレジストリのロード用・監視スレッドを開始し、
+    推論スケジューラを生成する。
+    model_lock を取得した状態で、init_model() の後に呼び出すこと。
+    引数：
+        batch   真：マイクロバッチ推論スケジューラ（BatchPredictor）を生成する
+    戻り値：
+        なし
+    """
+    global predictor, worker_pid
+    for registry in registries.values():
+        registry.start()
+    if batch:
+        predictor = BatchPredictor(max_batch=BATCH_SIZE, max_wait=BATCH_WAIT)
+    worker_pid = os.getpid()
+
+def load_models():
+    """
+    モデルID毎のモデルレジストリを取得する。
+    未生成の場合はモデルをロードして生成する（スレッドセーフ）。
+    スレッドは開始しない。
+    引数：
+        なし
+    戻り値：
+        {モデルID: ModelRegistry インスタンス}
+    """
+    if registries is None:
+        with model_lock:
+            if registries is None:
+                init_model()
+    return registries
+
+def get_registries():
+    """
+    モデルID毎のモデルレジストリを取得する。
+    未生成の場合はモデルをロードし、現在のプロセスでスレッドを
+    開始していない場合は開始する（スレッドセーフ）。
+    引数：
+        なし
+    戻り値：
+        {モデルID: ModelRegistry インスタンス}
+    """
+    if registries is None or worker_pid != os.getpid():
+        with model_lock:
+            if registries is None:
+                init_model()
+            if worker_pid != os.getpid():
+                start_workers()
+    return registries
+
+def get_registry(model_id=None):
+    """
+    モデルレジストリを取得する。
+    引数：
+        model_id    モデルID（None の場合既定のモデル）
+    戻り値：
+        ModelRegistry インスタンス
+    """
+    current = get_registries()
+    if model_id is None:
+        return next(iter(current.values()))
+    return current[model_id]
+
+def assign_model(session_id):
+    """
+    セッションを割り当てるモデルIDを取得する。
+    引数：
+        session_id  セッションID
+    戻り値：
+        モデルID
+    """
+    get_registries()
+    return assigner.assign(session_id)
+
+def warm_up():
+    """
+    初回リクエストを待たずにモデルのロードと初回推論を行う。
+    WSGIサーバのプリロード時などに呼び出す。
+    スレッドは開始しないため、呼び出し後に fork した各ワーカープロセスでは
+    最初のリクエスト時に推論スケジューラ等のスレッドを開始する。
+    引数：
+        なし
+    戻り値：
+        起動時間内訳辞書
+    """
+    load_models()
+    return dict(startup_times)
+
+def get_session_id():
+    """
+    クッキー上のセッションIDを取得する。
+    存在しない場合は新規に生成してクッキーへ格納する。
+    引数：
+        なし
+    戻り値：
+        セッションID
+    """
+    if 'sid' not in session:
+        session['sid'] = store.new_session_id()
+    return session['sid']
+
+def pon(my_action):
+    """
+    セッションの観測を使ってじゃんけん結果をJSONで返却する。
+    引数：
+        my_action   選択した行動
+    戻り値：
+        JSON文字列  結果
+    """
+    started = time.perf_counter()
+    in_flight_gauge.inc()
+    try:
+        session_id = get_session_id()
+        model_id = assign_model(session_id)
+        request_counter.inc(MOVE_NAMES[my_action], model_id)
+        stages = {}
+        def play(obs):
+            stages['loaded'] = time.perf_counter()
+            result = predict(my_action, obs, model_id)
+            stages['saving'] = time.perf_counter()
+            return result, obs.rounds
+        # 別プロセスと更新が競合した場合は最新の観測で推論し直す
+        loading = time.perf_counter()
+        result, rounds = store.update(session_id, play)
+        stage_histogram.observe(stages['loaded'] - loading, 'session_load')
+        stage_histogram.observe(time.perf_counter() - stages['saving'], 'session_save')
+        record_round(session_id, result, rounds)
+        encoding = time.perf_counter()
+        response = jsonify(result)
+        finished = time.perf_counter()
+        stage_histogram.observe(finished - encoding, 'json_encode')
+        request_histogram.observe(finished - started, model_id)
+        return response
+    finally:
+        in_flight_gauge.dec()
+
+def predict(my_action, obs, model_id=None):
     """
     選択した行動によるじゃんけん結果を辞書型で取得する。
     引数：
         my_action   選択した行動
+        obs         観測（ObservationBuffer）
+        model_id    対戦するモデルID（None の場合既定のモデル）
     戻り値：
         JSON文字列  結果
     """
-    enemy_action = int(model.predict(obs)[0])
+    registry = get_registry(model_id)
+    model_id = model_id or next(iter(registries))
+    # 取得したバージョンで推論する（推論中に差し替えられても影響しない）
+    version = registry.current()
+    started = time.perf_counter()
+    enemy_action, table = choose_action(obs, version, model_id)
+    stage_histogram.observe(time.perf_counter() - started, 'predict')
+    return play_round(my_action, obs, version, enemy_action, table, model_id)
+
+def choose_action(obs, version, model_id):
+    """
+    モデル側の行動を選択する。
+    参照テーブル・キャッシュ・マイクロバッチ推論の順に使用する。
+    引数：
+        obs         観測（ObservationBuffer）
+        version     推論に使用するモデルバージョン
+        model_id    モデルID（キャッシュの選択に使用）
+    戻り値：
+        (モデルが選択した行動, 使用した参照テーブル（使用しない場合None）)
+    """
+    # 参照テーブルは蒸留元と同じモデルを使用している間のみ使う
+    table = lookup
+    if table is not None and table.source_digest == version.digest:
+        return int(table.predict(obs.view())[0]), table
+    cache = caches.get(model_id)
+    if cache is not None:
+        enemy_action = cache.get(obs.hash_value, version.model)
+        if enemy_action is None:
+            probs = predictor.predict_probs(obs.view(), model=version.model)
+            enemy_action = cache.put(obs.hash_value, probs, version.model)
+        return enemy_action, None
+    return predictor.predict(obs.view(), model=version.model), None
+
+def play_round(my_action, obs, version, enemy_action, table=None, model_id=None):
+    """
+    両者の行動で観測を更新し、じゃんけん結果を辞書型で取得する。
+    引数：
+        my_action       選択した行動
+        obs             観測（ObservationBuffer）
+        version         推論に使用したモデルバージョン
+        enemy_action    モデルが選択した行動
+        table           使用した参照テーブル
+        model_id        対戦したモデルID
+    戻り値：
+        結果辞書
+    """
+    started = time.perf_counter()
     obs = env.update_observation(obs, my_action, enemy_action)
+    stage_histogram.observe(time.perf_counter() - started, 'update_observation')
     done = env.is_done(my_action, enemy_action)
     reward = env.calc_reward(my_action, enemy_action)
+    outcome_counter.inc('draw' if my_action == enemy_action
+        else 'win' if reward > 0 else 'lose', model_id)
     return {
         'my_action':    my_action,
-        'model':        model.__class__.__name__,
+        'enemy_action': enemy_action,
+        'model_id':     model_id,
+        'model':        version.model.__class__.__name__,
+        'model_version':    version.version,
+        'model_hash':       version.digest,
+        'lookup':           table is not None,
         'reward':       reward,
-        'observation':  obs,
+        'observation':  obs.tolist(),
         'done':         done,
     }
 
+def open_recorder(path):
+    """
+    現在のプロセス用の対戦履歴ファイルを開く。
+    複数のサーバプロセスが同じファイルへ追記しないよう、拡張子の前にプロセスIDを付加する
+    （例：trajectory.bin → trajectory.1234.bin）。
+    引数：
+        path    対戦履歴ファイルパス
+    戻り値：
+        TrajectoryWriter インスタンス（バックグラウンドで書き出す）
+    """
+    root, ext = os.path.splitext(path)
+    return TrajectoryWriter(f'{root}.{os.getpid()}{ext}', background=True)
+
+def episode_key(session_id):
+    """
+    対戦履歴に記録するセッションのエピソード番号を取得する。
+    セッション数が増えても衝突しないよう、BLAKE2b ダイジェストの先頭8バイトとする。
+    引数：
+        session_id  セッションID
+    戻り値：
+        エピソード番号（64ビット符号なし整数）
+    """
+    digest = hashlib.blake2b(session_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+def record_round(session_id, result, rounds):
+    """
+    対戦履歴ファイルが指定されている場合、1回分の結果を記録する。
+    引数：
+        session_id  セッションID
+        result      結果辞書
+        rounds      セッション内の対戦の通し番号（ObservationBuffer.rounds）
+    戻り値：
+        なし
+    """
+    if recorder is not None:
+        recorder.write(episode_key(session_id), rounds & 0xFFFFFFFF,
+            result['my_action'], result['enemy_action'], result['reward'])
+
 @app.route('/', methods=['GET'])
 def show_index():
     """
@@ -59,11 +479,11 @@ def show_index():
     戻り値：
         なし
     """
-    # セッション上に初期化した観測データを格納
-    if 'obs' not in session:
+    # セッションストア上に初期化した観測データを格納
+    session_id = get_session_id()
+    if store.load(session_id) is None:
         # 観測初期化
-        obs = env.init_observation()
-        session['obs'] = obs
+        store.save(session_id, store.new_observation())
     # /template/index.html を表示
     return render_template('index.html')
 
@@ -76,11 +496,7 @@ def goo():
     戻り値：
         JSON文字列  結果
     """
-    # 観測データを取得
-    if 'obs' not in session:
-        session['obs'] = env.init_observation()
-    obs = session['obs']
-    return jsonify(predict(0, obs))
+    return pon(0)
 
 @app.route('/pon/choki', methods=['POST'])
 def choki():
@@ -91,11 +507,7 @@ def choki():
     戻り値：
         JSON文字列  結果
     """
-    # 観測データを取得
-    if 'obs' not in session:
-        session['obs'] = env.init_observation()
-    obs = session['obs']
-    return jsonify(predict(2, obs))
+    return pon(2)
 
 @app.route('/pon/paa', methods=['POST'])
 def paa():
@@ -106,31 +518,165 @@ def paa():
     戻り値：
         JSON文字列  結果
     """
-    # 観測データを取得
-    if 'obs' not in session:
-        session['obs'] = env.init_observation()
-    obs = session['obs']
-    return jsonify(predict(1, obs))
+    return pon(1)
+
+@app.route('/stats', methods=['GET'])
+def show_stats():
+    """
+    推論レイテンシのパーセンタイル・バッチサイズ分布・キャッシュ統計を返却する。
+    引数：
+        なし
+    戻り値：
+        JSON文字列  統計情報
+    """
+    stats = {} if predictor is None else predictor.stats()
+    if caches:
+        stats['cache'] = {model_id: cache.stats() for model_id, cache in caches.items()}
+    stats['startup'] = startup_times
+    return jsonify(stats)
+
+@app.route('/metrics', methods=['GET'])
+def show_metrics():
+    """
+    リクエスト数・処理段階毎のレイテンシ・処理中リクエスト数・勝敗数・
+    モデルバージョンを Prometheus テキスト形式で返却する。
+    引数：
+        なし
+    戻り値：
+        Prometheus テキスト形式のメトリクス
+    """
+    return Response(metrics.render(),
+        mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/reload', methods=['GET'])
 def load_model():
     """
-    モデルをリロードする
+    全モデルファイルの更新を確認し、変更されていればバックグラウンドで
+    ロードして差し替える。ゲームのリクエストはロード中も旧バージョンで処理する。
+    クエリ文字列に wait=1 を指定した場合はロード完了まで待つ。
+    既定のモデルの結果に加え、models にモデルID毎の結果を格納する。
     引数：
         なし
     戻り値：
-        JSON文字列  観測データ
+        JSON文字列  バージョン情報
     """
-    global model
-    old_model = model
-    new_model = PPO.load(PATH)
-    is_updated = (new_model != old_model)
-    model = new_model
-    return jsonify({
-        'old_model':    old_model.__class__.__name__,
-        'new_model':    new_model.__class__.__name__,
-        'is_updated':   is_updated,
-    })
+    current = get_registries()
+    old_versions = {model_id: r.current() for model_id, r in current.items()}
+    futures = {model_id: r.reload() for model_id, r in current.items()}
+    wait = request.args.get('wait') == '1'
+    models = {model_id: {
+        'old_model':    old_versions[model_id].info(),
+        'is_updated':   future.result() if wait else None,
+        'new_model':    current[model_id].current().info(),
+    } for model_id, future in futures.items()}
+    result = dict(next(iter(models.values())))
+    result['models'] = models
+    return jsonify(result)
+
+# テスト
+
+def test_warm_up_fork():
+    import signal
+    import tempfile
+    import numpy as np
+    global PATH, registries, predictor, worker_pid, assigner, caches
+    saved = (PATH, registries, predictor, worker_pid, assigner, caches)
+    with tempfile.TemporaryDirectory() as dirname:
+        PATH = os.path.join(dirname, 'model.npz')
+        rng = np.random.default_rng(0)
+        np.savez(PATH, weight_0=rng.normal(size=(8, 200)), bias_0=np.zeros(8),
+            action_weight=rng.normal(size=(3, 8)), action_bias=np.zeros(3),
+            num_layers=np.array(1), activation=np.array('Tanh'),
+            observation_shape=np.array([100, 2]))
+        registries = predictor = worker_pid = None
+        try:
+            # warm_up() はスレッドを開始しない
+            warm_up()
+            assert(registries is not None and predictor is None)
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                # fork した子プロセスでもリクエストを処理できる
+                status = 1
+                try:
+                    os.close(read_fd)
+                    signal.alarm(3)
+                    response = app.test_client().post('/pon/goo')
+                    if response.status_code == 200 and worker_pid == os.getpid():
+                        status = 0
+                finally:
+                    os.write(write_fd, bytes([status]))
+                    os._exit(0)
+            os.close(write_fd)
+            with os.fdopen(read_fd, 'rb') as f:
+                assert(f.read() == bytes([0]))
+            os.waitpid(pid, 0)
+            # 親プロセスでも最初のリクエスト時にスレッドを開始する
+            assert(app.test_client().post('/pon/paa').status_code == 200)
+            assert(worker_pid == os.getpid() and predictor is not None)
+            predictor.close()
+        finally:
+            PATH, registries, predictor, worker_pid, assigner, caches = saved
+
+def test_record_round():
+    import tempfile
+    from trajectory import read_trajectory
+    global recorder
+    saved = recorder
+    with tempfile.TemporaryDirectory() as dirname:
+        path = os.path.join(dirname, 'trajectory.bin')
+        recorder = open_recorder(path)
+        try:
+            # ステップ番号はセッションストアに保持した対戦の通し番号
+            sessions = MemorySessionStore()
+            for action in [0, 2, 1]:
+                with sessions.open('a') as obs:
+                    obs.push(action, 1)
+                    rounds = obs.rounds
+                record_round('a', {'my_action': action, 'enemy_action': 1,
+                    'reward': 0}, rounds)
+            recorder.close()
+            records = read_trajectory(os.path.join(dirname, f'trajectory.{os.getpid()}.bin'))
+            assert(records['step'].tolist() == [1, 2, 3])
+            assert(records['policy_action'].tolist() == [0, 2, 1])
+            assert((records['episode'] == episode_key('a')).all())
+            assert(episode_key('a') != episode_key('b') and episode_key('a') >= 2 ** 32)
+            del records
+        finally:
+            recorder = saved
+
+def test_model_length():
+    import tempfile
+    import numpy as np
+    global MODELS
+    saved = MODELS
+    with tempfile.TemporaryDirectory() as dirname:
+        rng = np.random.default_rng(0)
+        paths = {}
+        for length in [10, 100]:
+            paths[length] = os.path.join(dirname, f'model{length}.npz')
+            np.savez(paths[length], weight_0=rng.normal(size=(8, 2 * length)),
+                bias_0=np.zeros(8), action_weight=rng.normal(size=(3, 8)),
+                action_bias=np.zeros(3), num_layers=np.array(1),
+                activation=np.array('Tanh'), observation_shape=np.array([length, 2]))
+        try:
+            MODELS = [('short', paths[10], 1.0)]
+            assert(model_length() == 10)
+            check_length('short', load_model_file(paths[10]), 10)
+            try:
+                check_length('short', load_model_file(paths[10]), 100)
+                assert(False)
+            except ValueError:
+                pass
+            # 観測長の異なるモデルは同じセッションストアで提供できない
+            MODELS = [('short', paths[10], 1.0), ('long', paths[100], 1.0)]
+            try:
+                model_length()
+                assert(False)
+            except ValueError:
+                pass
+        finally:
+            MODELS = saved
 
 if __name__ == '__main__':
     """
@@ -145,7 +691,31 @@ if __name__ == '__main__':
     debug = args['--debug']
     target_model_path = args['--model_path']
     if target_model_path is not None:
-        model_path = target_model_path
-        model = PPO.load(model_path)
-        PATH = model_path
+        PATH = target_model_path
+    if args['--models'] is not None:
+        MODELS = parse_model_specs(args['--models'])
+    # 観測長はモデルの学習時の観測長に揃え、指定が異なる場合は起動時にエラーとする
+    length = model_length()
+    if args['--length'] is not None and int(args['--length']) != length:
+        raise ValueError(f'length={args["--length"]}: models were trained with '
+            f'observation length {length}')
+    if args['--session_store'] == 'sqlite':
+        store = SqliteSessionStore(args['--session_path'], length=length)
+    elif args['--session_store'] == 'memory':
+        store = MemorySessionStore(length=length)
+    else:
+        raise ValueError(f'session_store={args["--session_store"]}: no match argument')
+    BATCH_SIZE = int(args['--batch_size'])
+    BATCH_WAIT = float(args['--batch_wait_ms']) / 1000.0
+    if args['--trajectory_path'] is not None:
+        recorder = open_recorder(args['--trajectory_path'])
+        atexit.register(recorder.close)
+    CACHE_SIZE = int(args['--cache_size'])
+    LOOKUP_PATH = args['--lookup_path']
+    LOOKUP_THRESHOLD = float(args['--lookup_threshold'])
+    if args['--watch_interval'] is not None:
+        WATCH_INTERVAL = float(args['--watch_interval'])
+    print(f'startup time: imports={startup_times["imports"]:.3f}sec')
+    if args['--warm_up']:
+        warm_up()
     app.run(debug=debug)
\ No newline at end of file
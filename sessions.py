@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+"""
+Webアプリケーションのじゃんけん観測をサーバ側で保持する
+セッションストアを提供するモジュール。
+クッキーにはセッションIDのみを格納し、観測はストア側で保持する。
+"""
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from envs import OBSERVATION_LENGTH, RockPaperScissorsEnv, ObservationBuffer
+
+class SessionConflict(Exception):
+    """
+    観測を読み込んでから格納するまでに、別のプロセス・スレッドが
+    同じセッションを更新していた場合の例外。
+    """
+    pass
+
+class SessionStore:
+    """
+    セッションストア基底クラス。
+    サブクラスは load/save/delete を実装する。
+    同一セッションへの同時アクセスはロックストライピングで直列化する。
+    """
+    # ロック数
+    LOCK_STRIPES = 64
+    # update() で更新が競合した場合にやり直す最大回数と、やり直す前に待つ時間の単位（秒）
+    MAX_RETRIES = 64
+    RETRY_WAIT = 0.001
+
+    def __init__(self, ttl=3600.0, length=OBSERVATION_LENGTH):
+        """
+        有効期限・観測長とロックを初期化する。
+        引数：
+            ttl     最終アクセスからの有効期限（秒）
+            length  観測長
+        戻り値：
+            なし
+        """
+        self.ttl = ttl
+        self.length = length
+        self.locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+
+    @staticmethod
+    def new_session_id():
+        """
+        新規セッションIDを生成する。
+        引数：
+            なし
+        戻り値：
+            セッションID文字列
+        """
+        return uuid.uuid4().hex
+
+    def new_observation(self):
+        """
+        新規セッション用に初期化した観測を取得する。
+        引数：
+            なし
+        戻り値：
+            観測（ObservationBuffer、長さはストアの観測長）
+        """
+        return RockPaperScissorsEnv.init_observation(length=self.length)
+
+    def load(self, session_id):
+        """
+        セッションIDに対応する観測を取得する。
+        引数：
+            session_id  セッションID
+        戻り値：
+            観測（ObservationBuffer）、存在しない・期限切れの場合None
+        """
+        raise NotImplementedError()
+
+    def save(self, session_id, observation):
+        """
+        セッションIDに対応する観測を格納する。
+        引数：
+            session_id  セッションID
+            observation 観測（ObservationBuffer）
+        戻り値：
+            なし
+        """
+        raise NotImplementedError()
+
+    def delete(self, session_id):
+        """
+        セッションIDに対応する観測を削除する。
+        引数：
+            session_id  セッションID
+        戻り値：
+            なし
+        """
+        raise NotImplementedError()
+
+    def begin(self, session_id):
+        """
+        更新するセッションの観測を取得する（存在しない場合は初期化した観測）。
+        取得した観測は更新後に commit() で格納する。
+        引数：
+            session_id  セッションID
+        戻り値：
+            (観測（ObservationBuffer）, commit() へ渡す読み込み時のバージョン)
+        """
+        observation = self.load(session_id)
+        if observation is None:
+            observation = self.new_observation()
+        return observation, None
+
+    def commit(self, session_id, observation, version):
+        """
+        begin() で取得して更新した観測を格納する。
+        begin() 以降に別のプロセス・スレッドが同じセッションを更新していた場合は
+        格納せずに SessionConflict を送出する（本実装では常に格納する）。
+        引数：
+            session_id  セッションID
+            observation 観測（ObservationBuffer）
+            version     begin() が返却したバージョン
+        戻り値：
+            なし
+        """
+        self.save(session_id, observation)
+
+    def retry_wait(self, attempt):
+        """
+        SessionConflict 後にやり直す前に待つ時間を取得する。
+        競合した相手と同時にやり直さないようランダムな時間とする。
+        引数：
+            attempt     何回目のやり直しか（0始まり）
+        戻り値：
+            待ち時間（秒）
+        """
+        return self.RETRY_WAIT * (attempt + 1) * random.random()
+
+    @contextmanager
+    def open(self, session_id):
+        """
+        セッションをロックした状態で観測を取得し、
+        ブロック終了時に観測を格納する。
+        観測が存在しない場合は初期化した観測を使用する。
+        引数：
+            session_id  セッションID
+        戻り値：
+            観測（ObservationBuffer）
+        """
+        with self.locks[hash(session_id) % self.LOCK_STRIPES]:
+            observation, version = self.begin(session_id)
+            yield observation
+            self.commit(session_id, observation, version)
+
+    def update(self, session_id, function):
+        """
+        open() のブロック内で観測を関数へ渡し、観測を格納して関数の戻り値を返却する。
+        格納時に SessionConflict が発生した場合は、retry_wait() の時間待ってから
+        最新の観測で関数を呼び出し直す。
+        引数：
+            session_id  セッションID
+            function    観測（ObservationBuffer）を受け取り更新する関数
+        戻り値：
+            関数の戻り値
+        """
+        for attempt in range(self.MAX_RETRIES):
+            try:
+                with self.open(session_id) as observation:
+                    return function(observation)
+            except SessionConflict:
+                if attempt + 1 == self.MAX_RETRIES:
+                    raise
+                time.sleep(self.retry_wait(attempt))
+
+class MemorySessionStore(SessionStore):
+    """
+    プロセス内で観測を保持するLRUセッションストア。
+    最大件数を超えた場合・有効期限を過ぎた場合は古いものから削除する。
+    観測はObservationBufferのまま保持するため、シリアライズは発生しない。
+    """
+    def __init__(self, max_size=10000, ttl=3600.0, length=OBSERVATION_LENGTH):
+        """
+        最大件数・有効期限を格納する。
+        引数：
+            max_size    保持する最大セッション数
+            ttl         最終アクセスからの有効期限（秒）
+            length      観測長
+        戻り値：
+            なし
+        """
+        super().__init__(ttl=ttl, length=length)
+        self.max_size = max_size
+        # セッションID -> (観測, 有効期限)、先頭ほど最終アクセスが古い
+        self.entries = OrderedDict()
+        self.entries_lock = threading.Lock()
+
+    def load(self, session_id):
+        with self.entries_lock:
+            entry = self.entries.get(session_id)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self.entries[session_id]
+                return None
+            self.entries.move_to_end(session_id)
+            return entry[0]
+
+    def save(self, session_id, observation):
+        now = time.monotonic()
+        with self.entries_lock:
+            self.entries[session_id] = (observation, now + self.ttl)
+            self.entries.move_to_end(session_id)
+            self._evict(now)
+
+    def delete(self, session_id):
+        with self.entries_lock:
+            self.entries.pop(session_id, None)
+
+    def _evict(self, now):
+        """
+        最大件数超過分・期限切れのセッションを先頭から削除する。
+        最終アクセス順に並んでいるため、期限切れは先頭に集まる。
+        """
+        while self.entries:
+            session_id, (_, expires) = next(iter(self.entries.items()))
+            if len(self.entries) <= self.max_size and expires >= now:
+                break
+            del self.entries[session_id]
+
+    def __len__(self):
+        return len(self.entries)
+
+class SqliteSessionStore(SessionStore):
+    """
+    SQLiteファイルに観測を保持するセッションストア。
+    複数ワーカープロセスで同じファイルを共有する構成で使用する。
+    観測はint8配列のバイト列として、対戦数（ObservationBuffer.rounds）と
+    更新毎に増やすバージョン番号と共に格納する。
+    open()（begin()/commit()）は楽観的排他制御を行う：読み込み時はロックを取得せず、
+    読み込んだバージョンのままの場合のみ短いトランザクションで格納し、
+    別プロセスが先に更新していた場合は SessionConflict を送出する
+    （update() はブロックの処理をやり直す）。推論中はデータベースをロックしない。
+    """
+    # 期限切れセッションを削除する保存回数間隔
+    PURGE_INTERVAL = 1000
+    # 旧形式のファイルへ追加する列
+    COLUMNS = {
+        'rounds':   'INTEGER NOT NULL DEFAULT 0',
+        'version':  'INTEGER NOT NULL DEFAULT 0',
+    }
+
+    def __init__(self, path='sessions.sqlite3', ttl=3600.0, length=OBSERVATION_LENGTH):
+        """
+        データベースファイルを初期化する。
+        引数：
+            path        SQLiteデータベースファイルパス
+            ttl         最終アクセスからの有効期限（秒）
+            length      観測長
+        戻り値：
+            なし
+        """
+        super().__init__(ttl=ttl, length=length)
+        self.path = path
+        self.local = threading.local()
+        self.save_count = 0
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                'session_id TEXT PRIMARY KEY, observation BLOB, expires REAL, '
+                + ', '.join(f'{name} {spec}' for name, spec in self.COLUMNS.items()) + ')')
+            # 対戦数・バージョン番号の列がない旧形式のファイルには列を追加する
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(sessions)')]
+            for name, spec in self.COLUMNS.items():
+                if name not in columns:
+                    conn.execute(f'ALTER TABLE sessions ADD COLUMN {name} {spec}')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _connect(self):
+        """
+        スレッド毎のデータベース接続を取得する。
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # 複数の文をまとめる場合はトランザクションを明示的に開始する
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    def begin(self, session_id):
+        observation, version = self._load(self._connect(), session_id)
+        if observation is None:
+            observation = self.new_observation()
+        return observation, version
+
+    def commit(self, session_id, observation, version):
+        """
+        begin() で読み込んだバージョンのままの場合のみ、短いトランザクションで観測を格納する。
+        別のプロセス・スレッドが先に更新していた場合は SessionConflict を送出する。
+        begin() と別のスレッドから呼び出してもよい。
+        引数：
+            session_id  セッションID
+            observation 観測（ObservationBuffer）
+            version     begin() が返却したバージョン（行が存在しなかった場合None）
+        戻り値：
+            なし
+        """
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            values = (observation.view().tobytes(), now + self.ttl, observation.rounds)
+            if version is None:
+                cursor = conn.execute('INSERT OR IGNORE INTO sessions '
+                    '(session_id, observation, expires, rounds, version) '
+                    'VALUES (?, ?, ?, ?, 0)', (session_id,) + values)
+            else:
+                cursor = conn.execute('UPDATE sessions SET observation = ?, expires = ?, '
+                    'rounds = ?, version = version + 1 '
+                    'WHERE session_id = ? AND version = ?', values + (session_id, version))
+            if cursor.rowcount != 1:
+                raise SessionConflict(session_id)
+            self._purge(conn, now)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    @contextmanager
+    def open(self, session_id):
+        """
+        観測を取得し、ブロック終了時に観測を格納する。
+        読み込んでから格納するまでに別のプロセス・スレッドが同じセッションを
+        更新していた場合は格納せずに SessionConflict を送出する。
+        ブロック内で例外が発生した場合は格納しない。
+        観測が存在しない場合は初期化した観測を使用する。
+        引数：
+            session_id  セッションID
+        戻り値：
+            観測（ObservationBuffer）
+        """
+        observation, version = self.begin(session_id)
+        yield observation
+        self.commit(session_id, observation, version)
+
+    def _load(self, conn, session_id):
+        """
+        観測と格納済みのバージョン番号を取得する。
+        引数：
+            conn        データベース接続
+            session_id  セッションID
+        戻り値：
+            (観測（存在しない・期限切れ・観測長が異なる場合None）,
+             バージョン番号（行が存在しない場合None）)
+        """
+        row = conn.execute('SELECT observation, expires, rounds, version '
+            'FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        if row is None:
+            return None, None
+        # 期限切れ・観測長の異なる設定で格納された観測は存在しないものとして扱う
+        if row[1] < time.time() or len(row[0]) != self.length * 2:
+            return None, row[3]
+        observation = ObservationBuffer(length=self.length, rounds=row[2])
+        observation.load(
+            memoryview(row[0]).cast('b', (self.length, 2)))
+        return observation, row[3]
+
+    def load(self, session_id):
+        return self._load(self._connect(), session_id)[0]
+
+    def save(self, session_id, observation):
+        now = time.time()
+        conn = self._connect()
+        conn.execute('INSERT INTO sessions '
+            '(session_id, observation, expires, rounds, version) VALUES (?, ?, ?, ?, 0) '
+            'ON CONFLICT(session_id) DO UPDATE SET observation = excluded.observation, '
+            'expires = excluded.expires, rounds = excluded.rounds, version = version + 1',
+            (session_id, observation.view().tobytes(), now + self.ttl, observation.rounds))
+        self._purge(conn, now)
+
+    def _purge(self, conn, now):
+        """
+        一定の保存回数毎に期限切れセッションを削除する。
+        """
+        self.save_count += 1
+        if self.save_count % self.PURGE_INTERVAL == 0:
+            conn.execute('DELETE FROM sessions WHERE expires < ?', (now,))
+
+    def delete(self, session_id):
+        self._connect().execute('DELETE FROM sessions WHERE session_id = ?',
+            (session_id,))
+
+# テスト
+
+def test_memory_session_store():
+    store = MemorySessionStore(max_size=2, ttl=60.0)
+    with store.open('a') as observation:
+        observation.push(2, 1)
+    assert(store.load('a').tolist()[-1] == [2, 1])
+    store.save('b', RockPaperScissorsEnv.init_observation())
+    store.load('a')
+    store.save('c', RockPaperScissorsEnv.init_observation())
+    assert(len(store) == 2)
+    assert(store.load('b') is None)
+    assert(store.load('a') is not None)
+    store.ttl = -1.0
+    store.save('d', RockPaperScissorsEnv.init_observation())
+    assert(store.load('d') is None)
+    # 観測長を指定した場合は新規セッションもその長さで初期化する
+    store = MemorySessionStore(length=1000)
+    with store.open('a') as observation:
+        observation.push(2, 1)
+    assert(store.load('a').shape == (1000, 2))
+
+def test_sqlite_session_store():
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as dirname:
+        store = SqliteSessionStore(os.path.join(dirname, 'sessions.sqlite3'))
+        with store.open('a') as observation:
+            expected = observation.tolist()[1:] + [[2, 1]]
+            observation.push(2, 1)
+        assert(store.load('a').tolist() == expected)
+        assert(store.load('a').rounds == 1)
+        store.delete('a')
+        assert(store.load('a') is None)
+        store.local.conn.close()
+        store = SqliteSessionStore(os.path.join(dirname, 'long.sqlite3'), length=1000)
+        with store.open('a') as observation:
+            observation.push(2, 1)
+        assert(store.load('a').tolist()[-1] == [2, 1])
+        assert(store.load('a').shape == (1000, 2))
+        # 観測長の異なる観測は存在しないものとして初期化し直す
+        other = SqliteSessionStore(store.path, length=10)
+        assert(other.load('a') is None)
+        with other.open('a') as observation:
+            assert(observation.shape == (10, 2))
+        # ブロック内で例外が発生した場合は格納しない
+        try:
+            with other.open('a') as observation:
+                observation.push(2, 2)
+                raise KeyError()
+        except KeyError:
+            pass
+        assert(other.load('a').tolist()[-1] != [2, 2])
+        store.local.conn.close()
+        other.local.conn.close()
+        # 対戦数の列がない旧形式のファイルには列を追加して使用する
+        path = os.path.join(dirname, 'old.sqlite3')
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE sessions ('
+            'session_id TEXT PRIMARY KEY, observation BLOB, expires REAL)')
+        conn.commit()
+        conn.close()
+        store = SqliteSessionStore(path)
+        with store.open('a') as observation:
+            observation.push(2, 1)
+        assert(store.load('a').rounds == 1)
+        # 読み込み後に別の接続が更新していた場合は格納せずに SessionConflict を送出する
+        other = SqliteSessionStore(path)
+        try:
+            with store.open('a') as observation:
+                other.save('a', other.new_observation())
+                observation.push(2, 2)
+            assert(False)
+        except SessionConflict:
+            pass
+        assert(store.load('a').rounds == 0)
+        assert(store.update('a', lambda observation: observation.push(2, 2)) is None)
+        assert(store.load('a').rounds == 1)
+        store.local.conn.close()
+        other.local.conn.close()
+
+def _push_rounds(path, session_id, rounds):
+    store = SqliteSessionStore(path, length=200)
+    def play(observation):
+        # 推論中はロックを保持しない
+        time.sleep(0.001)
+        observation.push(2, 2)
+    for _ in range(rounds):
+        store.update(session_id, play)
+    store.local.conn.close()
+
+def test_sqlite_session_store_processes():
+    import multiprocessing as mp
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as dirname:
+        path = os.path.join(dirname, 'sessions.sqlite3')
+        store = SqliteSessionStore(path, length=200)
+        store.save('a', store.new_observation())
+        context = mp.get_context('spawn')
+        processes = [context.Process(target=_push_rounds, args=(path, 'a', 20))
+            for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            assert(process.exitcode == 0)
+        # 初期観測は0/1のみのため、2の個数が失われずに格納された対戦数となる
+        assert(sum(row[0] == 2 for row in store.load('a').tolist()) == 80)
+        assert(store.load('a').rounds == 80)
+        store.local.conn.close()
+
+if __name__ == '__main__':
+    test_memory_session_store()
+    test_sqlite_session_store()
+    test_sqlite_session_store_processes()
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+対戦相手となる方策の重みを共有メモリへ1回だけ配置し、
+環境を実行する各子プロセスから読み取り専用で参照するためのモジュール。
+子プロセスは重みをコピーせずに共有メモリ上の配列ビューで推論するため、
+子プロセス数を増やしても重みのメモリ使用量は増えない。
+バージョン番号を共有メモリ上のカウンタで管理し、親プロセスが新しい重みを
+publish() すると、各子プロセスは次の推論時に新しいバージョンへ切り替える。
+"""
+import json
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from numpy_policy import NumpyPolicy
+
+# 配列の配置境界（バイト）
+ALIGNMENT = 64
+# ヘッダ長を格納する領域のバイト数
+HEADER_LENGTH_SIZE = 8
+
+def segment_name(name, version):
+    """
+    バージョン毎の重みを格納する共有メモリ名を取得する。
+    """
+    return f'{name}_v{version}'
+
+def _policy_layout(policy):
+    """
+    NumpyPolicy が推論時に使用する配列（転置済みの重み）と、
+    共有メモリ上の配置を記述したヘッダを生成する。
+    引数：
+        policy      NumpyPolicy インスタンス
+    戻り値：
+        arrays      {配列名: float32 配列}
+        header      ヘッダ辞書
+        size        共有メモリの必要バイト数
+    """
+    arrays = {}
+    for i, (weight, bias) in enumerate(zip(policy.weights, policy.biases)):
+        arrays[f'weight_{i}'] = weight
+        arrays[f'bias_{i}'] = bias
+    arrays['action_weight'] = policy.action_weight
+    arrays['action_bias'] = policy.action_bias
+    # ヘッダの後ろに配列を配置するため、先にヘッダの長さを確定させる
+    entries = {key: [list(value.shape), 0] for key, value in arrays.items()}
+    header = {
+        'num_layers':           len(policy.weights),
+        'activation':           policy.activation_name,
+        'observation_shape':    list(policy.observation_shape),
+        'arrays':               entries,
+    }
+    # オフセットの桁数でヘッダ長が変わらないよう上限値で見積もる
+    for entry in entries.values():
+        entry[1] = 1 << 40
+    offset = HEADER_LENGTH_SIZE + len(json.dumps(header).encode())
+    for key, value in arrays.items():
+        offset = (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        entries[key][1] = offset
+        offset += value.nbytes
+    return arrays, header, max(offset, 1)
+
+def write_policy(shm, arrays, header):
+    """
+    ヘッダと配列を共有メモリへ書き込む。
+    """
+    encoded = json.dumps(header).encode()
+    shm.buf[:HEADER_LENGTH_SIZE] = len(encoded).to_bytes(HEADER_LENGTH_SIZE, 'little')
+    shm.buf[HEADER_LENGTH_SIZE:HEADER_LENGTH_SIZE + len(encoded)] = encoded
+    for key, value in arrays.items():
+        shape, offset = header['arrays'][key]
+        np.ndarray(shape, dtype=np.float32, buffer=shm.buf, offset=offset)[...] = value
+
+def read_policy(shm, seed=None):
+    """
+    共有メモリ上の配列ビューを重みとする NumpyPolicy を生成する（コピーしない）。
+    引数：
+        shm     write_policy() で書き込んだ共有メモリ
+        seed    確率的行動選択に使用する乱数シード（Generator 可）
+    戻り値：
+        NumpyPolicy インスタンス
+    """
+    length = int.from_bytes(bytes(shm.buf[:HEADER_LENGTH_SIZE]), 'little')
+    header = json.loads(bytes(shm.buf[HEADER_LENGTH_SIZE:HEADER_LENGTH_SIZE + length]))
+    views = {}
+    for key, (shape, offset) in header['arrays'].items():
+        view = np.ndarray(shape, dtype=np.float32, buffer=shm.buf, offset=offset)
+        view.flags.writeable = False
+        views[key] = view
+    num_layers = header['num_layers']
+    # NumpyPolicy は重みを転置して保持するため、転置したビューを渡すと
+    # 連続領域のビューがそのまま使用される
+    return NumpyPolicy(
+        [views[f'weight_{i}'].T for i in range(num_layers)],
+        [views[f'bias_{i}'] for i in range(num_layers)],
+        views['action_weight'].T, views['action_bias'],
+        activation=header['activation'],
+        observation_shape=header['observation_shape'],
+        seed=seed)
+
+class SharedPolicyStore:
+    """
+    方策の重みを共有メモリへ配置する親プロセス側のクラス。
+    重みはバージョン毎に別の共有メモリへ書き込み、書き込み完了後に
+    バージョンカウンタを更新するため、子プロセスが書き込み途中の重みを
+    参照することはない。直前のバージョンは切り替え中の子プロセスのために残し、
+    それより古いバージョンは破棄する。
+    """
+    def __init__(self, name=None):
+        """
+        バージョンカウンタ用の共有メモリを確保する。
+        引数：
+            name    共有メモリ名（None の場合自動生成）
+        戻り値：
+            なし
+        """
+        self.control = SharedMemory(create=True, size=8, name=name)
+        self.name = self.control.name
+        self.counter = np.ndarray((1,), dtype=np.int64, buffer=self.control.buf)
+        self.counter[0] = 0
+        # {バージョン: 共有メモリ}
+        self.segments = {}
+
+    @property
+    def version(self):
+        """
+        公開中のバージョン番号（未公開の場合0）。
+        """
+        return int(self.counter[0])
+
+    def publish(self, model):
+        """
+        方策の重みを新しいバージョンとして共有メモリへ配置する。
+        引数：
+            model   NumpyPolicy または PPO インスタンス
+        戻り値：
+            公開したバージョン番号
+        """
+        policy = model if isinstance(model, NumpyPolicy) else NumpyPolicy.from_model(model)
+        arrays, header, size = _policy_layout(policy)
+        version = self.version + 1
+        shm = SharedMemory(create=True, size=size, name=segment_name(self.name, version))
+        write_policy(shm, arrays, header)
+        self.segments[version] = shm
+        self.counter[0] = version
+        for old in [v for v in self.segments if v < version - 1]:
+            self._release(self.segments.pop(old))
+        return version
+
+    @staticmethod
+    def _release(shm):
+        """
+        共有メモリを閉じて破棄する。
+        """
+        shm.close()
+        shm.unlink()
+
+    def close(self):
+        """
+        全バージョンとバージョンカウンタの共有メモリを破棄する。
+        """
+        for shm in self.segments.values():
+            self._release(shm)
+        self.segments = {}
+        self.counter = None
+        self._release(self.control)
+
+class SharedPolicy:
+    """
+    SharedPolicyStore が公開した方策を子プロセス側で参照するクラス。
+    推論の度にバージョンカウンタを確認し、更新されていれば新しいバージョンの
+    共有メモリへ接続し直す。predict() は stable_baselines3 の predict() と
+    同じ形式のため、AIPlayer へそのまま渡すことができる。
+    共有メモリの破棄は親プロセスが行うため、参照する子プロセスは
+    親プロセスから multiprocessing で起動すること。
+    """
+    def __init__(self, name, seed=None):
+        """
+        バージョンカウンタ用の共有メモリへ接続する。
+        引数：
+            name    SharedPolicyStore.name
+            seed    確率的行動選択に使用する乱数シード
+        戻り値：
+            なし
+        """
+        self.name = name
+        self.control = SharedMemory(name=name)
+        self.counter = np.ndarray((1,), dtype=np.int64, buffer=self.control.buf)
+        self.rng = np.random.default_rng(seed)
+        self.version = 0
+        self.segment = None
+        self.policy = None
+
+    def refresh(self):
+        """
+        バージョンカウンタが更新されていれば新しいバージョンへ接続し直す。
+        引数：
+            なし
+        戻り値：
+            真：切り替えた、偽：変更なし
+        """
+        version = int(self.counter[0])
+        if version == self.version:
+            return False
+        if version <= 0:
+            raise RuntimeError(f'shared policy={self.name}: not published')
+        while True:
+            try:
+                segment = SharedMemory(name=segment_name(self.name, version))
+                break
+            except FileNotFoundError:
+                # 接続前に破棄された場合は最新のバージョンへ接続する
+                version = int(self.counter[0])
+        old = self.segment
+        self.policy = read_policy(segment, seed=self.rng)
+        self.segment = segment
+        self.version = version
+        if old is not None:
+            self._close(old)
+        return True
+
+    @staticmethod
+    def _close(shm):
+        """
+        共有メモリを閉じる。配列ビューが残っている場合は解放時に閉じられる。
+        """
+        try:
+            shm.close()
+        except BufferError:
+            pass
+
+    def action_probs(self, observations):
+        """
+        最新バージョンの方策で各行動の選択確率を算出する。
+        """
+        self.refresh()
+        return self.policy.action_probs(observations)
+
+    def predict(self, observation, state=None, episode_start=None,
+            deterministic=False):
+        """
+        最新バージョンの方策で行動を選択する。NumpyPolicy.predict() と同じ形式。
+        """
+        self.refresh()
+        return self.policy.predict(observation, state=state,
+            episode_start=episode_start, deterministic=deterministic)
+
+    def close(self):
+        """
+        共有メモリを閉じる。
+        """
+        self.policy = None
+        self.counter = None
+        for shm in [self.segment, self.control]:
+            if shm is not None:
+                self._close(shm)
+        self.segment = None
+
+# テスト
+
+def _random_policy(seed):
+    rng = np.random.default_rng(seed)
+    return NumpyPolicy(
+        [rng.normal(size=(16, 200)), rng.normal(size=(16, 16))],
+        [rng.normal(size=16), rng.normal(size=16)],
+        rng.normal(size=(3, 16)), rng.normal(size=3))
+
+def _worker_actions(name, observations):
+    shared = SharedPolicy(name)
+    actions, _ = shared.predict(observations, deterministic=True)
+    version = shared.version
+    shared.close()
+    return version, actions.tolist()
+
+def test_shared_policy():
+    observations = np.random.default_rng(0).integers(
+        0, 3, size=(32, 100, 2)).astype(np.int8)
+    store = SharedPolicyStore()
+    try:
+        first = _random_policy(1)
+        assert(store.publish(first) == 1)
+        shared = SharedPolicy(store.name)
+        actions, _ = shared.predict(observations, deterministic=True)
+        assert((actions == first.predict(observations, deterministic=True)[0]).all())
+        assert(np.allclose(shared.action_probs(observations), first.action_probs(observations)))
+        # 重みは共有メモリ上のビューをコピーせずに使用し、書き換えできない
+        weight = shared.policy.weights[0]
+        assert(np.shares_memory(weight, np.ndarray(
+            (shared.segment.size,), dtype=np.uint8, buffer=shared.segment.buf)))
+        assert(not weight.flags.writeable)
+        # 新しいバージョンを公開すると次の推論から切り替わる
+        second = _random_policy(2)
+        store.publish(second)
+        store.publish(second)
+        assert(store.version == 3 and sorted(store.segments) == [2, 3])
+        actions, _ = shared.predict(observations, deterministic=True)
+        assert(shared.version == 3)
+        assert((actions == second.predict(observations, deterministic=True)[0]).all())
+        shared.close()
+    finally:
+        store.close()
+
+def test_shared_policy_processes():
+    import multiprocessing as mp
+    from concurrent.futures import ProcessPoolExecutor
+    observations = np.random.default_rng(0).integers(
+        0, 3, size=(8, 100, 2)).astype(np.int8)
+    store = SharedPolicyStore()
+    try:
+        policy = _random_policy(3)
+        store.publish(policy)
+        expected = policy.predict(observations, deterministic=True)[0].tolist()
+        with ProcessPoolExecutor(max_workers=2, mp_context=mp.get_context('spawn')) as executor:
+            results = list(executor.map(_worker_actions,
+                [store.name] * 2, [observations] * 2))
+        assert(results == [(1, expected)] * 2)
+    finally:
+        store.close()
+
+if __name__ == '__main__':
+    test_shared_policy()
+    test_shared_policy_processes()
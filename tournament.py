@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+プレイヤークラス・学習済みモデルの総当たり戦を行うモジュール。
+全組み合わせを並列に対戦させ、勝・分・敗行列とEloレーティングを出力する。
+対戦結果はモデルファイルのハッシュ値をキーとしてディスクへキャッシュし、
+再実行時は未対戦の組み合わせのみ対戦する。
+
+Usage:
+    tournament.py <entrant>... [--games=<games>] [--batch=<batch>] [--workers=<workers>] [--cache=<cache>] [--output=<output>] [--seed=<seed>] [--length=<n>]
+
+Arguments:
+    <entrant>               Player class name in envs.py or trained model path
+
+Options:
+    --games=<games>         rounds played per pairing [default: 10000]
+    --batch=<batch>         concurrent games stepped at once [default: 100]
+    --workers=<workers>     number of worker processes (0: cpu count) [default: 0]
+    --cache=<cache>         result cache file path [default: tournament_cache.json]
+    --output=<output>       result json file path [default: tournament_result.json]
+    --seed=<seed>           random seed (default: not reproducible)
+    --length=<n>            observation window (must match the models' training length) [default: 100]
+"""
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+
+import numpy as np
+
+import envs
+from model_registry import file_digest
+
+# 対戦結果表：OUTCOME_TABLE[先手行動, 後手行動]（1:先手勝ち、0:あいこ、-1:先手負け）
+OUTCOME_TABLE = np.sign(envs.REWARD_TABLE).astype(np.int8)
+np.fill_diagonal(OUTCOME_TABLE, 0)
+
+# 観測の列の並び（プレイヤーがどちらの側として観測を受け取るか）
+# ENV_SIDE：環境側プレイヤーと同じ [相手の行動, 自分の行動]（Player サブクラス）
+# POLICY_SIDE：方策側として学習したモデルと同じ [自分の行動, 相手の行動]
+ENV_SIDE = 'env'
+POLICY_SIDE = 'policy'
+SIDES = [ENV_SIDE, POLICY_SIDE]
+
+# プロセス毎の学習済みモデルキャッシュ
+_model_cache = {}
+
+def load_ai_player(path):
+    """
+    学習済みモデルをロードしてAIPlayerを生成する。
+    同じプロセス内で同じパスのモデルは1回だけロードする。
+    引数：
+        path    学習済みモデルファイルパス
+    戻り値：
+        AIPlayer インスタンス
+    """
+    model = _model_cache.get(path)
+    if model is None:
+        from numpy_policy import load_model
+        model = load_model(path)
+        _model_cache[path] = model
+    return envs.AIPlayer(model)
+
+class Entrant:
+    """
+    総当たり戦の参加者クラス。
+    プレイヤーは対戦するプロセス内で factory() を呼び出して生成する。
+    学習済みモデルは方策側として学習しているため、観測は学習時と同じ
+    [自分の行動, 相手の行動] の並び（POLICY_SIDE）で渡す。
+    """
+    def __init__(self, name, key, factory, args=(), side=ENV_SIDE):
+        """
+        引数：
+            name        表示名
+            key         キャッシュキー（クラス名またはモデルファイルのハッシュ値）
+            factory     プレイヤー生成関数（pickle可能であること）
+            args        factory へ渡す引数
+            side        観測の列の並び（ENV_SIDE または POLICY_SIDE）
+        戻り値：
+            なし
+        """
+        if side not in SIDES:
+            raise ValueError(f'side={side}: no match argument')
+        self.name = name
+        self.key = key
+        self.factory = factory
+        self.args = args
+        self.side = side
+
+    def create(self):
+        """
+        プレイヤーインスタンスを生成する。
+        """
+        return self.factory(*self.args)
+
+    @classmethod
+    def from_player_class(cls, player_class):
+        """
+        Player サブクラスから参加者を生成する。
+        """
+        return cls(player_class.__name__, player_class.__name__, player_class)
+
+    @classmethod
+    def from_model_path(cls, path):
+        """
+        学習済みモデルファイルから参加者を生成する。
+        キャッシュキーはモデルファイルのSHA-256ハッシュ値とする。
+        """
+        file_path = path
+        if not os.path.exists(path) and os.path.exists(path + '.zip'):
+            file_path = path + '.zip'
+        return cls(os.path.basename(path), 'model:' + file_digest(file_path),
+            load_ai_player, (path,), side=POLICY_SIDE)
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        envs.py のプレイヤークラス名または学習済みモデルファイルパスから
+        参加者を生成する。
+        """
+        player_class = getattr(envs, spec, None)
+        if isinstance(player_class, type) and issubclass(player_class, envs.Player):
+            return cls.from_player_class(player_class)
+        return cls.from_model_path(spec)
+
+def play(first, second, games=10000, batch=100, length=envs.OBSERVATION_LENGTH,
+        seed=None, sides=(ENV_SIDE, ENV_SIDE)):
+    """
+    2人のプレイヤーを対戦させる。
+    batch 個の対戦を (batch, 2×length, 2) のリングバッファ上で同時に進め、
+    各プレイヤーの行動は predict_batch でまとめて選択する。
+    バッファは [先手の行動, 後手の行動] の並びで保持し、各プレイヤーには
+    sides で指定した並びとなるよう必要に応じて列を入れ替えた観測を渡す。
+    引数：
+        first       先手プレイヤーインスタンス
+        second      後手プレイヤーインスタンス
+        games       対戦回数（じゃんけん1回を1対戦とする）
+        batch       同時に進める対戦数
+        length      観測長
+        seed        初期観測の乱数シード
+        sides       (先手, 後手) の観測の列の並び（ENV_SIDE または POLICY_SIDE）
+    戻り値：
+        (先手勝ち数, あいこ数, 先手負け数)
+    """
+    batch = max(1, min(batch, games))
+    rng = np.random.default_rng(seed)
+    buffer = rng.integers(0, 2, size=(batch, 2 * length, 2), dtype=np.int8)
+    buffer[:, length:] = buffer[:, :length]
+    head = 0
+    counts = np.zeros(3, dtype=np.int64)
+    remaining = games
+    while remaining > 0:
+        observations = buffer[:, head:head + length]
+        first_actions = np.asarray(first.predict_batch(
+            observations if sides[0] == POLICY_SIDE else observations[:, :, ::-1]),
+            dtype=np.int64)
+        second_actions = np.asarray(second.predict_batch(
+            observations if sides[1] == ENV_SIDE else observations[:, :, ::-1]),
+            dtype=np.int64)
+        buffer[:, head, 0] = first_actions
+        buffer[:, head, 1] = second_actions
+        buffer[:, head + length] = buffer[:, head]
+        head = head + 1 if head + 1 < length else 0
+        outcomes = OUTCOME_TABLE[first_actions, second_actions][:min(batch, remaining)]
+        # 勝ち:0、あいこ:1、負け:2 の順に集計
+        counts += np.bincount(1 - outcomes, minlength=3)
+        remaining -= batch
+    return tuple(int(count) for count in counts)
+
+def _play_pairing(first, second, games, batch, seed=None,
+        length=envs.OBSERVATION_LENGTH):
+    """
+    ワーカープロセス上で参加者同士を対戦させる。
+    シード指定時は初期観測・各プレイヤーの乱数系列を子シードで初期化する。
+    """
+    sides = (first.side, second.side)
+    first, second = first.create(), second.create()
+    play_seed = None
+    if seed is not None:
+        play_seed, first_seed, second_seed = envs.spawn_seeds(seed, 3)
+        first.seed(first_seed)
+        second.seed(second_seed)
+    return play(first, second, games=games, batch=batch, length=length,
+        seed=play_seed, sides=sides)
+
+def _init_worker():
+    """
+    ワーカープロセス同士でCPUコアを奪い合わないよう torch のスレッド数を1にする。
+    """
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+
+def pairing_key(first, second, games, batch, seed=None, length=envs.OBSERVATION_LENGTH):
+    """
+    対戦結果キャッシュのキーを生成する。
+    """
+    key = f'{first.key}@{first.side}|{second.key}@{second.side}|{games}|{batch}|{length}'
+    return key if seed is None else f'{key}|{seed}'
+
+def load_cache(path):
+    """
+    対戦結果キャッシュを読み込む。
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_cache(path, cache):
+    """
+    対戦結果キャッシュを書き出す（一時ファイル経由で置き換える）。
+    """
+    if path is None:
+        return
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+def elo_ratings(wins, draws, base=1500.0, iterations=1000, tolerance=1e-9):
+    """
+    勝ち数・あいこ数行列から Bradley-Terry モデルの強さを推定し、
+    Eloレーティングへ換算する（あいこは0.5勝として扱う）。
+    引数：
+        wins        wins[i, j] = i が j に勝った数
+        draws       draws[i, j] = i と j のあいこ数
+        base        平均レーティング
+        iterations  最大反復回数
+        tolerance   収束判定値
+    戻り値：
+        レーティング配列
+    """
+    # 全員が1回ずつ引き分けた仮想対戦を加えて全勝・全敗でも発散しないようにする
+    scores = wins + 0.5 * draws + 0.5
+    np.fill_diagonal(scores, 0.0)
+    games = scores + scores.T
+    total_scores = scores.sum(axis=1)
+    strength = np.ones(len(wins))
+    for _ in range(iterations):
+        denominator = (games / (strength[:, np.newaxis] + strength[np.newaxis, :])).sum(axis=1)
+        updated = total_scores / denominator
+        updated /= np.exp(np.log(updated).mean())
+        if np.abs(updated - strength).max() < tolerance:
+            strength = updated
+            break
+        strength = updated
+    return base + 400.0 * np.log10(strength)
+
+def run_tournament(entrants, games=10000, batch=100, workers=None, cache_path=None,
+        seed=None, length=envs.OBSERVATION_LENGTH):
+    """
+    全参加者の総当たり戦を行う。
+    キャッシュに存在しない組み合わせのみプロセスプールで並列に対戦する。
+    シード指定時は組み合わせ毎の子シードで対戦するため、
+    ワーカー数・実行順によらず同じ結果となる。
+    引数：
+        entrants    Entrant のリスト
+        games       1組み合わせ毎の対戦回数
+        batch       同時に進める対戦数
+        workers     ワーカープロセス数（None の場合CPU数）
+        cache_path  対戦結果キャッシュファイルパス
+        seed        乱数シード（None の場合再現性なし）
+        length      観測長（学習済みモデルの学習時の観測長と揃えること）
+    戻り値：
+        結果辞書（names, wins, draws, losses, ratings, played）
+    """
+    cache = load_cache(cache_path)
+    pairings = list(combinations(range(len(entrants)), 2))
+    # 組み合わせの位置毎に子シードを割り当てる
+    seeds = [None] * len(pairings) if seed is None \
+        else envs.spawn_seeds(seed, len(pairings))
+    missing = [(index, i, j) for index, (i, j) in enumerate(pairings)
+        if pairing_key(entrants[i], entrants[j], games, batch, seed, length) not in cache]
+    if missing:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            futures = {(i, j): executor.submit(_play_pairing,
+                entrants[i], entrants[j], games, batch, seeds[index], length)
+                for index, i, j in missing}
+            for (i, j), future in futures.items():
+                cache[pairing_key(entrants[i], entrants[j], games, batch, seed, length)] = \
+                    list(future.result())
+        save_cache(cache_path, cache)
+
+    n = len(entrants)
+    wins = np.zeros((n, n), dtype=np.int64)
+    draws = np.zeros((n, n), dtype=np.int64)
+    for i, j in pairings:
+        win, draw, loss = cache[pairing_key(entrants[i], entrants[j], games, batch, seed, length)]
+        wins[i, j], wins[j, i] = win, loss
+        draws[i, j] = draws[j, i] = draw
+    return {
+        'names':    [entrant.name for entrant in entrants],
+        'wins':     wins.tolist(),
+        'draws':    draws.tolist(),
+        'losses':   wins.T.tolist(),
+        'ratings':  elo_ratings(wins, draws).tolist(),
+        'played':   len(missing),
+    }
+
+def print_result(result):
+    """
+    勝・分・敗行列とレーティングを標準出力へ表示する。
+    """
+    names = result['names']
+    width = max(12, max(len(name) for name in names) + 1)
+    print('win/draw/loss (row vs column)')
+    print(' ' * width + ''.join(f'{name:>{width}}' for name in names))
+    for i, name in enumerate(names):
+        cells = ''.join(f'{"-":>{width}}' if i == j else
+            f'{result["wins"][i][j]}/{result["draws"][i][j]}/{result["losses"][i][j]}'.rjust(width)
+            for j in range(len(names)))
+        print(f'{name:<{width}}' + cells)
+    print('ratings')
+    for rating, name in sorted(zip(result['ratings'], names), reverse=True):
+        print(f'  {name:<{width}} {rating:8.1f}')
+
+# テスト
+
+def test_play():
+    first = envs.JurinaPlayer(action=0)
+    second = envs.JurinaPlayer(action=2)
+    assert(play(first, second, games=250, batch=100) == (250, 0, 0))
+    assert(play(second, first, games=250, batch=100) == (0, 0, 250))
+    assert(play(first, first, games=10, batch=100) == (0, 10, 0))
+
+def test_play_ngram():
+    # 同じ手を出し続ける相手には n-gram プレイヤーがほぼ全勝する
+    win, draw, loss = play(envs.NGramPlayer(), envs.JurinaPlayer(action=2),
+        games=1000, batch=10)
+    assert(win >= 900)
+    win, draw, loss = play(envs.JurinaPlayer(action=2), envs.NGramPlayer(),
+        games=1000, batch=10)
+    assert(loss >= 900)
+
+class _CounterLastMoveModel:
+    """
+    観測の列1を相手の行動とみなし、相手の直前の手に勝つ手を選ぶモデル
+    （方策側として学習したモデルと同じ並びを前提とする）。
+    """
+    def predict(self, observations):
+        return envs.COUNTER_ACTIONS[np.asarray(observations)[:, -1, 1]], None
+
+def test_play_sides():
+    model = envs.AIPlayer(_CounterLastMoveModel())
+    choki = envs.JurinaPlayer(action=2)
+    # 方策側の並びで観測を渡すと、初手以外はすべて勝つ
+    win, _, _ = play(model, choki, games=1000, batch=10, sides=(POLICY_SIDE, ENV_SIDE))
+    assert(win >= 990)
+    _, _, loss = play(choki, model, games=1000, batch=10, sides=(ENV_SIDE, POLICY_SIDE))
+    assert(loss >= 990)
+    # 環境側の並びでは自分の手に勝つ手を出すことになる
+    win, _, _ = play(model, choki, games=1000, batch=10)
+    assert(win < 990)
+
+def test_entrant_side():
+    import tempfile
+    with tempfile.NamedTemporaryFile(suffix='.npz') as f:
+        assert(Entrant.from_model_path(f.name).side == POLICY_SIDE)
+    assert(Entrant.from_spec('NGramPlayer').side == ENV_SIDE)
+    first, second = Entrant.from_spec('NGramPlayer'), Entrant.from_spec('ProbPlayer')
+    assert(pairing_key(first, second, 10, 10) != pairing_key(first, second, 10, 10, length=50))
+
+def test_elo_ratings():
+    wins = np.array([[0, 90, 90], [10, 0, 50], [10, 50, 0]])
+    draws = np.zeros((3, 3))
+    ratings = elo_ratings(wins, draws)
+    assert(ratings[0] > ratings[1])
+    assert(abs(ratings[1] - ratings[2]) < 1e-6)
+    assert(abs(ratings.mean() - 1500.0) < 1e-6)
+
+def test_run_tournament():
+    import tempfile
+    entrants = [Entrant('goo', 'goo', envs.JurinaPlayer, (0,)),
+        Entrant('paa', 'paa', envs.JurinaPlayer, (1,)),
+        Entrant('choki', 'choki', envs.JurinaPlayer, (2,))]
+    with tempfile.TemporaryDirectory() as dirname:
+        cache_path = os.path.join(dirname, 'cache.json')
+        result = run_tournament(entrants, games=100, workers=2, cache_path=cache_path)
+        assert(result['played'] == 3)
+        assert(result['wins'][1][0] == 100 and result['losses'][0][1] == 100)
+        result = run_tournament(entrants, games=100, workers=2, cache_path=cache_path)
+        assert(result['played'] == 0)
+        result = run_tournament(entrants, games=100, workers=2, cache_path=cache_path,
+            length=10)
+        assert(result['played'] == 3)
+
+def test_run_tournament_seed():
+    entrants = [Entrant.from_player_class(envs.ProbPlayer),
+        Entrant.from_player_class(envs.Player), Entrant.from_player_class(envs.EnemyPlayer)]
+    first = run_tournament(entrants, games=500, batch=10, workers=1, seed=5)
+    second = run_tournament(entrants, games=500, batch=10, workers=3, seed=5)
+    assert(first['wins'] == second['wins'] and first['draws'] == second['draws'])
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    entrants = [Entrant.from_spec(spec) for spec in args['<entrant>']]
+    result = run_tournament(entrants,
+        games=int(args['--games']), batch=int(args['--batch']),
+        workers=int(args['--workers']) or None, cache_path=args['--cache'],
+        seed=None if args['--seed'] is None else int(args['--seed']),
+        length=int(args['--length']))
+    print_result(result)
+    with open(args['--output'], 'w') as f:
+        json.dump(result, f, indent=2)
@@ -2,112 +2,386 @@
 """
 トレーニングモジュール
 
+Usage:
+    train.py [--target=<target>] [--path=<path>] [--org_path=<org_path>] [--timesteps=<timesteps>] [--num_envs=<num_envs>] [--workers=<workers>] [--backend=<backend>] [--seed=<seed>] [--length=<n>] [--refresh=<refresh>] [--checkpoint_interval=<steps>] [--keep=<keep>] [--resume]
+
+Options:
+    --target=<target>           train target: all, prob, pa, policy or ngram [default: all]
+    --path=<path>               output model path (single target only)
+    --org_path=<org_path>       opponent model path for policy target [default: prob_ppo]
+    --timesteps=<timesteps>     total timesteps per target [default: 1000000]
+    --num_envs=<num_envs>       number of games stepped at once [default: 8]
+    --workers=<workers>         number of env worker processes [default: 1]
+    --backend=<backend>         vectorization backend: batch, subproc or shmem [default: batch]
+    --seed=<seed>               random seed for envs, players and PPO (default: not reproducible)
+    --length=<n>                observation window (past rounds in each observation) [default: 100]
+    --refresh=<refresh>         policy target: replace opponent with current model every <refresh> steps (0: fixed org_path snapshot) [default: 0]
+    --checkpoint_interval=<steps>   write a checkpoint in background every <steps> steps (0: none) [default: 100000]
+    --keep=<keep>               number of checkpoints kept per target [default: 3]
+    --resume                    resume from the latest checkpoint of each target
+
 (C) Tasuku Hori, 2020
 """
+import copy
 import os
 import time
+from functools import partial
 import gym
 
-from stable_baselines3.common.vec_env import DummyVecEnv
+from docopt import docopt
+from stable_baselines3.common.callbacks import BaseCallback, CallbackList
+from stable_baselines3.common.vec_env import VecMonitor
 from stable_baselines3 import PPO
-from stable_baselines3.common.monitor import Monitor
 
-from envs import RockPaperScissorsEnv, ProbPlayer, JurinaPlayer, AIPlayer
+from checkpoint import CheckpointWriter, load_checkpoint
+from envs import OBSERVATION_LENGTH, ProbPlayer, JurinaPlayer, NGramPlayer, AIPlayer
+from numpy_policy import NumpyPolicy
+from shared_policy import SharedPolicy, SharedPolicyStore
+from vec_envs import BACKENDS, make_batch_vec_env
 
 LOGDIR = './logs'
 os.makedirs(LOGDIR, exist_ok=True)
+# チェックポイントディレクトリ（学習済みモデル毎にサブディレクトリを作成）
+CHECKPOINT_DIR = './checkpoints'
 
 
-def train_prob_ppo(path='prob_ppo'):
+def shared_ai_player(name):
     """
-    1/3の確率で出を出す環境での学習を行う。
+    子プロセス内で共有メモリ上の方策を参照するAIPlayerを生成する。
+    重みはコピーせず、NumPyのみで推論する。
+    引数：
+        name    SharedPolicyStore の共有メモリ名
+    戻り値：
+        AIPlayer インスタンス
+    """
+    return AIPlayer(SharedPolicy(name))
+
+class OpponentRefreshCallback(BaseCallback):
+    """
+    一定ステップ毎に学習中のモデルの重みを公開し、
+    環境側プレイヤーを最新の方策へ差し替えるコールバック。
+    """
+    def __init__(self, publish, interval):
+        """
+        引数：
+            publish     学習中のモデルを受け取り対戦相手を差し替える関数
+                        （SharedPolicyStore.publish など）
+            interval    公開間隔（ステップ数）
+        戻り値：
+            なし
+        """
+        super().__init__()
+        self.publish = publish
+        self.interval = interval
+        self.published_at = 0
+
+    def _on_step(self):
+        if self.num_timesteps - self.published_at >= self.interval:
+            self.publish(self.model)
+            self.published_at = self.num_timesteps
+        return True
+
+def snapshot_state(model):
+    """
+    学習再開に必要な状態のコピーを取得する。
+    モデル・オプティマイザのパラメータ、ステップ数、torch の乱数状態、
+    環境（観測・環境側プレイヤーの乱数系列）の状態を含む。
+    引数：
+        model   学習中のモデル
+    戻り値：
+        状態辞書（学習を続けても変化しない）
+    """
+    import torch
+    env = model.get_env().unwrapped
+    return {
+        'num_timesteps':    model.num_timesteps,
+        'n_updates':        model._n_updates,
+        'parameters':       copy.deepcopy(model.get_parameters()),
+        'torch_rng':        torch.get_rng_state(),
+        'env':              env.get_state() if hasattr(env, 'get_state') else None,
+    }
+
+def restore_state(model, state):
+    """
+    snapshot_state() で取得した状態をモデル・環境へ復元する。
     引数：
-        path    学習済みモデルファイルパス
+        model   復元先のモデル（同じ構成で生成済みであること）
+        state   状態辞書
     戻り値：
         なし
     """
-    print(f'train ppo with prob_player path={path}')
-    # じゃんけん環境の構築
-    env = RockPaperScissorsEnv(ProbPlayer())
-    env = Monitor(env, LOGDIR, allow_early_resets=True)
-    env = DummyVecEnv([lambda: env])
+    import torch
+    model.set_parameters(state['parameters'], exact_match=True)
+    model.num_timesteps = state['num_timesteps']
+    model._n_updates = state['n_updates']
+    torch.set_rng_state(state['torch_rng'])
+    env = model.get_env().unwrapped
+    if state['env'] is not None and hasattr(env, 'set_state'):
+        env.set_state(state['env'])
 
-    # PPOモデルの初期化
-    model = PPO('MlpPolicy', env, verbose=1)
+class AsyncCheckpointCallback(BaseCallback):
+    """
+    一定ステップ毎に学習状態のコピーを取得し、
+    バックグラウンドスレッドでチェックポイントを書き出すコールバック。
+    """
+    def __init__(self, writer, interval):
+        """
+        引数：
+            writer      CheckpointWriter インスタンス
+            interval    書き出し間隔（ステップ数）
+        戻り値：
+            なし
+        """
+        super().__init__()
+        self.writer = writer
+        self.interval = interval
+        self.saved_at = 0
+
+    def _on_training_start(self):
+        self.saved_at = self.num_timesteps
+
+    def _on_step(self):
+        if self.num_timesteps - self.saved_at >= self.interval:
+            self.writer.submit(self.num_timesteps, snapshot_state(self.model))
+            self.saved_at = self.num_timesteps
+        return True
+
+def learn(model, env, path, total_timesteps, callback=None,
+        checkpoint_interval=0, keep=3, resume=False):
+    """
+    トレーニングを実行し、処理時間・ステップ毎秒を表示した後
+    学習済みモデルを保存して環境をクローズする。
+    checkpoint_interval を指定した場合は学習中に定期的にチェックポイントを
+    書き出し、resume を指定した場合は最新のチェックポイントから再開する。
+    引数：
+        model               学習対象モデル
+        env                 じゃんけん環境
+        path                学習済みモデルファイルパス
+        total_timesteps     総ステップ数（再開時は再開前のステップ数を含む）
+        callback            stable_baselines3 のコールバック
+        checkpoint_interval チェックポイントの書き出し間隔（ステップ数、0:書き出さない）
+        keep                保持するチェックポイント数
+        resume              真：最新のチェックポイントから再開する
+    戻り値：
+        steps/sec
+    """
+    writer = CheckpointWriter(os.path.join(CHECKPOINT_DIR, os.path.basename(path)),
+        prefix=os.path.basename(path), keep=keep)
+    callbacks = [] if callback is None else [callback]
+    if checkpoint_interval > 0:
+        callbacks.append(AsyncCheckpointCallback(writer, checkpoint_interval))
+    latest = writer.latest() if resume else None
+    if latest is not None:
+        restore_state(model, load_checkpoint(latest))
+        print(f'resume from {latest} ({model.num_timesteps} steps)')
+    started = model.num_timesteps
 
     # トレーニング実行
     elapsed = time.time()
-    model.learn(total_timesteps=1000000)
-    print(f'elapse time: {time.time() - elapsed}sec')
+    try:
+        model.learn(total_timesteps=max(0, total_timesteps - started),
+            callback=CallbackList(callbacks), reset_num_timesteps=latest is None)
+    finally:
+        writer.close()
+    elapsed = time.time() - elapsed
+    steps_per_sec = (model.num_timesteps - started) / elapsed
+    print(f'elapse time: {elapsed}sec')
+    print(f'{model.num_timesteps} steps, {steps_per_sec:.1f} steps/sec ' + \
+        f'(num_envs={env.num_envs})')
 
     # 学習済みモデルの保存
     model.save(path)
 
     # じゃんけん環境のクローズ
     env.close()
+    return steps_per_sec
 
-def train_pa_ppo(path='pa_ppo'):
+def train_prob_ppo(path='prob_ppo', num_envs=8, total_timesteps=1000000,
+        workers=1, backend='batch', seed=None, checkpoint_interval=0, keep=3,
+        resume=False, length=OBSERVATION_LENGTH):
     """
     1/3の確率で出を出す環境での学習を行う。
     引数：
-        path    学習済みモデルファイルパス
+        path            学習済みモデルファイルパス
+        num_envs        同時に進める環境数
+        total_timesteps 総ステップ数
+        workers         環境を実行する子プロセス数
+        backend         ベクトル化方式（batch, subproc, shmem）
+        seed            乱数シード（None の場合再現性なし）
+        checkpoint_interval チェックポイントの書き出し間隔（ステップ数、0:書き出さない）
+        keep            保持するチェックポイント数
+        resume          真：最新のチェックポイントから再開する
+        length          観測長
     戻り値：
         なし
     """
-    print(f'train ppo with jurina_player path={path}')
+    print(f'train ppo with prob_player path={path}')
     # じゃんけん環境の構築
-    env = RockPaperScissorsEnv(JurinaPlayer())
-    env = Monitor(env, LOGDIR, allow_early_resets=True)
-    env = DummyVecEnv([lambda: env])
+    env = make_batch_vec_env(ProbPlayer, num_envs=num_envs,
+        workers=workers, backend=backend, seed=seed, length=length)
+    env = VecMonitor(env, LOGDIR)
 
     # PPOモデルの初期化
-    model = PPO('MlpPolicy', env, verbose=1)
+    model = PPO('MlpPolicy', env, verbose=1, seed=seed)
 
-    # トレーニング実行
-    elapsed = time.time()
-    model.learn(total_timesteps=1000000)
-    print(f'elapse time: {time.time() - elapsed}sec')
+    # トレーニング実行・保存
+    learn(model, env, path, total_timesteps, checkpoint_interval=checkpoint_interval,
+        keep=keep, resume=resume)
 
-    # 学習済みモデルの保存
-    model.save(path)
+def train_pa_ppo(path='pa_ppo', num_envs=8, total_timesteps=1000000,
+        workers=1, backend='batch', seed=None, checkpoint_interval=0, keep=3,
+        resume=False, length=OBSERVATION_LENGTH):
+    """
+    1/3の確率で出を出す環境での学習を行う。
+    引数：
+        path            学習済みモデルファイルパス
+        num_envs        同時に進める環境数
+        total_timesteps 総ステップ数
+        workers         環境を実行する子プロセス数
+        backend         ベクトル化方式（batch, subproc, shmem）
+        seed            乱数シード（None の場合再現性なし）
+        checkpoint_interval チェックポイントの書き出し間隔（ステップ数、0:書き出さない）
+        keep            保持するチェックポイント数
+        resume          真：最新のチェックポイントから再開する
+        length          観測長
+    戻り値：
+        なし
+    """
+    print(f'train ppo with jurina_player path={path}')
+    # じゃんけん環境の構築
+    env = make_batch_vec_env(JurinaPlayer, num_envs=num_envs,
+        workers=workers, backend=backend, seed=seed, length=length)
+    env = VecMonitor(env, LOGDIR)
 
-    # じゃんけん環境のクローズ
-    env.close()
+    # PPOモデルの初期化
+    model = PPO('MlpPolicy', env, verbose=1, seed=seed)
 
-def train_policy_ppo(path='policy_ppo', org_path='prob_ppo'):
+    # トレーニング実行・保存
+    learn(model, env, path, total_timesteps, checkpoint_interval=checkpoint_interval,
+        keep=keep, resume=resume)
+
+def train_ngram_ppo(path='ngram_ppo', num_envs=8, total_timesteps=1000000,
+        workers=1, backend='batch', seed=None, checkpoint_interval=0, keep=3,
+        resume=False, length=OBSERVATION_LENGTH):
     """
-    学習済み方策をつかった環境を相手にトレーニングを行う
+    直前の手の並びから次の手を予測して勝つ手を出す環境での学習を行う。
     引数：
-        path        学習済みモデルファイルパス
-        org_path    学習元となる方策がロードする学習済みモデルファイルパス
+        path            学習済みモデルファイルパス
+        num_envs        同時に進める環境数
+        total_timesteps 総ステップ数
+        workers         環境を実行する子プロセス数
+        backend         ベクトル化方式（batch, subproc, shmem）
+        seed            乱数シード（None の場合再現性なし）
+        checkpoint_interval チェックポイントの書き出し間隔（ステップ数、0:書き出さない）
+        keep            保持するチェックポイント数
+        resume          真：最新のチェックポイントから再開する
+        length          観測長
+    戻り値：
+        なし
     """
-    print(f'train ppo with prob_player path={path}, org_path={org_path}')
-    # 学習済みモデルファイルのロード
-    model = PPO.load(org_path)
-    
+    print(f'train ppo with ngram_player path={path}')
     # じゃんけん環境の構築
-    env = RockPaperScissorsEnv(AIPlayer(model))
-    env = Monitor(env, LOGDIR, allow_early_resets=True)
-    env = DummyVecEnv([lambda: env])
+    env = make_batch_vec_env(NGramPlayer, num_envs=num_envs,
+        workers=workers, backend=backend, seed=seed, length=length)
+    env = VecMonitor(env, LOGDIR)
 
-    # モデルのセット
-    model.set_env(env)
+    # PPOモデルの初期化
+    model = PPO('MlpPolicy', env, verbose=1, seed=seed)
 
-    # トレーニング実行
-    elapsed = time.time()
-    model.learn(total_timesteps=1000000)
-    print(f'elapse time: {time.time() - elapsed}sec')
+    # トレーニング実行・保存
+    learn(model, env, path, total_timesteps, checkpoint_interval=checkpoint_interval,
+        keep=keep, resume=resume)
 
-    # 学習済みモデルの保存
-    model.save(path)
+def train_policy_ppo(path='policy_ppo', org_path='prob_ppo', num_envs=8,
+        total_timesteps=1000000, workers=1, backend='batch', seed=None, refresh=0,
+        checkpoint_interval=0, keep=3, resume=False, length=OBSERVATION_LENGTH):
+    """
+    学習済み方策をつかった環境を相手にトレーニングを行う。
+    ベクトル化方式によらず、org_pathの方策の重みのコピー（学習しても変化しない）を
+    環境側プレイヤーとする。batch の場合はプロセス内に NumpyPolicy として保持し、
+    subproc/shmem の場合は共有メモリへ1回だけ配置して全子プロセスが参照する。
+    refresh を指定した場合、refresh ステップ毎に学習中のモデルの重みのコピーで
+    対戦相手を差し替える（subproc/shmem は子プロセスを再起動しない）。
+    引数：
+        path            学習済みモデルファイルパス
+        org_path        学習元となる方策がロードする学習済みモデルファイルパス
+        num_envs        同時に進める環境数
+        total_timesteps 総ステップ数
+        workers         環境を実行する子プロセス数
+        backend         ベクトル化方式（batch, subproc, shmem）
+        seed            乱数シード（None の場合再現性なし）
+        refresh         対戦相手の差し替え間隔（ステップ数、0:差し替えない）
+        checkpoint_interval チェックポイントの書き出し間隔（ステップ数、0:書き出さない）
+        keep            保持するチェックポイント数
+        resume          真：最新のチェックポイントから再開する
+        length          観測長
+    """
+    print(f'train ppo with prob_player path={path}, org_path={org_path}')
+    # じゃんけん環境の構築（batch の場合環境側プレイヤーはモデルロード後にセット、
+    # それ以外は子プロセスが共有メモリの方策を最初の推論時に参照する）
+    store = None
+    if backend == 'batch':
+        player_fn = lambda: None
+    else:
+        store = SharedPolicyStore()
+        player_fn = partial(shared_ai_player, store.name)
+    env = make_batch_vec_env(player_fn, num_envs=num_envs,
+        workers=workers, backend=backend, seed=seed, length=length)
+    env = VecMonitor(env, LOGDIR)
 
-    # じゃんけん環境のクローズ
-    env.close()
+    # 学習済みモデルファイルのロード
+    # ロールアウトバッファを環境数に合わせるためenvを指定してロードする
+    model = PPO.load(org_path, env=env)
+    if backend == 'batch':
+        def publish(model):
+            env.set_attr('player', AIPlayer(NumpyPolicy.from_model(model)))
+    else:
+        publish = store.publish
+    publish(model)
+    callback = OpponentRefreshCallback(publish, refresh) if refresh > 0 else None
+    if seed is not None:
+        model.set_random_seed(seed)
+
+    # トレーニング実行・保存
+    try:
+        learn(model, env, path, total_timesteps, callback=callback,
+            checkpoint_interval=checkpoint_interval, keep=keep, resume=resume)
+    finally:
+        if store is not None:
+            store.close()
 
 if __name__ == '__main__':
     """
-    各々トレーニング実行する。
+    起動時のオプションに従いトレーニング実行する。
     """
-    train_prob_ppo()
-    train_pa_ppo()
-    train_policy_ppo()
+    args = docopt(__doc__)
+    target = args['--target']
+    backend = args['--backend']
+    if target not in ['all', 'prob', 'pa', 'policy', 'ngram']:
+        raise ValueError(f'target={target}: no match argument')
+    if backend not in BACKENDS:
+        raise ValueError(f'backend={backend}: no match argument')
+    if target == 'all' and args['--path'] is not None:
+        raise ValueError('--path is available for single target only')
+    options = {
+        'num_envs':         int(args['--num_envs']),
+        'total_timesteps':  int(args['--timesteps']),
+        'workers':          int(args['--workers']),
+        'backend':          backend,
+        'seed':             None if args['--seed'] is None else int(args['--seed']),
+        'checkpoint_interval':  int(args['--checkpoint_interval']),
+        'keep':             int(args['--keep']),
+        'resume':           args['--resume'],
+        'length':           int(args['--length']),
+    }
+    if args['--path'] is not None:
+        options['path'] = args['--path']
+    if target in ['all', 'prob']:
+        train_prob_ppo(**options)
+    if target in ['all', 'pa']:
+        train_pa_ppo(**options)
+    if target in ['all', 'policy']:
+        train_policy_ppo(org_path=args['--org_path'],
+            refresh=int(args['--refresh']), **options)
+    if target == 'ngram':
+        train_ngram_ppo(**options)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+じゃんけんの対戦履歴（エピソード番号, ステップ番号, 方策側行動, 環境側行動, 報酬）を
+固定長バイナリレコードとして書き出し、メモリマップで読み込むモジュール。
+
+ファイル形式：
+    ヘッダ(16バイト)：マジック(8バイト) + 形式バージョン(uint32) + レコード長(uint32)
+    レコード(15バイト)：episode(uint64) + step(uint32) + policy_action(int8)
+                        + env_action(int8) + reward(int8)
+形式バージョン1（episode が uint32 の11バイトレコード）のファイルも読み込める。
+"""
+import os
+import queue
+import struct
+import threading
+
+import numpy as np
+
+# ファイル先頭のマジック
+MAGIC = b'RPSTRAJ\0'
+# ファイル形式バージョン
+FORMAT_VERSION = 2
+# ヘッダ形式
+HEADER = struct.Struct('<8sII')
+# レコード形式（エピソード番号はセッションIDのハッシュ値を格納できるよう64ビット）
+RECORD_DTYPE = np.dtype([
+    ('episode',         '<u8'),
+    ('step',            '<u4'),
+    ('policy_action',   'i1'),
+    ('env_action',      'i1'),
+    ('reward',          'i1'),
+])
+# 形式バージョン毎のレコード形式（読み込み用）
+RECORD_DTYPES = {
+    1: np.dtype([
+        ('episode',         '<u4'),
+        ('step',            '<u4'),
+        ('policy_action',   'i1'),
+        ('env_action',      'i1'),
+        ('reward',          'i1'),
+    ]),
+    FORMAT_VERSION: RECORD_DTYPE,
+}
+
+class TrajectoryWriter:
+    """
+    対戦履歴をバッファリングしてファイルへ追記するクラス。
+    レコードは確保済みの配列へ格納し、満杯になった時点でまとめて書き出す。
+    background=True の場合、書き出しはバックグラウンドスレッドで行い、
+    呼び出し元はファイルI/Oを待たない。
+    """
+    def __init__(self, path, buffer_size=65536, background=False):
+        """
+        ファイルを追記モードで開き、新規ファイルの場合はヘッダを書き込む。
+        引数：
+            path            出力ファイルパス
+            buffer_size     バッファリングするレコード数
+            background      真：バックグラウンドスレッドで書き出す
+        戻り値：
+            なし
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists and read_header(path) != FORMAT_VERSION:
+            raise ValueError(f'path={path}: cannot append to an older format file')
+        self.file = open(path, 'ab')
+        if not exists:
+            self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION, RECORD_DTYPE.itemsize))
+        self.buffer = np.empty(buffer_size, dtype=RECORD_DTYPE)
+        self.count = 0
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        if background:
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def write(self, episode, step, policy_action, env_action, reward):
+        """
+        1レコードを書き込む。
+        引数：
+            episode         エピソード番号
+            step            ステップ番号
+            policy_action   方策側行動
+            env_action      環境側行動
+            reward          方策側報酬
+        戻り値：
+            なし
+        """
+        with self.lock:
+            self.buffer[self.count] = (episode, step, policy_action, env_action, reward)
+            self.count += 1
+            if self.count >= self.buffer_size:
+                self._flush_buffer()
+
+    def write_batch(self, episodes, steps, policy_actions, env_actions, rewards):
+        """
+        複数レコードをまとめて書き込む（ベクトル化環境用）。
+        引数：
+            episodes        エピソード番号の配列
+            steps           ステップ番号の配列
+            policy_actions  方策側行動の配列
+            env_actions     環境側行動の配列
+            rewards         方策側報酬の配列
+        戻り値：
+            なし
+        """
+        records = np.empty(len(policy_actions), dtype=RECORD_DTYPE)
+        records['episode'] = episodes
+        records['step'] = steps
+        records['policy_action'] = policy_actions
+        records['env_action'] = env_actions
+        records['reward'] = rewards
+        with self.lock:
+            start = 0
+            while start < len(records):
+                size = min(len(records) - start, self.buffer_size - self.count)
+                self.buffer[self.count:self.count + size] = records[start:start + size]
+                self.count += size
+                start += size
+                if self.count >= self.buffer_size:
+                    self._flush_buffer()
+
+    def _flush_buffer(self):
+        """
+        バッファの内容を書き出す（lock を取得した状態で呼び出すこと）。
+        """
+        if self.count <= 0:
+            return
+        if self.queue is not None:
+            # バッファごと書き出しスレッドへ渡し、新しいバッファへ切り替える
+            self.queue.put(self.buffer[:self.count])
+            self.buffer = np.empty(self.buffer_size, dtype=RECORD_DTYPE)
+        else:
+            self.file.write(self.buffer[:self.count].tobytes())
+        self.count = 0
+
+    def _run(self):
+        """
+        書き出しスレッド本体。
+        """
+        while True:
+            records = self.queue.get()
+            if records is None:
+                return
+            self.file.write(records.tobytes())
+
+    def flush(self):
+        """
+        バッファの内容をファイルへ書き出す。
+        """
+        with self.lock:
+            self._flush_buffer()
+            if self.queue is None:
+                self.file.flush()
+
+    def close(self):
+        """
+        バッファの内容を書き出してファイルを閉じる。
+        """
+        with self.lock:
+            if self.file.closed:
+                return
+            self._flush_buffer()
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_header(path):
+    """
+    ヘッダを読み込み、形式を検証する。
+    引数：
+        path    対戦履歴ファイルパス
+    戻り値：
+        形式バージョン
+    """
+    with open(path, 'rb') as f:
+        magic, version, record_size = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f'path={path}: not a trajectory file')
+    if version not in RECORD_DTYPES or record_size != RECORD_DTYPES[version].itemsize:
+        raise ValueError(f'path={path}: unsupported format version={version}')
+    return version
+
+def read_trajectory(path):
+    """
+    対戦履歴ファイルをメモリマップで読み込む。
+    ファイル全体をPythonオブジェクトへ展開せず、列は
+    records['policy_action'] のように配列ビューとして参照できる。
+    引数：
+        path    対戦履歴ファイルパス
+    戻り値：
+        レコード配列（numpy.memmap、ファイルの形式バージョンの RECORD_DTYPES）
+    """
+    dtype = RECORD_DTYPES[read_header(path)]
+    count = (os.path.getsize(path) - HEADER.size) // dtype.itemsize
+    if count <= 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r',
+        offset=HEADER.size, shape=(count,))
+
+# テスト
+
+def test_trajectory():
+    import tempfile
+    with tempfile.TemporaryDirectory() as dirname:
+        path = os.path.join(dirname, 'trajectory.bin')
+        for background in [False, True]:
+            if os.path.exists(path):
+                os.remove(path)
+            with TrajectoryWriter(path, buffer_size=7, background=background) as writer:
+                for i in range(20):
+                    writer.write(i // 5, i, i % 3, (i + 1) % 3, -1)
+                writer.write_batch(np.full(10, 9), np.arange(20, 30),
+                    np.zeros(10), np.ones(10), np.full(10, -10))
+            # 追記
+            with TrajectoryWriter(path) as writer:
+                writer.write(10, 30, 2, 1, 10)
+            records = read_trajectory(path)
+            assert(len(records) == 31)
+            assert(records['step'].tolist() == list(range(31)))
+            assert(records['episode'][:5].tolist() == [0] * 5)
+            assert(records['reward'][20:30].tolist() == [-10] * 10)
+            assert(records[30]['policy_action'] == 2)
+            del records
+        # 64ビットのエピソード番号
+        with TrajectoryWriter(path) as writer:
+            writer.write(2 ** 63 + 5, 31, 0, 0, -1)
+        assert(read_trajectory(path)['episode'][-1] == 2 ** 63 + 5)
+        # 形式バージョン1のファイルも読み込める（追記はできない）
+        old = os.path.join(dirname, 'v1.bin')
+        with open(old, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, 1, RECORD_DTYPES[1].itemsize))
+            f.write(np.array([(7, 3, 1, 2, 10)], dtype=RECORD_DTYPES[1]).tobytes())
+        records = read_trajectory(old)
+        assert(records['episode'].tolist() == [7] and records['step'].tolist() == [3])
+        del records
+        try:
+            TrajectoryWriter(old)
+            assert(False)
+        except ValueError:
+            pass
+
+if __name__ == '__main__':
+    test_trajectory()
@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+"""
+N個のじゃんけん対戦を1回のNumPy演算でまとめて進める
+Stable Baselines3 VecEnv 実装を提供するモジュール。
+"""
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from gym import spaces
+from stable_baselines3.common.vec_env import VecEnv
+from stable_baselines3.common.vec_env.base_vec_env import CloudpickleWrapper
+
+from envs import OBSERVATION_LENGTH, REWARD_TABLE, spawn_seeds
+
+# ベクトル化方式
+BACKENDS = ['batch', 'subproc', 'shmem']
+
+class BatchRockPaperScissorsEnv(VecEnv):
+    """
+    RockPaperScissorsEnv をN個まとめて保持するVecEnvクラス。
+    観測は (N, 2×length, 2) のリングバッファ上に保持し、
+    報酬は報酬表の参照、エピソード完了判定は一括比較で算出する。
+    """
+    def __init__(self, player, num_envs=8, length=OBSERVATION_LENGTH, seed=None):
+        """
+        環境側プレイヤー・環境数を格納し、
+        行動空間・観測空間の定義と観測の初期化を行う。
+        引数：
+            player      環境側プレイヤーインスタンス（predict_batchを使用）
+            num_envs    同時に進める環境数
+            length      観測長
+            seed        乱数シード（指定した場合は環境側プレイヤーも子シードで初期化する）
+        戻り値：
+            なし
+        """
+        # 行動空間・観測空間は RockPaperScissorsEnv と同一
+        action_space = spaces.Discrete(2)
+        observation_space = spaces.Box(
+            low=0, high=2, shape=(length, 2), dtype=np.int8)
+        super().__init__(num_envs, observation_space, action_space)
+        self.player = player
+        self.length = length
+        env_seed, player_seed = spawn_seeds(seed, 2)
+        self.rng = np.random.default_rng(env_seed)
+        if seed is not None and hasattr(player, 'seed'):
+            player.seed(player_seed)
+        # 同じ内容を前半・後半に持つリングバッファ（全環境で先頭位置を共有）
+        self.buffer = np.zeros((num_envs, 2 * length, 2), dtype=np.int8)
+        self.head = 0
+        self.actions = None
+        self.init_observations()
+
+    def init_observations(self):
+        """
+        全環境の観測を乱数で初期化する。
+        引数：
+            なし
+        戻り値：
+            なし
+        """
+        values = self.rng.integers(
+            0, 2, size=(self.num_envs, self.length, 2), dtype=np.int8)
+        self.buffer[:, :self.length] = values
+        self.buffer[:, self.length:] = values
+        self.head = 0
+
+    def observations(self):
+        """
+        古い順に並んだ全環境の観測ビューを取得する。
+        引数：
+            なし
+        戻り値：
+            観測 (N, length, 2) int8 配列ビュー
+        """
+        return self.buffer[:, self.head:self.head + self.length]
+
+    def reset(self):
+        """
+        エピソード開始時の観測を取得する。
+        RockPaperScissorsEnv と同様に観測はリセットしない。
+        引数：
+            なし
+        戻り値：
+            観測 (N, length, 2)
+        """
+        return self.observations().copy()
+
+    def step_async(self, actions):
+        """
+        方策が選択した行動を格納する。
+        引数：
+            actions     方策側行動の配列 (N,)
+        戻り値：
+            なし
+        """
+        self.actions = actions
+
+    def step_wait(self):
+        """
+        格納済みの方策側行動と環境側プレイヤーの行動で全環境を1ステップ進める。
+        引数：
+            なし
+        戻り値：
+            observations    更新後の観測 (N, length, 2)
+            rewards         報酬値 (N,)
+            dones           エピソード完 (N,)
+            infos           その他情報（完了した環境はterminal_observationを含む）
+        """
+        policy_actions = np.asarray(self.actions, dtype=np.int64).reshape(-1)
+        env_actions = np.asarray(
+            self.player.predict_batch(self.observations()), dtype=np.int64)
+        # リングバッファの最古の位置を最新の両者の手で上書き
+        head = self.head
+        self.buffer[:, head, 0] = policy_actions
+        self.buffer[:, head, 1] = env_actions
+        self.buffer[:, head + self.length] = self.buffer[:, head]
+        self.head = head + 1 if head + 1 < self.length else 0
+
+        rewards = REWARD_TABLE[policy_actions, env_actions]
+        dones = policy_actions != env_actions
+        # 観測はリセットしないため、完了した環境の終端観測は返却する観測と同一
+        observations = self.observations().copy()
+        infos = [{} for _ in range(self.num_envs)]
+        for i in np.flatnonzero(dones):
+            infos[i]['terminal_observation'] = observations[i]
+        return observations, rewards, dones, infos
+
+    def close(self):
+        """
+        何もしない。
+        """
+        pass
+
+    def seed(self, seed=None):
+        """
+        観測初期化用の乱数生成器と環境側プレイヤーの乱数系列を
+        同じシードから生成した子シードで再生成する。
+        引数：
+            seed        乱数シード
+        戻り値：
+            各環境のシードリスト
+        """
+        env_seed, player_seed = spawn_seeds(seed, 2)
+        self.rng = np.random.default_rng(env_seed)
+        if hasattr(self.player, 'seed'):
+            self.player.seed(player_seed)
+        return [seed] * self.num_envs
+
+    def get_state(self):
+        """
+        観測・乱数系列の状態を取得する（学習再開用）。
+        引数：
+            なし
+        戻り値：
+            状態辞書
+        """
+        get_player_state = getattr(self.player, 'get_state', None)
+        return {
+            'rng':      self.rng.bit_generator.state,
+            'player':   None if get_player_state is None else get_player_state(),
+            'buffer':   self.buffer.copy(),
+            'head':     self.head,
+        }
+
+    def set_state(self, state):
+        """
+        get_state() で取得した状態を復元する。
+        引数：
+            state   状態辞書
+        戻り値：
+            なし
+        """
+        self.rng.bit_generator.state = state['rng']
+        if state['player'] is not None and hasattr(self.player, 'set_state'):
+            self.player.set_state(state['player'])
+        self.buffer[:] = state['buffer']
+        self.head = state['head']
+
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(self, attr_name)] * len(self._get_indices(indices))
+
+    def set_attr(self, attr_name, value, indices=None):
+        setattr(self, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        # 全環境を1つのオブジェクトで扱うため、メソッドは1回だけ呼び出す
+        result = getattr(self, method_name)(*method_args, **method_kwargs)
+        return [result] * len(self._get_indices(indices))
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [False] * len(self._get_indices(indices))
+
+    def _get_indices(self, indices):
+        if indices is None:
+            return range(self.num_envs)
+        if isinstance(indices, int):
+            return [indices]
+        return indices
+
+def _worker(remote, parent_remote, player_fn_wrapper, num_envs, length, shm_spec,
+        seed=None):
+    """
+    子プロセス側でBatchRockPaperScissorsEnvを実行する。
+    shm_specが指定された場合、行動・観測・報酬・完了フラグは共有メモリ上で
+    受け渡し、パイプではコマンドのみ送受信する。
+    引数：
+        remote              子プロセス側パイプ
+        parent_remote       親プロセス側パイプ（子プロセスでは閉じる）
+        player_fn_wrapper   環境側プレイヤー生成関数（CloudpickleWrapper）
+        num_envs            子プロセスが担当する環境数
+        length              観測長
+        shm_spec            (共有メモリ名辞書, 担当開始位置) または None
+        seed                子プロセス用の子シード（SeedSequence）または None
+    戻り値：
+        なし
+    """
+    parent_remote.close()
+    env = BatchRockPaperScissorsEnv(
+        player_fn_wrapper.var(), num_envs=num_envs, length=length, seed=seed)
+    shms, arrays = [], None
+    if shm_spec is not None:
+        names, start = shm_spec
+        shms, arrays = _attach_shared_arrays(names)
+        arrays = {key: value[start:start + num_envs]
+            for key, value in arrays.items()}
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                if arrays is not None:
+                    observations, rewards, dones, _ = env.step(
+                        arrays['actions'].copy())
+                    arrays['observations'][:] = observations
+                    arrays['rewards'][:] = rewards
+                    arrays['dones'][:] = dones
+                    remote.send(None)
+                else:
+                    observations, rewards, dones, _ = env.step(data)
+                    remote.send((observations, rewards, dones))
+            elif cmd == 'reset':
+                observations = env.reset()
+                if arrays is not None:
+                    arrays['observations'][:] = observations
+                    remote.send(None)
+                else:
+                    remote.send(observations)
+            elif cmd == 'seed':
+                remote.send(env.seed(data))
+            elif cmd == 'get_attr':
+                remote.send(getattr(env, data))
+            elif cmd == 'set_attr':
+                remote.send(setattr(env, data[0], data[1]))
+            elif cmd == 'env_method':
+                name, args, kwargs = data
+                remote.send(getattr(env, name)(*args, **kwargs))
+            elif cmd == 'close':
+                remote.close()
+                break
+            else:
+                raise NotImplementedError(f'cmd={cmd}: not implemented')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # 配列ビューを解放してから共有メモリを閉じる
+        arrays = None
+        for shm in shms:
+            shm.close()
+
+def _shared_array_specs(num_envs, length):
+    """
+    共有メモリ上に配置する配列の形状・型を取得する。
+    """
+    return {
+        'actions':      ((num_envs,), np.int64),
+        'observations': ((num_envs, length, 2), np.int8),
+        'rewards':      ((num_envs,), np.float32),
+        'dones':        ((num_envs,), np.bool_),
+    }
+
+def _attach_shared_arrays(names):
+    """
+    共有メモリ名辞書から共有メモリへ接続し、配列ビューを生成する。
+    引数：
+        names   {配列名: (共有メモリ名, 形状, 型)}
+    戻り値：
+        shms    共有メモリリスト
+        arrays  {配列名: 配列ビュー}
+    """
+    shms, arrays = [], {}
+    for key, (name, shape, dtype) in names.items():
+        shm = SharedMemory(name=name)
+        shms.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return shms, arrays
+
+class SubprocBatchEnv(VecEnv):
+    """
+    複数の子プロセスそれぞれでBatchRockPaperScissorsEnvを実行するVecEnvクラス。
+    shared_memory=True の場合、ステップ毎のデータは共有メモリ上で受け渡し、
+    パイプによるシリアライズを行わない。
+    """
+    def __init__(self, player_fn, num_envs=8, workers=2, length=OBSERVATION_LENGTH,
+            shared_memory=False, start_method=None, seed=None):
+        """
+        子プロセスを起動する。
+        引数：
+            player_fn       環境側プレイヤー生成関数（子プロセス毎に呼び出す）
+            num_envs        全子プロセス合計の環境数
+            workers         子プロセス数
+            length          観測長
+            shared_memory   真：共有メモリでデータを受け渡す
+            start_method    multiprocessing 起動方式
+            seed            乱数シード（子プロセス毎に子シードを生成して渡す）
+        戻り値：
+            なし
+        """
+        action_space = spaces.Discrete(2)
+        observation_space = spaces.Box(
+            low=0, high=2, shape=(length, 2), dtype=np.int8)
+        super().__init__(num_envs, observation_space, action_space)
+        workers = max(1, min(workers, num_envs))
+        # 各子プロセスの担当環境数
+        self.sizes = [len(part) for part in np.array_split(np.arange(num_envs), workers)]
+        self.starts = np.cumsum([0] + self.sizes[:-1]).tolist()
+        self.closed = False
+        self.waiting = False
+
+        self.shms, self.arrays = [], None
+        names = None
+        if shared_memory:
+            names, self.arrays = {}, {}
+            for key, (shape, dtype) in _shared_array_specs(num_envs, length).items():
+                size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                shm = SharedMemory(create=True, size=size)
+                self.shms.append(shm)
+                names[key] = (shm.name, shape, dtype)
+                self.arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+        if start_method is None:
+            start_method = 'forkserver' \
+                if 'forkserver' in mp.get_all_start_methods() else 'spawn'
+        ctx = mp.get_context(start_method)
+        self.remotes, work_remotes = zip(*[ctx.Pipe() for _ in range(workers)])
+        seeds = self._worker_seeds(seed)
+        self.processes = []
+        for work_remote, remote, size, start, worker_seed in zip(
+                work_remotes, self.remotes, self.sizes, self.starts, seeds):
+            shm_spec = None if names is None else (names, start)
+            args = (work_remote, remote, CloudpickleWrapper(player_fn),
+                size, length, shm_spec, worker_seed)
+            process = ctx.Process(target=_worker, args=args, daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        results = [remote.recv() for remote in self.remotes]
+        if self.arrays is not None:
+            return self.arrays['observations'].copy()
+        return np.concatenate(results)
+
+    def step_async(self, actions):
+        actions = np.asarray(actions, dtype=np.int64).reshape(-1)
+        if self.arrays is not None:
+            self.arrays['actions'][:] = actions
+        for remote, size, start in zip(self.remotes, self.sizes, self.starts):
+            remote.send(('step', None if self.arrays is not None \
+                else actions[start:start + size]))
+        self.waiting = True
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        if self.arrays is not None:
+            observations = self.arrays['observations'].copy()
+            rewards = self.arrays['rewards'].copy()
+            dones = self.arrays['dones'].copy()
+        else:
+            observations, rewards, dones = (np.concatenate(values)
+                for values in zip(*results))
+        # 観測はリセットしないため、完了した環境の終端観測は返却する観測と同一
+        infos = [{} for _ in range(self.num_envs)]
+        for i in np.flatnonzero(dones):
+            infos[i]['terminal_observation'] = observations[i]
+        return observations, rewards, dones, infos
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.arrays = None
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.closed = True
+
+    def _worker_seeds(self, seed):
+        """
+        子プロセス毎の子シードを生成する。
+        シードが指定されない場合は各子プロセスでOSの乱数から生成させる。
+        """
+        if seed is None:
+            return [None] * len(self.sizes)
+        return spawn_seeds(seed, len(self.sizes))
+
+    def seed(self, seed=None):
+        for remote, worker_seed in zip(self.remotes, self._worker_seeds(seed)):
+            remote.send(('seed', worker_seed))
+        for remote in self.remotes:
+            remote.recv()
+        return [seed] * self.num_envs
+
+    def get_state(self):
+        """
+        全子プロセスの観測・乱数系列の状態を取得する（学習再開用）。
+        """
+        for remote in self.remotes:
+            remote.send(('env_method', ('get_state', (), {})))
+        return [remote.recv() for remote in self.remotes]
+
+    def set_state(self, states):
+        """
+        get_state() で取得した全子プロセスの状態を復元する。
+        """
+        for remote, state in zip(self.remotes, states):
+            remote.send(('env_method', ('set_state', (state,), {})))
+        for remote in self.remotes:
+            remote.recv()
+
+    def get_attr(self, attr_name, indices=None):
+        return self._call_workers('get_attr', attr_name, indices)
+
+    def set_attr(self, attr_name, value, indices=None):
+        for remote in self._get_remotes(indices):
+            remote.send(('set_attr', (attr_name, value)))
+            remote.recv()
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return self._call_workers('env_method',
+            (method_name, method_args, method_kwargs), indices)
+
+    def _call_workers(self, cmd, data, indices):
+        """
+        指定環境を担当する子プロセスへ1回ずつコマンドを送り、
+        結果を環境毎に並べて返却する（子プロセスは担当する全環境を1つの
+        オブジェクトで扱うため、同じ子プロセスの環境には同じ結果を返す）。
+        """
+        workers = [self._worker_index(i) for i in self._get_indices(indices)]
+        targets = list(dict.fromkeys(workers))
+        for worker in targets:
+            self.remotes[worker].send((cmd, data))
+        results = {worker: self.remotes[worker].recv() for worker in targets}
+        return [results[worker] for worker in workers]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [False] * len(self._get_indices(indices))
+
+    def _get_indices(self, indices):
+        if indices is None:
+            return range(self.num_envs)
+        if isinstance(indices, int):
+            return [indices]
+        return indices
+
+    def _worker_index(self, index):
+        return int(np.searchsorted(self.starts, index, side='right')) - 1
+
+    def _get_remotes(self, indices):
+        workers = sorted({self._worker_index(i) for i in self._get_indices(indices)})
+        return [self.remotes[i] for i in workers]
+
+def make_batch_vec_env(player_fn, num_envs=8, workers=1, backend='batch', seed=None,
+        length=OBSERVATION_LENGTH):
+    """
+    ベクトル化方式を指定してじゃんけん環境を生成する。
+    引数：
+        player_fn   環境側プレイヤー生成関数
+        num_envs    同時に進める環境数
+        workers     子プロセス数（batch の場合は使用しない）
+        backend     batch:プロセス内、subproc:子プロセス(パイプ)、
+                    shmem:子プロセス(共有メモリ)
+        seed        乱数シード（None の場合再現性なし）
+        length      観測長
+    戻り値：
+        VecEnv インスタンス
+    """
+    if backend == 'batch':
+        return BatchRockPaperScissorsEnv(player_fn(), num_envs=num_envs,
+            length=length, seed=seed)
+    elif backend == 'subproc':
+        return SubprocBatchEnv(player_fn, num_envs=num_envs, workers=workers,
+            length=length, seed=seed)
+    elif backend == 'shmem':
+        return SubprocBatchEnv(player_fn, num_envs=num_envs, workers=workers,
+            length=length, shared_memory=True, seed=seed)
+    else:
+        raise ValueError(f'backend={backend}: no match argument')
+
+# テスト
+
+def test_step():
+    from envs import JurinaPlayer
+    env = BatchRockPaperScissorsEnv(JurinaPlayer(action=1), num_envs=4)
+    observations = env.reset()
+    assert(observations.shape == (4, 100, 2))
+    assert(observations.dtype == np.int8)
+    for _ in range(150):
+        actions = np.array([0, 1, 2, 1])
+        observations, rewards, dones, infos = env.step(actions)
+    assert((observations[:, -1, 0] == actions).all())
+    assert((observations[:, -1, 1] == 1).all())
+    assert(rewards.tolist() == [-10, -1, 10, -1])
+    assert(dones.tolist() == [True, False, True, False])
+    assert('terminal_observation' in infos[0])
+    assert('terminal_observation' not in infos[1])
+
+def test_subproc_step():
+    from functools import partial
+    from envs import JurinaPlayer
+    for backend in ['subproc', 'shmem']:
+        env = make_batch_vec_env(partial(JurinaPlayer, action=1),
+            num_envs=5, workers=2, backend=backend)
+        observations = env.reset()
+        assert(observations.shape == (5, 100, 2))
+        actions = np.array([0, 1, 2, 1, 0])
+        for _ in range(3):
+            observations, rewards, dones, infos = env.step(actions)
+        assert((observations[:, -1, 0] == actions).all())
+        assert((observations[:, -1, 1] == 1).all())
+        assert(rewards.tolist() == [-10, -1, 10, -1, -10])
+        assert(dones.tolist() == [True, False, True, False, True])
+        assert(env.get_attr('num_envs') == [3, 3, 3, 2, 2])
+        assert(env.env_method('get_state', indices=[0, 4])[0]['head'] == 3)
+        env.close()
+
+def test_seed():
+    from envs import ProbPlayer
+    envs = [BatchRockPaperScissorsEnv(ProbPlayer(), num_envs=4, seed=3) for _ in range(2)]
+    assert((envs[0].reset() == envs[1].reset()).all())
+    actions = np.array([0, 1, 2, 1])
+    for _ in range(10):
+        first, second = envs[0].step(actions), envs[1].step(actions)
+        assert((first[0] == second[0]).all())
+    envs[0].seed(4)
+    envs[1].seed(4)
+    envs[0].init_observations()
+    envs[1].init_observations()
+    assert((envs[0].reset() == envs[1].reset()).all())
+    # env_method() は環境数によらず1回だけ呼び出す
+    envs[0].env_method('init_observations')
+    envs[1].init_observations()
+    assert((envs[0].reset() == envs[1].reset()).all())
+    # 状態を復元すると同じ続きの観測となる
+    state = envs[0].get_state()
+    expected = [envs[0].step(actions)[0] for _ in range(10)]
+    envs[1].set_state(state)
+    for observations in expected:
+        assert((envs[1].step(actions)[0] == observations).all())
+
+if __name__ == '__main__':
+    test_step()
+    test_subproc_step()
+    test_seed()